@@ -6,6 +6,8 @@ from flask import Flask
 
 from src.auth import init_oidc
 from src.auth.decorators import requires_auth as create_auth_decorator
+from src.camera import SessionPool
+from src.camera_registry import CameraRegistry
 from src.config import (
     configure_app,
     parse_arguments,
@@ -15,14 +17,20 @@ from src.config import (
     build_download_config
 )
 from src.logger import Logger
+from src.mirror import MirrorService
+from src.retention import RetentionEngine
 from src.routes import register_routes
+from src.storage import SqliteStore
 from src.task_manager import TaskManager
+from src.worker import init_runtime
 
 task_manager = None
+mirror_service = None
+retention_engine = None
 
 
 def create_app(args=None):
-    global task_manager
+    global task_manager, mirror_service, retention_engine
     app = Flask(__name__)
 
     if args is None:
@@ -34,6 +42,7 @@ def create_app(args=None):
 
     credentials = build_credentials(args)
     config = build_download_config(args)
+    registry = CameraRegistry.from_config(args)
     oidc_config = {}
     oauth = None
 
@@ -54,26 +63,41 @@ def create_app(args=None):
         args['auth_method'], oidc_config, credentials
     )
 
-    task_manager = TaskManager()
+    init_runtime(config, registry)
+
+    task_manager = TaskManager(config=config, registry=registry, role=args['role'])
+    mirror_service = MirrorService(task_manager, registry, config)
+    retention_engine = RetentionEngine(config, registry, task_manager.worker_id)
     register_routes(
-        app, oauth, oidc_config, credentials,
-        task_manager, config, requires_auth_decorator, args['auth_method']
+        app, oauth, oidc_config, credentials, registry,
+        task_manager, config, requires_auth_decorator, args['auth_method'], mirror_service, retention_engine
     )
 
     task_manager.start()
+    if task_manager.runs_tasks:
+        mirror_service.start()
+        retention_engine.start()
 
     def cleanup():
+        if retention_engine:
+            retention_engine.stop()
+        if mirror_service:
+            mirror_service.stop()
         if task_manager:
             task_manager.stop()
-    
+        SessionPool.close_all()
+        SqliteStore.close_all()
+
     atexit.register(cleanup)
     signal.signal(signal.SIGTERM, lambda signum, frame: cleanup())
     signal.signal(signal.SIGINT, lambda signum, frame: cleanup())
 
     logger.info("HikFetch Initialized")
-    logger.info(f"Camera URL: {args['camera_url']}")
+    for camera in registry.all():
+        logger.info(f"Camera {camera.id}: {camera.url} (channels {camera.channels})")
     logger.info(f"Media will be saved to: {args['download_dir']}")
     logger.info(f"Authentication: {args['auth_method']}")
+    logger.info(f"Role: {args['role']}")
 
     return app
 
@@ -0,0 +1,97 @@
+import shutil
+import threading
+
+
+class DiskBudget:
+    path = None
+    min_free_bytes = 0
+    quota_bytes = 0
+    archive_index = None
+
+    _reservations = {}
+    _condition = threading.Condition()
+
+    _WAIT_STEP_SECONDS = 5
+
+    @classmethod
+    def init(cls, path, min_free_bytes=0, quota_bytes=0, archive_index=None):
+        with cls._condition:
+            cls.path = path
+            cls.min_free_bytes = min_free_bytes
+            cls.quota_bytes = quota_bytes
+            cls.archive_index = archive_index
+            cls._condition.notify_all()
+
+    @classmethod
+    def enabled(cls):
+        return cls.path is not None and bool(cls.min_free_bytes or cls.quota_bytes)
+
+    @classmethod
+    def check(cls, needed_bytes, task_id=None):
+        with cls._condition:
+            return cls.__check(needed_bytes, task_id)
+
+    @classmethod
+    def admit(cls, task_id, needed_bytes, cancel_event=None):
+        with cls._condition:
+            while True:
+                decision = cls.__check(needed_bytes, task_id)
+                if decision['verdict'] != 'wait':
+                    break
+                if cancel_event is not None and cancel_event.is_set():
+                    return decision
+                cls._condition.wait(cls._WAIT_STEP_SECONDS)
+
+            if decision['verdict'] == 'ok':
+                cls._reservations[task_id] = needed_bytes
+            return decision
+
+    @classmethod
+    def consume(cls, task_id, written_bytes):
+        with cls._condition:
+            if task_id in cls._reservations:
+                cls._reservations[task_id] = max(0, cls._reservations[task_id] - written_bytes)
+
+    @classmethod
+    def release(cls, task_id):
+        with cls._condition:
+            if cls._reservations.pop(task_id, None) is not None:
+                cls._condition.notify_all()
+
+    @classmethod
+    def reserved_bytes(cls):
+        with cls._condition:
+            return sum(cls._reservations.values())
+
+    @classmethod
+    def __check(cls, needed_bytes, task_id):
+        # Reservations cover what admitted tasks have yet to write; free space
+        # already reflects what they wrote so far.
+        reserved = sum(size for other, size in cls._reservations.items() if other != task_id)
+        free = shutil.disk_usage(cls.path).free - cls.min_free_bytes
+        decision = {'verdict': 'ok', 'needed_bytes': needed_bytes, 'free_bytes': max(free, 0),
+                    'reserved_bytes': reserved}
+        limits = [('free space', free)]
+        if cls.quota_bytes:
+            used = cls.archive_index.total_size() if cls.archive_index else 0
+            decision.update(quota_bytes=cls.quota_bytes, quota_used_bytes=used)
+            limits.append(('quota', cls.quota_bytes - used))
+
+        for name, available in limits:
+            # Too big even once every other task is done: waiting cannot help
+            if needed_bytes > available:
+                decision.update(verdict='reject', message='{} needed, only {} of {} left'.format(
+                    format_bytes(needed_bytes), format_bytes(max(available, 0)), name))
+                return decision
+            if needed_bytes > available - reserved:
+                decision.update(verdict='wait', message='{} needed, {} of {} left after running tasks'.format(
+                    format_bytes(needed_bytes), format_bytes(max(available - reserved, 0)), name))
+        return decision
+
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(size)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
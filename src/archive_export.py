@@ -0,0 +1,181 @@
+import hashlib
+import os
+import struct
+import tarfile
+import time
+import zlib
+
+
+class ArchiveEntry:
+    def __init__(self, path, name, size, mtime):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def from_file(cls, path, name):
+        stat = os.stat(path)
+        return cls(path, name, stat.st_size, int(stat.st_mtime))
+
+
+class ArchiveStream:
+    CONTENT_TYPES = {'zip': 'application/zip', 'tar': 'application/x-tar'}
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, entries, archive_format, checksums):
+        if archive_format not in self.CONTENT_TYPES:
+            raise ValueError(f"Unsupported archive format '{archive_format}'")
+
+        self.entries = entries
+        self.format = archive_format
+        self.checksums = checksums
+        # Every part has a known length up front, so Content-Length and Range
+        # work without building the archive; only ZIP checksums are resolved late.
+        self.parts = self.__zip_parts() if archive_format == 'zip' else self.__tar_parts()
+        self.size = sum(length for length, _, _ in self.parts)
+
+    @property
+    def content_type(self):
+        return self.CONTENT_TYPES[self.format]
+
+    def etag(self):
+        digest = hashlib.sha1(self.format.encode())
+        for entry in self.entries:
+            digest.update('{}\0{}\0{}\n'.format(entry.name, entry.size, entry.mtime).encode())
+        return digest.hexdigest()
+
+    def iter_bytes(self, start=0, stop=None):
+        stop = self.size if stop is None else stop
+        offset = 0
+        for length, kind, value in self.parts:
+            part_start, part_stop = max(start - offset, 0), min(stop - offset, length)
+            offset += length
+            if part_start >= part_stop:
+                continue
+
+            if kind == 'file':
+                yield from self.__read_file(value, part_start, part_stop)
+            else:
+                data = value() if callable(value) else value
+                yield data[part_start:part_stop]
+
+            if offset >= stop:
+                break
+
+    def __read_file(self, entry, start, stop):
+        checksum = 0 if start == 0 and self.format == 'zip' else None
+        with open(entry.path, 'rb') as file:
+            file.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = file.read(min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{entry.path} is shorter than when the archive was planned")
+                if checksum is not None:
+                    checksum = zlib.crc32(chunk, checksum)
+                remaining -= len(chunk)
+                yield chunk
+
+        # A full pass computes the checksum for free, so later descriptors and
+        # resumed downloads do not have to read the file again.
+        if checksum is not None and stop == entry.size:
+            self.checksums.record(entry, checksum)
+
+    def __tar_parts(self):
+        parts = []
+        for entry in self.entries:
+            info = tarfile.TarInfo(entry.name)
+            info.size = entry.size
+            info.mtime = entry.mtime
+            info.mode = 0o644
+            header = info.tobuf(format=tarfile.GNU_FORMAT)
+            padding = -entry.size % tarfile.BLOCKSIZE
+            parts.append((len(header), 'bytes', header))
+            parts.append((entry.size, 'file', entry))
+            if padding:
+                parts.append((padding, 'bytes', bytes(padding)))
+
+        trailer = bytes(tarfile.BLOCKSIZE * 2)
+        parts.append((len(trailer), 'bytes', trailer))
+        return parts
+
+    # ZIP64 is always used: clips of a long task easily exceed 4 GB in total,
+    # and a single fixed layout keeps every offset computable in advance.
+    __ZIP_VERSION = 45
+    __ZIP_FLAGS = 0x0808
+    __ZIP_MAX_32 = 0xFFFFFFFF
+
+    def __zip_parts(self):
+        parts = []
+        offset = 0
+        central_directory = []
+        for entry in self.entries:
+            name = entry.name.encode('utf-8')
+            dos_time, dos_date = self.__dos_time(entry.mtime)
+            local_header = struct.pack(
+                '<IHHHHHIIIHH', 0x04034b50, self.__ZIP_VERSION, self.__ZIP_FLAGS, 0, dos_time, dos_date,
+                0, self.__ZIP_MAX_32, self.__ZIP_MAX_32, len(name), 20) + name + \
+                struct.pack('<HHQQ', 0x0001, 16, entry.size, entry.size)
+
+            parts.append((len(local_header), 'bytes', local_header))
+            parts.append((entry.size, 'file', entry))
+            parts.append((24, 'lazy', self.__data_descriptor(entry)))
+            central_directory.append((entry, name, dos_time, dos_date, offset))
+            offset += len(local_header) + entry.size + 24
+
+        directory_size = sum(46 + len(name) + 28 for _, name, _, _, _ in central_directory)
+        parts.append((directory_size, 'lazy', lambda: self.__central_directory(central_directory)))
+
+        count = len(self.entries)
+        end_record = struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, self.__ZIP_VERSION, self.__ZIP_VERSION, 0, 0, count, count,
+            directory_size, offset)
+        end_locator = struct.pack('<IIQI', 0x07064b50, 0, offset + directory_size, 1)
+        end_of_directory = struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(directory_size, self.__ZIP_MAX_32), self.__ZIP_MAX_32, 0)
+        trailer = end_record + end_locator + end_of_directory
+        parts.append((len(trailer), 'bytes', trailer))
+        return parts
+
+    def __data_descriptor(self, entry):
+        return lambda: struct.pack('<IIQQ', 0x08074b50, self.checksums.get(entry), entry.size, entry.size)
+
+    def __central_directory(self, central_directory):
+        records = []
+        for entry, name, dos_time, dos_date, offset in central_directory:
+            records.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | self.__ZIP_VERSION, self.__ZIP_VERSION,
+                self.__ZIP_FLAGS, 0, dos_time, dos_date, self.checksums.get(entry), self.__ZIP_MAX_32,
+                self.__ZIP_MAX_32, len(name), 28, 0, 0, 0, 0o100644 << 16, self.__ZIP_MAX_32))
+            records.append(name)
+            records.append(struct.pack('<HHQQQ', 0x0001, 24, entry.size, entry.size, offset))
+        return b''.join(records)
+
+    @staticmethod
+    def __dos_time(mtime):
+        moment = time.localtime(max(mtime, 315532800))
+        dos_time = (moment.tm_hour << 11) | (moment.tm_min << 5) | (moment.tm_sec // 2)
+        dos_date = ((moment.tm_year - 1980) << 9) | (moment.tm_mon << 5) | moment.tm_mday
+        return dos_time, dos_date
+
+
+class ClipChecksums:
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, archive_index):
+        self.archive_index = archive_index
+
+    def get(self, entry):
+        checksum = self.archive_index.get_checksum(entry.path, entry.size, entry.mtime)
+        if checksum is None:
+            checksum = 0
+            with open(entry.path, 'rb') as file:
+                for chunk in iter(lambda: file.read(self.CHUNK_SIZE), b''):
+                    checksum = zlib.crc32(chunk, checksum)
+            self.record(entry, checksum)
+        return checksum
+
+    def record(self, entry, checksum):
+        self.archive_index.record_checksum(entry.path, entry.size, entry.mtime, checksum)
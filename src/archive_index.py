@@ -0,0 +1,168 @@
+import json
+import os
+from datetime import datetime
+
+from src.storage import SqliteStore
+
+
+class ArchiveIndex(SqliteStore):
+    FILE_NAME = 'archive.db'
+    RETENTION_RUNS_KEEP_COUNT = 100
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS clips (
+    camera TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    playback_uri TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    expected_size INTEGER NOT NULL,
+    file_path TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    downloaded_at TEXT NOT NULL,
+    PRIMARY KEY (camera, channel, playback_uri, start_time, end_time, expected_size)
+);
+CREATE INDEX IF NOT EXISTS clips_file_path ON clips (file_path);
+CREATE INDEX IF NOT EXISTS clips_start_time ON clips (start_time);
+CREATE TABLE IF NOT EXISTS clip_checksums (
+    file_path TEXT PRIMARY KEY,
+    file_size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS retention_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    deleted_files INTEGER NOT NULL DEFAULT 0,
+    deleted_bytes INTEGER NOT NULL DEFAULT 0,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS retention_requests (
+    requested_at TEXT NOT NULL
+);
+"""
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls.open(os.path.join(state_dir, cls.FILE_NAME))
+
+    def find_downloaded(self, camera, channel, track):
+        rows = self.__find(camera, channel, track)
+        if not rows:
+            return None
+
+        file_path = rows[0]['file_path']
+        if self.__has_size(file_path, rows[0]['file_size']):
+            return file_path
+
+        self.execute(
+            'DELETE FROM clips WHERE camera = ? AND channel = ? AND playback_uri = ? '
+            'AND start_time = ? AND end_time = ? AND expected_size = ?',
+            self.__key(camera, channel, track))
+        return None
+
+    def has_clip(self, camera, channel, track, file_path):
+        # Read-only counterpart of find_downloaded and adopt_existing, for estimates
+        rows = self.__find(camera, channel, track)
+        if rows and self.__has_size(rows[0]['file_path'], rows[0]['file_size']):
+            return True
+        expected_size = track.size()
+        return bool(expected_size) and self.__has_size(file_path, expected_size)
+
+    def adopt_existing(self, camera, channel, track, file_path):
+        expected_size = track.size()
+        if expected_size and self.__has_size(file_path, expected_size):
+            self.record(camera, channel, track, file_path)
+            return True
+        return False
+
+    def record(self, camera, channel, track, file_path):
+        self.execute(
+            'INSERT OR REPLACE INTO clips (camera, channel, playback_uri, start_time, end_time, expected_size, '
+            'file_path, file_size, downloaded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self.__key(camera, channel, track) + (file_path, os.path.getsize(file_path), datetime.now().isoformat()))
+
+    def average_clip_size(self, camera):
+        rows = self.execute('SELECT AVG(file_size) AS size FROM clips WHERE camera = ?', (camera,))
+        return int(rows[0]['size'] or 0)
+
+    def total_size(self):
+        rows = self.execute('SELECT SUM(file_size) AS size FROM clips')
+        return rows[0]['size'] or 0
+
+    def find_clips(self, camera, channels, start_time_text, end_time_text):
+        placeholders = ', '.join('?' for _ in channels)
+        rows = self.execute(
+            'SELECT channel, start_time, file_path, file_size FROM clips WHERE camera = ? '
+            'AND channel IN ({}) AND start_time < ? AND end_time > ? '
+            'ORDER BY channel, start_time'.format(placeholders),
+            (camera, *channels, end_time_text, start_time_text))
+        return [dict(row) for row in rows if self.__has_size(row['file_path'], row['file_size'])]
+
+    def camera_usage(self):
+        rows = self.execute('SELECT camera, COUNT(*) AS clips, SUM(file_size) AS bytes, MIN(start_time) AS oldest '
+                            'FROM clips GROUP BY camera')
+        return {row['camera']: dict(row) for row in rows}
+
+    def list_oldest(self, after_start_time, after_rowid, limit):
+        rows = self.execute(
+            'SELECT rowid, camera, channel, start_time, file_path, file_size FROM clips '
+            'WHERE (start_time, rowid) > (?, ?) ORDER BY start_time, rowid LIMIT ?',
+            (after_start_time, after_rowid, limit))
+        return [dict(row) for row in rows]
+
+    def delete_clips(self, rows):
+        self.execute_many('DELETE FROM clips WHERE rowid = ?', [(row['rowid'],) for row in rows])
+        self.execute_many('DELETE FROM clip_checksums WHERE file_path = ?', [(row['file_path'],) for row in rows])
+
+    def start_retention_run(self):
+        rows = self.execute('INSERT INTO retention_runs (started_at) VALUES (?) RETURNING run_id',
+                            (datetime.now().isoformat(),))
+        return rows[0]['run_id']
+
+    def finish_retention_run(self, run_id, report):
+        self.execute(
+            'UPDATE retention_runs SET finished_at = ?, deleted_files = ?, deleted_bytes = ?, report = ? '
+            'WHERE run_id = ?',
+            (datetime.now().isoformat(), report['files'], report['bytes'], json.dumps(report), run_id))
+        self.execute('DELETE FROM retention_runs WHERE run_id <= ?', (run_id - self.RETENTION_RUNS_KEEP_COUNT,))
+
+    def list_retention_runs(self, limit=10):
+        rows = self.execute('SELECT * FROM retention_runs ORDER BY run_id DESC LIMIT ?', (limit,))
+        return [dict(row, report=json.loads(row['report']) if row['report'] else None) for row in rows]
+
+    def request_retention_run(self):
+        self.execute('INSERT INTO retention_requests (requested_at) VALUES (?)', (datetime.now().isoformat(),))
+
+    def pop_retention_requests(self):
+        return bool(self.execute('DELETE FROM retention_requests RETURNING requested_at'))
+
+    def get_checksum(self, file_path, file_size, mtime):
+        rows = self.execute(
+            'SELECT crc32 FROM clip_checksums WHERE file_path = ? AND file_size = ? AND mtime = ?',
+            (file_path, file_size, mtime))
+        return rows[0]['crc32'] if rows else None
+
+    def record_checksum(self, file_path, file_size, mtime, crc32):
+        self.execute(
+            'INSERT OR REPLACE INTO clip_checksums (file_path, file_size, mtime, crc32) VALUES (?, ?, ?, ?)',
+            (file_path, file_size, mtime, crc32))
+
+    def __find(self, camera, channel, track):
+        return self.execute(
+            'SELECT file_path, file_size FROM clips WHERE camera = ? AND channel = ? AND playback_uri = ? '
+            'AND start_time = ? AND end_time = ? AND expected_size = ?',
+            self.__key(camera, channel, track))
+
+    @staticmethod
+    def __key(camera, channel, track):
+        start_time_text, end_time_text = track.get_time_interval().to_text()
+        return camera, channel, track.url_to_download(), start_time_text, end_time_text, track.size()
+
+    @staticmethod
+    def __has_size(file_path, size):
+        try:
+            return os.path.getsize(file_path) == size
+        except OSError:
+            return False
@@ -1,5 +1,7 @@
 from .sdk import CameraSdk, AuthType
+from .capabilities import CapabilityCache, DeviceCapabilities
+from .session import SessionPool
 from .track import Track
 from .time_interval import TimeInterval
 
-__all__ = ['CameraSdk', 'AuthType', 'Track', 'TimeInterval']
+__all__ = ['CameraSdk', 'AuthType', 'CapabilityCache', 'DeviceCapabilities', 'SessionPool', 'Track', 'TimeInterval']
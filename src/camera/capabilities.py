@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from .sdk import CameraSdk, AuthType
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceCapabilities:
+    def __init__(self, auth_type, local_time, time_offset, features, channels):
+        self.auth_type = auth_type
+        self.local_time = local_time
+        self.time_offset = time_offset
+        self.features = features
+        self.channels = channels
+        self.batch_search = True
+        self.fetched_at = time.monotonic()
+
+    def camera_now(self):
+        # The device clock is read once per probe and advanced locally, so
+        # callers get camera time without another /System/time round trip.
+        return self.local_time + timedelta(seconds=time.monotonic() - self.fetched_at)
+
+    def age_seconds(self):
+        return time.monotonic() - self.fetched_at
+
+    def to_dict(self):
+        return {
+            'auth_type': 'basic' if self.auth_type == AuthType.BASIC else 'digest',
+            'time_offset_minutes': int(self.time_offset.total_seconds() // 60),
+            'features': sorted(self.features),
+            'channels': self.channels,
+            'batch_search': self.batch_search,
+            'age_seconds': int(self.age_seconds())
+        }
+
+
+class CapabilityCache:
+    ttl_seconds = 3600
+
+    _entries = {}
+    _camera_locks = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def init(cls, ttl_seconds):
+        cls.ttl_seconds = max(1, ttl_seconds)
+
+    @classmethod
+    def get(cls, camera):
+        capabilities = cls.peek(camera.id)
+        if capabilities is not None:
+            return capabilities
+
+        with cls.__camera_lock(camera.id):
+            capabilities = cls.peek(camera.id)
+            if capabilities is None:
+                capabilities = cls.__probe(camera)
+                with cls._lock:
+                    cls._entries[camera.id] = capabilities
+            return capabilities
+
+    @classmethod
+    def peek(cls, camera_id):
+        with cls._lock:
+            capabilities = cls._entries.get(camera_id)
+            if capabilities is None or capabilities.age_seconds() >= cls.ttl_seconds:
+                return None
+            return capabilities
+
+    @classmethod
+    def invalidate(cls, camera_id):
+        with cls._lock:
+            if cls._entries.pop(camera_id, None) is not None:
+                logger.info(f"Dropped cached capabilities of camera {camera_id}")
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries.clear()
+
+    @classmethod
+    def warm(cls, cameras):
+        thread = threading.Thread(target=cls.__warm, args=(list(cameras),), name='capability-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def __warm(cls, cameras):
+        for camera in cameras:
+            try:
+                capabilities = cls.get(camera)
+                logger.info(f"Camera {camera.id}: {capabilities.to_dict()}")
+            except Exception as e:
+                logger.warning(f"Could not probe camera {camera.id}: {e}")
+
+    @classmethod
+    def __camera_lock(cls, camera_id):
+        with cls._lock:
+            return cls._camera_locks.setdefault(camera_id, threading.Lock())
+
+    @staticmethod
+    def __probe(camera):
+        auth_type, time_answer = CameraSdk.detect_auth(camera.url, camera.username, camera.password)
+        if auth_type == AuthType.UNAUTHORISED:
+            raise RuntimeError('Unauthorised! Check login and password')
+
+        auth_handler = CameraSdk.get_auth(auth_type, camera.username, camera.password)
+        local_time, time_offset = CameraSdk.parse_time_info(time_answer)
+
+        return DeviceCapabilities(
+            auth_type=auth_type,
+            local_time=local_time,
+            time_offset=time_offset,
+            features=CameraSdk.get_supported_features(auth_handler, camera.url),
+            channels=CameraSdk.get_channel_ids(auth_handler, camera.url)
+        )
@@ -1,12 +1,17 @@
+import json
+import os
 import re
+import time
 import uuid
-from datetime import timedelta
+from datetime import datetime, timedelta
 from xml.etree import ElementTree
 
 import requests
-from requests.auth import HTTPBasicAuth, HTTPDigestAuth
 
+from src import metrics
+from src.limits import BandwidthLimiter
 from src.logger import Logger
+from .session import SessionPool
 from .track import Track
 
 
@@ -22,10 +27,20 @@ class CameraSdk:
         ERROR = 2
         DEVICE_ERROR = 3
         TIMEOUT = 4
+        UNAUTHORISED = 5
+        CONNECTION_ERROR = 6
+
+        NAMES = {OK: 'ok', ERROR: 'error', DEVICE_ERROR: 'device_error', TIMEOUT: 'timeout',
+                 UNAUTHORISED: 'unauthorised', CONNECTION_ERROR: 'connection_error'}
 
         def __init__(self, result_type, text=""):
             self.result_type = result_type
             self.text = text
+            self.stages = {}
+            self.received_bytes = 0
+
+        def name(self):
+            return self.NAMES.get(self.result_type, 'unknown')
 
         @classmethod
         def ok(cls):
@@ -43,13 +58,29 @@ class CameraSdk:
         def timeout(cls):
             return cls(cls.TIMEOUT)
 
+        @classmethod
+        def unauthorised(cls, text):
+            return cls(cls.UNAUTHORISED, text)
+
+        @classmethod
+        def connection_error(cls, text):
+            return cls(cls.CONNECTION_ERROR, text)
+
     default_timeout_seconds = 10
+    PART_SUFFIX = '.part'
+    JOURNAL_SUFFIX = '.json'
+    JOURNAL_INTERVAL_BYTES = 4 * 1024 * 1024
+    __UNAUTHORISED_CODE = 401
     __DEVICE_ERROR_CODE = 500
+    __RANGE_NOT_SATISFIABLE_CODE = 416
     __VIDEO_TRACK_ID = 101
     __PHOTO_TRACK_ID = 103
     __camera_channel = 1
 
     __TIME_URL = '/ISAPI/System/time'
+    __CONTENT_CAPABILITIES_URL = '/ISAPI/ContentMgmt/capabilities'
+    __PROXY_CHANNELS_URL = '/ISAPI/ContentMgmt/InputProxy/channels'
+    __VIDEO_INPUT_CHANNELS_URL = '/ISAPI/System/Video/inputs/channels'
     __SEARCH_MEDIA_URL = '/ISAPI/ContentMgmt/search'
     __DOWNLOAD_MEDIA_URL = '/ISAPI/ContentMgmt/download'
 
@@ -80,8 +111,9 @@ class CameraSdk:
 </downloadRequest>"""
 
     @classmethod
-    def init(cls, default_timeout_seconds, camera_channel=1):
+    def init(cls, default_timeout_seconds, camera_channel=1, connection_pool_size=4):
         cls.default_timeout_seconds = default_timeout_seconds
+        SessionPool.init(connection_pool_size)
         cls.__camera_channel = camera_channel
         cls.__VIDEO_TRACK_ID = camera_channel * 100 + 1
         cls.__PHOTO_TRACK_ID = camera_channel * 100 + 3
@@ -105,29 +137,76 @@ class CameraSdk:
 
     @classmethod
     def get_auth_type(cls, cam_url, user_name, password):
-        auth_handler = HTTPBasicAuth(user_name, password)
-        request = cls.__make_get_request(auth_handler, cam_url, cls.__TIME_URL)
-        if request.ok:
-            return AuthType.BASIC
+        return cls.detect_auth(cam_url, user_name, password)[0]
 
-        auth_handler = HTTPDigestAuth(user_name, password)
-        request = cls.__make_get_request(auth_handler, cam_url, cls.__TIME_URL)
-        if request.ok:
-            return AuthType.DIGEST
+    @classmethod
+    def detect_auth(cls, cam_url, user_name, password):
+        for auth_type in (AuthType.BASIC, AuthType.DIGEST):
+            auth_handler = cls.get_auth(auth_type, user_name, password)
+            answer = cls.__make_get_request(auth_handler, cam_url, cls.__TIME_URL)
+            if answer.ok:
+                return auth_type, answer
 
-        return AuthType.UNAUTHORISED
+        return AuthType.UNAUTHORISED, None
 
     @classmethod
     def get_time_offset(cls, auth_handler, cam_url):
+        return cls.parse_time_info(cls.__get_time_answer(auth_handler, cam_url))[1]
+
+    @classmethod
+    def get_local_time(cls, auth_handler, cam_url):
+        return cls.parse_time_info(cls.__get_time_answer(auth_handler, cam_url))[0]
+
+    @classmethod
+    def __get_time_answer(cls, auth_handler, cam_url):
         answer = cls.__make_get_request(auth_handler, cam_url, cls.__TIME_URL)
-        if answer:
-            time_info_text = cls.__clear_xml_from_namespaces(answer.text)
-            time_info_xml = ElementTree.fromstring(time_info_text)
-            timezone_raw = time_info_xml.find('timeZone')
-            time_offset = cls.parse_timezone(timezone_raw.text)
-            return time_offset
-        else:
+        if not answer:
             raise RuntimeError(cls.get_error_message_from(answer))
+        return answer
+
+    @classmethod
+    def parse_time_info(cls, answer):
+        time_info_text = cls.__clear_xml_from_namespaces(answer.text)
+        time_info_xml = ElementTree.fromstring(time_info_text)
+        local_time_raw = time_info_xml.find('localTime')
+        timezone_raw = time_info_xml.find('timeZone')
+        local_time = datetime.strptime(local_time_raw.text[:19], '%Y-%m-%dT%H:%M:%S')
+        time_offset = cls.parse_timezone(timezone_raw.text) if timezone_raw is not None else timedelta()
+        return local_time, time_offset
+
+    @classmethod
+    def get_supported_features(cls, auth_handler, cam_url):
+        capabilities_xml = cls.__get_optional_xml(auth_handler, cam_url, cls.__CONTENT_CAPABILITIES_URL)
+        if capabilities_xml is None:
+            return set()
+        return {element.tag for element in capabilities_xml.iter() if (element.text or '').strip() == 'true'}
+
+    @classmethod
+    def get_channel_ids(cls, auth_handler, cam_url):
+        for url in (cls.__PROXY_CHANNELS_URL, cls.__VIDEO_INPUT_CHANNELS_URL):
+            channels_xml = cls.__get_optional_xml(auth_handler, cam_url, url)
+            if channels_xml is None:
+                continue
+
+            channel_ids = set()
+            for channel in channels_xml:
+                channel_id = channel.find('id')
+                if channel_id is not None and (channel_id.text or '').strip().isdigit():
+                    channel_ids.add(int(channel_id.text))
+            if channel_ids:
+                return sorted(channel_ids)
+
+        return []
+
+    @classmethod
+    def __get_optional_xml(cls, auth_handler, cam_url, url):
+        try:
+            answer = cls.__make_get_request(auth_handler, cam_url, url)
+            if not answer:
+                return None
+            return ElementTree.fromstring(cls.__clear_xml_from_namespaces(answer.text))
+        except (requests.exceptions.RequestException, ElementTree.ParseError):
+            return None
 
     @staticmethod
     def parse_timezone(raw_timezone):
@@ -146,45 +225,170 @@ class CameraSdk:
     @staticmethod
     def get_auth(auth_type, name, password):
         if auth_type == AuthType.BASIC:
-            return HTTPBasicAuth(name, password)
+            return SessionPool.basic_auth(name, password)
         elif auth_type == AuthType.DIGEST:
-            return HTTPDigestAuth(name, password)
+            return SessionPool.digest_auth(name, password)
         else:
             return None
 
     @classmethod
-    def download_file(cls, auth_handler, cam_url, file_uri, file_name, task=None):
+    def download_file(cls, auth_handler, cam_url, file_uri, file_name, task=None, rate_limit_key=None):
+        attempt = {'stages': {}, 'received_bytes': 0}
+        result = cls.__download_file(auth_handler, cam_url, file_uri, file_name, task, rate_limit_key, attempt)
+        result.stages = attempt['stages']
+        result.received_bytes = attempt['received_bytes']
+        return result
+
+    @classmethod
+    def __download_file(cls, auth_handler, cam_url, file_uri, file_name, task, rate_limit_key, attempt):
         request = ElementTree.fromstring(cls.__DOWNLOAD_REQUEST_XML)
         playback_uri = request.find('playbackURI')
         playback_uri.text = file_uri
         request_data = ElementTree.tostring(request, encoding='utf8', method='xml')
 
+        part_name = file_name + cls.PART_SUFFIX
+        journal_name = part_name + cls.JOURNAL_SUFFIX
+        offset = cls.__get_resume_offset(file_uri, part_name, journal_name)
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+
         url = cam_url + cls.__DOWNLOAD_MEDIA_URL
+        session = SessionPool.get_session(cam_url)
+        camera = rate_limit_key or cam_url
+        started_at = time.monotonic()
         try:
-            answer = requests.get(url=url, auth=auth_handler, data=request_data, stream=True,
-                                  timeout=cls.default_timeout_seconds)
-            if answer:
-                with open(file_name, 'wb') as out_file:
-                    for chunk in answer.iter_content(chunk_size=8192):
-                        if task and task.is_cancelled():
-                            answer.close()
-                            out_file.close()
-                            import os
-                            if os.path.exists(file_name):
-                                os.remove(file_name)
-                            return cls.FileDownloadingResult.error("Cancelled")
-                        if chunk:
-                            out_file.write(chunk)
-                answer.close()
+            with session.get(url=url, auth=auth_handler, data=request_data, headers=headers, stream=True,
+                             timeout=cls.default_timeout_seconds) as answer:
+                cls.__observe_stage(camera, 'response', time.monotonic() - started_at, attempt)
+
+                if answer.status_code == cls.__RANGE_NOT_SATISFIABLE_CODE:
+                    cls.__remove_partial_file(part_name, journal_name)
+                    return cls.FileDownloadingResult.error('Partial file is out of range, restarting')
+
+                if not answer:
+                    return cls.get_file_downloading_result_error(answer)
+
+                if offset and not cls.__is_resumed_answer(answer, offset):
+                    Logger.get_logger().debug('Device ignored Range request, restarting {}'.format(file_name))
+                    offset = 0
+
+                cancelled = cls.__write_answer_to_part_file(answer, camera, file_uri, part_name,
+                                                            journal_name, offset, task, attempt)
+                if cancelled:
+                    return cls.FileDownloadingResult.error("Cancelled")
+
+                finalize_started_at = time.monotonic()
+                try:
+                    os.replace(part_name, file_name)
+                    os.remove(journal_name)
+                except OSError as e:
+                    return cls.FileDownloadingResult.error('Could not finalize {}: {}'.format(file_name, e))
+                cls.__observe_stage(camera, 'finalize', time.monotonic() - finalize_started_at, attempt)
                 return cls.FileDownloadingResult.ok()
-            else:
-                return cls.get_file_downloading_result_error(answer)
 
         except (requests.exceptions.Timeout, requests.packages.urllib3.exceptions.TimeoutError):
             return cls.FileDownloadingResult.timeout()
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+            return cls.FileDownloadingResult.connection_error('Connection interrupted: {}'.format(e))
+
+    @classmethod
+    def __write_answer_to_part_file(cls, answer, camera, file_uri, part_name, journal_name, offset, task, attempt):
+        cancel_event = task.cancel_flag if task else None
+        mode = 'r+b' if offset else 'wb'
+        received = offset
+        journaled = offset
+        downloaded_bytes = metrics.DOWNLOADED_BYTES.labels(camera=camera)
+        transfer_started_at = time.monotonic()
+        throttle_seconds = 0.0
+        disk_seconds = 0.0
+
+        with open(part_name, mode) as out_file:
+            out_file.seek(offset)
+            out_file.truncate()
+            try:
+                for chunk in answer.iter_content(chunk_size=65536):
+                    if task and task.is_cancelled():
+                        return True
+                    if chunk:
+                        throttle_started_at = time.monotonic()
+                        if not BandwidthLimiter.throttle(camera, len(chunk), cancel_event):
+                            return True
+                        write_started_at = time.monotonic()
+                        throttle_seconds += write_started_at - throttle_started_at
+
+                        out_file.write(chunk)
+                        received += len(chunk)
+                        downloaded_bytes.inc(len(chunk))
+                        if received - journaled >= cls.JOURNAL_INTERVAL_BYTES:
+                            out_file.flush()
+                            cls.__write_journal(journal_name, file_uri, received)
+                            journaled = received
+                        disk_seconds += time.monotonic() - write_started_at
+            finally:
+                out_file.flush()
+                cls.__write_journal(journal_name, file_uri, received)
+                attempt['received_bytes'] = received - offset
+                # Whatever is neither throttling nor writing is time spent waiting on the socket.
+                transfer_seconds = time.monotonic() - transfer_started_at
+                cls.__observe_stage(camera, 'network', max(0.0, transfer_seconds - throttle_seconds - disk_seconds),
+                                    attempt)
+                cls.__observe_stage(camera, 'throttle', throttle_seconds, attempt)
+                cls.__observe_stage(camera, 'disk', disk_seconds, attempt)
+
+        return False
+
+    @staticmethod
+    def __observe_stage(camera, stage, seconds, attempt):
+        metrics.CLIP_STAGE_SECONDS.labels(camera=camera, stage=stage).observe(seconds)
+        attempt['stages'][stage] = seconds
+
+    @classmethod
+    def __get_resume_offset(cls, file_uri, part_name, journal_name):
+        try:
+            with open(journal_name, 'r') as journal_file:
+                journal = json.load(journal_file)
+            part_size = os.path.getsize(part_name)
+        except (OSError, ValueError):
+            return 0
+
+        if journal.get('uri') != file_uri:
+            return 0
+
+        received = journal.get('bytes', 0)
+        if not isinstance(received, int) or received < 0 or received > part_size:
+            return 0
+
+        return received
+
+    @staticmethod
+    def __write_journal(journal_name, file_uri, received):
+        temp_name = journal_name + '.tmp'
+        with open(temp_name, 'w') as journal_file:
+            json.dump({'uri': file_uri, 'bytes': received}, journal_file)
+        os.replace(temp_name, journal_name)
+
+    @staticmethod
+    def __is_resumed_answer(answer, offset):
+        if answer.status_code != 206:
+            return False
+        content_range = answer.headers.get('Content-Range', '')
+        match = re.match(r'bytes (\d+)-', content_range)
+        return match is not None and int(match.group(1)) == offset
+
+    @staticmethod
+    def __remove_partial_file(part_name, journal_name):
+        for path in (part_name, journal_name):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def is_unauthorised(cls, answer):
+        return answer is not None and answer.status_code == cls.__UNAUTHORISED_CODE
 
     @classmethod
     def get_file_downloading_result_error(cls, answer):
+        if cls.is_unauthorised(answer):
+            return cls.FileDownloadingResult.unauthorised('Unauthorised! Check login and password')
+
         error_text = cls.get_error_message_from(answer)
         if answer.status_code == CameraSdk.__DEVICE_ERROR_CODE:
             return cls.FileDownloadingResult.device_error(error_text)
@@ -192,7 +396,7 @@ class CameraSdk:
             return cls.FileDownloadingResult.error(error_text)
 
     @classmethod
-    def get_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos, track_id):
+    def get_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos, track_ids, search_position=0):
         request = ElementTree.fromstring(cls.__SEARCH_MEDIA_XML)
 
         search_id = request.find('searchID')
@@ -201,8 +405,14 @@ class CameraSdk:
         max_results_count = request.find('maxResults')
         max_results_count.text = str(max_videos)
 
-        track_id_element = request.find('trackIDList').find('trackID')
-        track_id_element.text = str(track_id)
+        search_position_element = request.find('searchResultPostion')
+        search_position_element.text = str(search_position)
+
+        track_id_list = request.find('trackIDList')
+        for track_id_element in list(track_id_list):
+            track_id_list.remove(track_id_element)
+        for track_id in (track_ids if isinstance(track_ids, (list, tuple)) else [track_ids]):
+            ElementTree.SubElement(track_id_list, 'trackID').text = str(track_id)
 
         time_span = request.find('timeSpanList').find('timeSpan')
 
@@ -215,38 +425,69 @@ class CameraSdk:
         end_time_element.text = end_time_tz_text
 
         request_data = ElementTree.tostring(request, encoding='utf8', method='xml')
-        answer = cls.__make_post_request(auth_handler, cam_url, cls.__SEARCH_MEDIA_URL, request_data)
+        # Streamed, so iter_search_result parses the matches as they arrive
+        answer = cls.__make_post_request(auth_handler, cam_url, cls.__SEARCH_MEDIA_URL, request_data, stream=True)
 
         return answer
 
-    @classmethod
-    def get_video_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos):
-        return cls.get_tracks_info(auth_handler, cam_url, utc_time_interval, max_videos, cls.__VIDEO_TRACK_ID)
+    @staticmethod
+    def video_track_id(camera_channel):
+        return camera_channel * 100 + 1
+
+    @staticmethod
+    def channel_of_track(track_id):
+        return track_id // 100
 
     @classmethod
-    def get_photo_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos):
-        return cls.get_tracks_info(auth_handler, cam_url, utc_time_interval, max_videos, cls.__PHOTO_TRACK_ID)
+    def get_video_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos, camera_channel=None):
+        track_id = cls.__VIDEO_TRACK_ID if camera_channel is None else cls.video_track_id(camera_channel)
+        return cls.get_tracks_info(auth_handler, cam_url, utc_time_interval, max_videos, track_id)
 
     @classmethod
-    def create_tracks_from_info(cls, answer, local_time_offset):
-        answer_text = cls.__clear_xml_from_namespaces(answer.text)
-        answer_xml = ElementTree.fromstring(answer_text)
+    def get_photo_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos, camera_channel=None):
+        track_id = cls.__PHOTO_TRACK_ID if camera_channel is None else camera_channel * 100 + 3
+        return cls.get_tracks_info(auth_handler, cam_url, utc_time_interval, max_videos, track_id)
 
-        match_list = answer_xml.find('matchList')
-        if match_list is None:
-            Logger.get_logger().debug('Response XML: {}'.format(answer_text[:500]))
-            return []
+    @classmethod
+    def get_multi_channel_video_tracks_info(cls, auth_handler, cam_url, utc_time_interval, max_videos,
+                                            camera_channels, search_position=0):
+        track_ids = [cls.video_track_id(camera_channel) for camera_channel in camera_channels]
+        return cls.get_tracks_info(auth_handler, cam_url, utc_time_interval, max_videos, track_ids, search_position)
 
-        match_items = match_list.findall('searchMatchItem')
+    @classmethod
+    def create_tracks_from_info(cls, answer, local_time_offset, default_track_id=None):
+        return list(cls.iter_search_result(answer, local_time_offset, default_track_id))
 
-        tracks = []
-        for match_item in match_items:
-            media_descriptor = match_item.find('mediaSegmentDescriptor')
-            playback_uri = media_descriptor.find('playbackURI')
-            new_track = Track(playback_uri.text, local_time_offset)
-            tracks.append(new_track)
+    @classmethod
+    def iter_search_result(cls, answer, local_time_offset, default_track_id=None, page=None):
+        page = {} if page is None else page
+        page.update(has_more=False, has_match_list=False)
+        track_id = None
+        answer.raw.decode_content = True
+        try:
+            for _, element in ElementTree.iterparse(answer.raw, events=('end',)):
+                tag = cls.__local_tag(element.tag)
+                if tag == 'trackID':
+                    track_id = int(element.text) if (element.text or '').strip().isdigit() else None
+                elif tag == 'playbackURI':
+                    yield Track(element.text, local_time_offset,
+                                track_id if track_id is not None else default_track_id)
+                elif tag == 'searchMatchItem':
+                    track_id = None
+                    element.clear()
+                elif tag == 'matchList':
+                    page['has_match_list'] = True
+                elif tag == 'responseStatusStrg':
+                    page['has_more'] = (element.text or '').strip().upper() == 'MORE'
+        finally:
+            answer.close()
+
+        if not page['has_match_list']:
+            Logger.get_logger().debug('Search response without a match list')
 
-        return tracks
+    @staticmethod
+    def __local_tag(tag):
+        return tag.rpartition('}')[2]
 
     @staticmethod
     def __clear_xml_from_namespaces(xml_text):
@@ -254,10 +495,12 @@ class CameraSdk:
 
     @classmethod
     def __make_get_request(cls, auth_handler, cam_url, url):
-        return requests.get(url=cam_url + url, auth=auth_handler,
-                            timeout=cls.default_timeout_seconds, verify=True)
+        session = SessionPool.get_session(cam_url)
+        return session.get(url=cam_url + url, auth=auth_handler,
+                           timeout=cls.default_timeout_seconds, verify=True)
 
     @classmethod
-    def __make_post_request(cls, auth_handler, cam_url, url, request_data):
-        return requests.post(url=cam_url + url, auth=auth_handler, data=request_data,
-                             timeout=cls.default_timeout_seconds, verify=True)
+    def __make_post_request(cls, auth_handler, cam_url, url, request_data, stream=False):
+        session = SessionPool.get_session(cam_url)
+        return session.post(url=cam_url + url, auth=auth_handler, data=request_data, stream=stream,
+                            timeout=cls.default_timeout_seconds, verify=True)
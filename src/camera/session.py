@@ -0,0 +1,64 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth, HTTPDigestAuth
+
+
+class SessionPool:
+    pool_size = 4
+
+    _sessions = {}
+    _auth_handlers = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def init(cls, pool_size):
+        cls.pool_size = max(1, pool_size)
+
+    @classmethod
+    def get_session(cls, cam_url):
+        with cls._lock:
+            session = cls._sessions.get(cam_url)
+            if session is None:
+                session = cls.__create_session()
+                cls._sessions[cam_url] = session
+            return session
+
+    @classmethod
+    def get_auth_handler(cls, auth_class, user_name, password):
+        # Digest handlers keep the last nonce per thread, so reusing the same
+        # instance lets follow-up requests skip the 401 challenge round trip.
+        key = (auth_class, user_name, password)
+        with cls._lock:
+            handler = cls._auth_handlers.get(key)
+            if handler is None:
+                handler = auth_class(user_name, password)
+                cls._auth_handlers[key] = handler
+            return handler
+
+    @classmethod
+    def basic_auth(cls, user_name, password):
+        return cls.get_auth_handler(HTTPBasicAuth, user_name, password)
+
+    @classmethod
+    def digest_auth(cls, user_name, password):
+        return cls.get_auth_handler(HTTPDigestAuth, user_name, password)
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            sessions = list(cls._sessions.values())
+            cls._sessions.clear()
+            cls._auth_handlers.clear()
+
+        for session in sessions:
+            session.close()
+
+    @classmethod
+    def __create_session(cls):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.pool_size, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
@@ -1,10 +1,13 @@
+import re
 from datetime import datetime
 
 from .time_interval import TimeInterval
 
 
 class Track:
-    def __init__(self, text, local_time_offset):
+    __slots__ = ('_text', '_base_url', '_name', '_size', '_time_interval', '_track_id')
+
+    def __init__(self, text, local_time_offset, track_id=None):
         self._text = text
         self._base_url = ''
         self._name = ''
@@ -13,8 +16,8 @@ class Track:
         text = text.replace('?', '&')
         text_parts = text.split('&')
 
-        start_time_text = ''
-        end_time_text = ''
+        start_time = None
+        end_time = None
 
         for text_part in text_parts:
             if text_part.count('rtsp://') > 0:
@@ -25,19 +28,38 @@ class Track:
                 param_value = param_parts[1]
 
                 if param_name == 'starttime':
-                    start_time_text = self.decode_time(param_value)
+                    start_time = self.parse_time(param_value)
                 elif param_name == 'endtime':
-                    end_time_text = self.decode_time(param_value)
+                    end_time = self.parse_time(param_value)
                 elif param_name == 'name':
                     self._name = param_value
                 elif param_name == 'size':
-                    self._size = param_value
+                    self._size = int(param_value) if param_value.isdigit() else 0
+
+        if start_time is None or end_time is None:
+            raise ValueError('Playback URI "{}" has no start or end time'.format(self._text))
 
-        self._time_interval = TimeInterval.from_string(start_time_text, end_time_text, local_time_offset)
+        self._time_interval = TimeInterval(start_time, end_time, local_time_offset)
+
+        if track_id is None:
+            track_match = re.search(r'/tracks/(\d+)', self._base_url)
+            track_id = int(track_match.group(1)) if track_match else None
+        self._track_id = track_id
+
+    @staticmethod
+    def parse_time(time_text):
+        # Fixed-width YYYYMMDDTHHMMSSZ, sliced directly to avoid strptime on every track
+        if len(time_text) == 16 and time_text[8] == 'T':
+            try:
+                return datetime(int(time_text[0:4]), int(time_text[4:6]), int(time_text[6:8]),
+                                int(time_text[9:11]), int(time_text[11:13]), int(time_text[13:15]))
+            except ValueError:
+                pass
+        return datetime.strptime(time_text, '%Y%m%dT%H%M%SZ')
 
     @staticmethod
     def decode_time(time_text):
-        date_time = datetime.strptime(time_text, '%Y%m%dT%H%M%SZ')
+        date_time = Track.parse_time(time_text)
         date_time_text = date_time.strftime('%Y-%m-%d %H:%M:%S')
         return date_time_text
 
@@ -59,6 +81,12 @@ class Track:
     def size(self):
         return self._size
 
+    def track_id(self):
+        return self._track_id
+
+    def channel(self):
+        return self._track_id // 100 if self._track_id else None
+
     def base_url(self):
         return self._base_url
 
@@ -0,0 +1,112 @@
+import json
+
+
+class CameraConfig:
+    def __init__(self, camera_id, url, username, password, name=None, channels=None,
+                 max_parallel_downloads=None, site=None, rate_limit=None, archive_subdir=None,
+                 batch_search=True, mirror=False, retention_days=None, max_archive_mb=None):
+        self.id = camera_id
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.name = name or camera_id
+        self.channels = channels or [1]
+        self.max_parallel_downloads = max_parallel_downloads
+        self.site = site
+        self.rate_limit = rate_limit
+        self.archive_subdir = camera_id + '/' if archive_subdir is None else archive_subdir
+        self.batch_search = batch_search
+        self.mirror = mirror
+        self.retention_days = retention_days
+        self.max_archive_mb = max_archive_mb
+
+    @classmethod
+    def from_dict(cls, data):
+        for field in ('id', 'url', 'username', 'password'):
+            if not data.get(field):
+                raise ValueError(f"Camera entry is missing required field '{field}'")
+
+        channels = data.get('channels', [1])
+        if not isinstance(channels, list) or not all(isinstance(c, int) and c > 0 for c in channels):
+            raise ValueError(f"Camera '{data['id']}' has invalid channels, expected a list of positive integers")
+
+        for field in ('retention_days', 'max_archive_mb'):
+            value = data.get(field)
+            if value is not None and not (isinstance(value, int) and value > 0):
+                raise ValueError(f"Camera '{data['id']}' has invalid {field}, expected a positive integer")
+
+        return cls(
+            camera_id=str(data['id']),
+            url=data['url'],
+            username=data['username'],
+            password=data['password'],
+            name=data.get('name'),
+            channels=channels,
+            max_parallel_downloads=data.get('max_parallel_downloads'),
+            site=data.get('site'),
+            rate_limit=data.get('rate_limit'),
+            batch_search=data.get('batch_search', True),
+            mirror=bool(data.get('mirror', False)),
+            retention_days=data.get('retention_days'),
+            max_archive_mb=data.get('max_archive_mb')
+        )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'channels': self.channels,
+            'max_parallel_downloads': self.max_parallel_downloads,
+            'site': self.site,
+            'mirror': self.mirror,
+            'retention_days': self.retention_days,
+            'max_archive_mb': self.max_archive_mb
+        }
+
+
+class CameraRegistry:
+    DEFAULT_CAMERA_ID = 'default'
+
+    def __init__(self, cameras):
+        if not cameras:
+            raise ValueError('No cameras configured')
+
+        self.cameras = {}
+        for camera in cameras:
+            if camera.id in self.cameras:
+                raise ValueError(f"Duplicate camera id '{camera.id}'")
+            self.cameras[camera.id] = camera
+
+    @classmethod
+    def from_config(cls, args):
+        if args.get('cameras_file'):
+            return cls.from_file(args['cameras_file'])
+
+        return cls([CameraConfig(
+            camera_id=cls.DEFAULT_CAMERA_ID,
+            url=args['camera_url'],
+            username=args['username'],
+            password=args['password'],
+            name='Camera',
+            archive_subdir='',
+            mirror=args.get('mirror', False)
+        )])
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as cameras_file:
+            entries = json.load(cameras_file)
+        if isinstance(entries, dict):
+            entries = entries.get('cameras', [])
+        return cls([CameraConfig.from_dict(entry) for entry in entries])
+
+    def get(self, camera_id):
+        return self.cameras.get(camera_id or self.default_camera_id())
+
+    def default_camera_id(self):
+        if self.DEFAULT_CAMERA_ID in self.cameras:
+            return self.DEFAULT_CAMERA_ID
+        return next(iter(self.cameras))
+
+    def all(self):
+        return list(self.cameras.values())
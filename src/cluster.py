@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+
+from src.storage import SqliteStore
+
+
+class ClusterStore(SqliteStore):
+    FILE_NAME = 'cluster.db'
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS slot_leases (
+    lease_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    camera TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS slot_leases_camera ON slot_leases (camera, expires_at);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    worker_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls.open(os.path.join(state_dir, cls.FILE_NAME))
+
+    def acquire_slot(self, camera, worker_id, limit, lease_seconds):
+        now = time.time()
+        rows = self.execute(
+            'INSERT INTO slot_leases (camera, worker_id, expires_at) SELECT ?, ?, ? '
+            'WHERE (SELECT COUNT(*) FROM slot_leases WHERE camera = ? AND expires_at >= ?) < ? '
+            'RETURNING lease_id', (camera, worker_id, now + lease_seconds, camera, now, limit))
+        return rows[0]['lease_id'] if rows else None
+
+    def release_slot(self, lease_id):
+        self.execute('DELETE FROM slot_leases WHERE lease_id = ?', (lease_id,))
+
+    def count_slots(self):
+        rows = self.execute('SELECT camera, COUNT(*) AS count FROM slot_leases WHERE expires_at >= ? GROUP BY camera',
+                            (time.time(),))
+        return {row['camera']: row['count'] for row in rows}
+
+    def acquire_lease(self, name, worker_id, lease_seconds):
+        now = time.time()
+        rows = self.execute(
+            'INSERT INTO leases (name, worker_id, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at '
+            'WHERE leases.worker_id = excluded.worker_id OR leases.expires_at < ? RETURNING name',
+            (name, worker_id, now + lease_seconds, now))
+        return bool(rows)
+
+    def release_lease(self, name, worker_id):
+        self.execute('DELETE FROM leases WHERE name = ? AND worker_id = ?', (name, worker_id))
+
+    def renew(self, worker_id, lease_seconds):
+        now = time.time()
+        self.execute('UPDATE slot_leases SET expires_at = ? WHERE worker_id = ?', (now + lease_seconds, worker_id))
+        self.execute('DELETE FROM slot_leases WHERE expires_at < ?', (now,))
+
+
+class ClusterSlots:
+    def __init__(self, store, worker_id, lease_seconds):
+        self.store = store
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, camera, limit):
+        lease_id = self.store.acquire_slot(camera, self.worker_id, limit, self.lease_seconds)
+        if lease_id is None:
+            return False
+        with self._lock:
+            self._leases.setdefault(camera, []).append(lease_id)
+        return True
+
+    def release(self, camera):
+        with self._lock:
+            leases = self._leases.get(camera)
+            lease_id = leases.pop() if leases else None
+        if lease_id is not None:
+            self.store.release_slot(lease_id)
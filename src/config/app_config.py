@@ -8,6 +8,8 @@ def get_config_from_env():
     username = os.environ.get('HIKFETCH_CAMERA_USERNAME')
     password = os.environ.get('HIKFETCH_CAMERA_PASSWORD')
     download_dir = os.environ.get('HIKFETCH_DOWNLOAD_DIR')
+    state_dir = os.environ.get('HIKFETCH_STATE_DIR')
+    cameras_file = os.environ.get('HIKFETCH_CAMERAS_FILE')
     web_username = os.environ.get('HIKFETCH_WEB_USERNAME')
     web_password = os.environ.get('HIKFETCH_WEB_PASSWORD')
     oidc_discovery_url = os.environ.get('HIKFETCH_OIDC_DISCOVERY_URL')
@@ -20,12 +22,38 @@ def get_config_from_env():
     public_url = os.environ.get('HIKFETCH_PUBLIC_URL')
     auth_method = os.environ.get('HIKFETCH_AUTH_METHOD', 'none')
     log_level = os.environ.get('HIKFETCH_LOG_LEVEL', 'INFO').upper()
+    max_concurrent_tasks = os.environ.get('HIKFETCH_MAX_CONCURRENT_TASKS', '2')
+    max_parallel_downloads = os.environ.get('HIKFETCH_MAX_PARALLEL_DOWNLOADS', '2')
+    max_global_downloads = os.environ.get('HIKFETCH_MAX_GLOBAL_DOWNLOADS', '4')
+    search_shard_minutes = os.environ.get('HIKFETCH_SEARCH_SHARD_MINUTES', '60')
+    search_fan_out = os.environ.get('HIKFETCH_SEARCH_FAN_OUT', '4')
+    task_retention_days = os.environ.get('HIKFETCH_TASK_RETENTION_DAYS', '30')
+    task_retention_count = os.environ.get('HIKFETCH_TASK_RETENTION_COUNT', '1000')
+    rate_limit_global = os.environ.get('HIKFETCH_RATE_LIMIT_GLOBAL', '0')
+    rate_limit_per_camera = os.environ.get('HIKFETCH_RATE_LIMIT_PER_CAMERA', '0')
+    device_cache_ttl_minutes = os.environ.get('HIKFETCH_DEVICE_CACHE_TTL_MINUTES', '60')
+    retry_max_attempts = os.environ.get('HIKFETCH_RETRY_MAX_ATTEMPTS', '5')
+    mirror = os.environ.get('HIKFETCH_MIRROR', 'false').lower() == 'true'
+    role = os.environ.get('HIKFETCH_ROLE', 'all').lower()
+    worker_metrics_port = os.environ.get('HIKFETCH_WORKER_METRICS_PORT', '0')
+    cluster = os.environ.get('HIKFETCH_CLUSTER', 'false').lower() == 'true'
+    lease_seconds = os.environ.get('HIKFETCH_LEASE_SECONDS', '60')
+    min_free_space_mb = os.environ.get('HIKFETCH_MIN_FREE_SPACE_MB', '0')
+    download_quota_mb = os.environ.get('HIKFETCH_DOWNLOAD_QUOTA_MB', '0')
+    archive_retention_days = os.environ.get('HIKFETCH_ARCHIVE_RETENTION_DAYS', '0')
+    archive_max_mb = os.environ.get('HIKFETCH_ARCHIVE_MAX_MB', '0')
+    archive_retention_interval_minutes = os.environ.get('HIKFETCH_ARCHIVE_RETENTION_INTERVAL_MINUTES', '60')
+    mirror_interval_minutes = os.environ.get('HIKFETCH_MIRROR_INTERVAL_MINUTES', '5')
+    mirror_backfill_hours = os.environ.get('HIKFETCH_MIRROR_BACKFILL_HOURS', '24')
+    max_event_streams = os.environ.get('HIKFETCH_MAX_EVENT_STREAMS', '16')
 
     return {
         'camera_url': camera_url,
         'username': username,
         'password': password,
         'download_dir': download_dir,
+        'state_dir': state_dir,
+        'cameras_file': cameras_file,
         'web_username': web_username,
         'web_password': web_password,
         'oidc_discovery_url': oidc_discovery_url,
@@ -36,17 +64,45 @@ def get_config_from_env():
         'oidc_scopes': oidc_scopes,
         'public_url': public_url,
         'auth_method': auth_method,
-        'log_level': log_level
+        'log_level': log_level,
+        'max_concurrent_tasks': max_concurrent_tasks,
+        'max_parallel_downloads': max_parallel_downloads,
+        'max_global_downloads': max_global_downloads,
+        'search_shard_minutes': search_shard_minutes,
+        'search_fan_out': search_fan_out,
+        'task_retention_days': task_retention_days,
+        'task_retention_count': task_retention_count,
+        'rate_limit_global': rate_limit_global,
+        'rate_limit_per_camera': rate_limit_per_camera,
+        'device_cache_ttl_minutes': device_cache_ttl_minutes,
+        'retry_max_attempts': retry_max_attempts,
+        'mirror': mirror,
+        'mirror_interval_minutes': mirror_interval_minutes,
+        'mirror_backfill_hours': mirror_backfill_hours,
+        'role': role,
+        'worker_metrics_port': worker_metrics_port,
+        'cluster': cluster,
+        'lease_seconds': lease_seconds,
+        'min_free_space_mb': min_free_space_mb,
+        'download_quota_mb': download_quota_mb,
+        'archive_retention_days': archive_retention_days,
+        'archive_max_mb': archive_max_mb,
+        'archive_retention_interval_minutes': archive_retention_interval_minutes,
+        'max_event_streams': max_event_streams
     }
 
 
 def validate_config(config, error_fn):
-    if not config['camera_url']:
-        error_fn('Camera URL is required (set HIKFETCH_CAMERA_URL env var)')
-    if not config['username']:
-        error_fn('Username is required (set HIKFETCH_CAMERA_USERNAME env var)')
-    if not config['password']:
-        error_fn('Password is required (set HIKFETCH_CAMERA_PASSWORD env var)')
+    if config['cameras_file']:
+        if not os.path.isfile(config['cameras_file']):
+            error_fn(f"Cameras file {config['cameras_file']} does not exist (HIKFETCH_CAMERAS_FILE)")
+    else:
+        if not config['camera_url']:
+            error_fn('Camera URL is required (set HIKFETCH_CAMERA_URL or HIKFETCH_CAMERAS_FILE env var)')
+        if not config['username']:
+            error_fn('Username is required (set HIKFETCH_CAMERA_USERNAME env var)')
+        if not config['password']:
+            error_fn('Password is required (set HIKFETCH_CAMERA_PASSWORD env var)')
     if not config['download_dir']:
         error_fn('Download directory is required (set HIKFETCH_DOWNLOAD_DIR env var)')
 
@@ -69,8 +125,50 @@ def validate_config(config, error_fn):
     else:
         error_fn('Invalid HIKFETCH_AUTH_METHOD. Must be none, basic, or oidc')
 
+    if config['role'] not in ('all', 'web', 'worker'):
+        error_fn('Invalid HIKFETCH_ROLE. Must be all, web, or worker')
+
     if config['download_dir']:
         config['download_dir'] = config['download_dir'].rstrip('/') + '/'
+        if not config['state_dir']:
+            config['state_dir'] = config['download_dir'] + '.hikfetch'
+    if config['state_dir']:
+        config['state_dir'] = config['state_dir'].rstrip('/') + '/'
+
+    for key, env_name in [('max_concurrent_tasks', 'HIKFETCH_MAX_CONCURRENT_TASKS'),
+                          ('max_parallel_downloads', 'HIKFETCH_MAX_PARALLEL_DOWNLOADS'),
+                          ('max_global_downloads', 'HIKFETCH_MAX_GLOBAL_DOWNLOADS'),
+                          ('search_shard_minutes', 'HIKFETCH_SEARCH_SHARD_MINUTES'),
+                          ('search_fan_out', 'HIKFETCH_SEARCH_FAN_OUT'),
+                          ('task_retention_days', 'HIKFETCH_TASK_RETENTION_DAYS'),
+                          ('task_retention_count', 'HIKFETCH_TASK_RETENTION_COUNT'),
+                          ('device_cache_ttl_minutes', 'HIKFETCH_DEVICE_CACHE_TTL_MINUTES'),
+                          ('retry_max_attempts', 'HIKFETCH_RETRY_MAX_ATTEMPTS'),
+                          ('mirror_interval_minutes', 'HIKFETCH_MIRROR_INTERVAL_MINUTES'),
+                          ('mirror_backfill_hours', 'HIKFETCH_MIRROR_BACKFILL_HOURS'),
+                          ('lease_seconds', 'HIKFETCH_LEASE_SECONDS'),
+                          ('archive_retention_interval_minutes', 'HIKFETCH_ARCHIVE_RETENTION_INTERVAL_MINUTES'),
+                          ('max_event_streams', 'HIKFETCH_MAX_EVENT_STREAMS')]:
+        config[key] = parse_positive_int(config[key], env_name, error_fn)
+
+    for key, env_name in [('rate_limit_global', 'HIKFETCH_RATE_LIMIT_GLOBAL'),
+                          ('rate_limit_per_camera', 'HIKFETCH_RATE_LIMIT_PER_CAMERA'),
+                          ('worker_metrics_port', 'HIKFETCH_WORKER_METRICS_PORT'),
+                          ('min_free_space_mb', 'HIKFETCH_MIN_FREE_SPACE_MB'),
+                          ('download_quota_mb', 'HIKFETCH_DOWNLOAD_QUOTA_MB'),
+                          ('archive_retention_days', 'HIKFETCH_ARCHIVE_RETENTION_DAYS'),
+                          ('archive_max_mb', 'HIKFETCH_ARCHIVE_MAX_MB')]:
+        config[key] = parse_positive_int(config[key], env_name, error_fn, allow_zero=True)
+
+
+def parse_positive_int(value, env_name, error_fn, allow_zero=False):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = -1
+    if number < (0 if allow_zero else 1):
+        error_fn(f'{env_name} must be a {"non-negative" if allow_zero else "positive"} integer')
+    return number
 
 
 def parse_arguments():
@@ -102,8 +200,39 @@ def build_credentials(args):
 def build_download_config(args):
     return {
         'path_to_media_archive': args['download_dir'],
+        'state_dir': args['state_dir'],
         'default_timeout_seconds': 15,
-        'retry_delay_seconds': 5
+        'retry_base_delay_seconds': 2,
+        'retry_max_delay_seconds': 120,
+        'retry_max_attempts': args['retry_max_attempts'],
+        'circuit_failure_threshold': 5,
+        'circuit_cooldown_seconds': 30,
+        'circuit_max_cooldown_seconds': 300,
+        'max_concurrent_tasks': args['max_concurrent_tasks'],
+        'max_parallel_downloads': args['max_parallel_downloads'],
+        'max_global_downloads': args['max_global_downloads'],
+        'connection_pool_size': args['max_parallel_downloads'] + args['search_fan_out'],
+        'download_queue_size': 50,
+        'search_shard_minutes': args['search_shard_minutes'],
+        'search_fan_out': args['search_fan_out'],
+        'search_cache_recent_minutes': 90,
+        'task_retention_days': args['task_retention_days'],
+        'task_retention_count': args['task_retention_count'],
+        'max_cached_finished_tasks': 100,
+        'rate_limit_global': args['rate_limit_global'],
+        'rate_limit_per_camera': args['rate_limit_per_camera'],
+        'device_cache_ttl_minutes': args['device_cache_ttl_minutes'],
+        'mirror_interval_minutes': args['mirror_interval_minutes'],
+        'mirror_backfill_hours': args['mirror_backfill_hours'],
+        'mirror_settle_seconds': 120,
+        'cluster': args['cluster'],
+        'lease_seconds': args['lease_seconds'],
+        'min_free_space_bytes': args['min_free_space_mb'] * 1024 * 1024,
+        'download_quota_bytes': args['download_quota_mb'] * 1024 * 1024,
+        'archive_retention_days': args['archive_retention_days'],
+        'archive_max_mb': args['archive_max_mb'],
+        'archive_retention_interval_minutes': args['archive_retention_interval_minutes'],
+        'max_event_streams': args['max_event_streams']
     }
 
 
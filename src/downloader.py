@@ -1,9 +1,42 @@
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
-from src.camera import CameraSdk, AuthType, TimeInterval
+from src import metrics
+from src.admission import DiskBudget
+from src.archive_index import ArchiveIndex
+from src.camera import CameraSdk, CapabilityCache, TimeInterval, Track
+from src.limits import ClipLocks, DownloadSlots
 from src.logger import Logger
+from src.retry import CircuitBreaker, RetryPolicy
+from src.search_cache import SearchCache
+
+
+class _StopEvent(threading.Event):
+    # Set when a download is abandoned. It also reports the task's own
+    # cancellation, so the clip threads wait on it instead of the cancel flag.
+    _CANCEL_POLL_SECONDS = 0.5
+
+    def __init__(self, cancel_event=None):
+        super().__init__()
+        self.cancel_event = cancel_event
+
+    def is_set(self):
+        return super().is_set() or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            step = self._CANCEL_POLL_SECONDS
+            if deadline is not None:
+                step = min(step, deadline - time.monotonic())
+                if step <= 0:
+                    return False
+            super().wait(step)
+        return True
 
 
 def create_directory_for(file_path):
@@ -13,28 +46,59 @@ def create_directory_for(file_path):
 
 
 class MediaDownloader:
+    MAX_REPORTED_FAILED_CLIPS = 500
+
     def __init__(self, config):
         self.config = config
         self.logger = None
-
-    def init(self, camera_url, camera_channel=1, task_id=None):
-        camera_url = camera_url.rstrip('/')
-
-        path_to_media_archive = self.config['path_to_media_archive']
+        self.camera_id = None
+        self.camera_channels = [1]
+        self.channel_subdirs = False
+        self.batch_search = False
+        self.capabilities = None
+        self.task = None
+        self.max_parallel_downloads = config.get('max_parallel_downloads', 1)
+        self.task_id = None
+        self.archive_index = None
+        self.search_cache = None
+        self.skipped = 0
+        self.failed = 0
+        self.failed_clips = []
+        self.incremental = False
+        self.retry_policy = RetryPolicy.from_config(config)
+        self._progress_lock = threading.Lock()
+
+    def init(self, camera, camera_channels=(1,), task_id=None):
+        camera_url = camera.url.rstrip('/')
+
+        path_to_media_archive = self.config['path_to_media_archive'] + camera.archive_subdir
         create_directory_for(path_to_media_archive)
 
-        Logger.init_logger(task_id=task_id)
+        self.task_id = task_id
+        self.camera_id = camera.id
+        self.camera_channels = list(camera_channels)
+        self.channel_subdirs = len(self.camera_channels) > 1 or len(camera.channels) > 1
+        if camera.max_parallel_downloads:
+            self.max_parallel_downloads = camera.max_parallel_downloads
+        self.archive_index = ArchiveIndex.for_state_dir(self.config['state_dir'])
+        self.search_cache = SearchCache.for_state_dir(self.config['state_dir'])
+        Logger.set_task_id(task_id)
         self.logger = Logger.get_logger()
 
-        CameraSdk.init(self.config['default_timeout_seconds'], camera_channel)
+        CameraSdk.init(self.config['default_timeout_seconds'], self.camera_channels[0],
+                       self.config.get('connection_pool_size', 4))
 
         return camera_url, path_to_media_archive
 
-    def download(self, camera_url, user_name, user_password, start_datetime_str, end_datetime_str,
-                 camera_channel=1, task=None):
+    def download(self, camera, start_datetime_str, end_datetime_str, camera_channels=1, task=None,
+                 incremental=False):
+        if isinstance(camera_channels, int):
+            camera_channels = [camera_channels]
 
         task_id = task.display_id if task else None
-        cam_url, path_to_media_archive = self.init(camera_url, camera_channel, task_id=task_id)
+        self.task = task
+        self.incremental = incremental
+        cam_url, path_to_media_archive = self.init(camera, camera_channels, task_id=task_id)
 
         try:
             if task and task.is_cancelled():
@@ -42,106 +106,508 @@ class MediaDownloader:
 
             self.logger.info('Processing cam {}: downloading video'.format(cam_url))
 
-            auth_type = CameraSdk.get_auth_type(cam_url, user_name, user_password)
-            if auth_type == AuthType.UNAUTHORISED:
-                raise RuntimeError('Unauthorised! Check login and password')
-
-            auth_handler = CameraSdk.get_auth(auth_type, user_name, user_password)
+            auth_handler = self._connect(camera)
 
             time_interval = TimeInterval.from_string(start_datetime_str, end_datetime_str, timedelta())
 
             if task and task.is_cancelled():
                 return {'status': 'cancelled'}
 
-            tracks = self._get_all_tracks(auth_handler, cam_url, time_interval)
-            self.logger.info('Found {} files'.format(len(tracks)))
-
-            if len(tracks) == 0:
-                return {'status': 'error', 'message': 'No recordings found for the specified time range'}
-
-            if task:
-                task.total = len(tracks)
+            tracks = self._iter_tracks(auth_handler, cam_url, time_interval)
+            files_count = self._download_tracks(tracks, auth_handler, cam_url, path_to_media_archive, task)
+            self.logger.info('Found {} files'.format(files_count))
 
             if task and task.is_cancelled():
                 return {'status': 'cancelled'}
 
-            self._download_tracks(tracks, auth_handler, cam_url, path_to_media_archive, task)
+            if files_count == 0 and not self.incremental:
+                return {'status': 'error', 'message': 'No recordings found for the specified time range'}
 
-            return {'status': 'success', 'files': len(tracks)}
+            if self.failed:
+                return {'status': 'error', 'files': files_count, 'skipped': self.skipped, 'failed': self.failed,
+                        'failed_clips': self.failed_clips[:self.MAX_REPORTED_FAILED_CLIPS],
+                        'message': '{} of {} clips could not be downloaded'.format(self.failed, files_count)}
+
+            return {'status': 'success', 'files': files_count, 'skipped': self.skipped}
 
         except Exception as e:
             self.logger.exception(e)
             return {'status': 'error', 'message': str(e)}
 
-    def _get_all_tracks(self, auth_handler, cam_url, utc_time_interval):
+    def plan(self, camera, start_datetime_str, end_datetime_str, camera_channels=1, task=None, incremental=False):
+        if isinstance(camera_channels, int):
+            camera_channels = [camera_channels]
+
+        self.task = task
+        self.incremental = incremental
+        cam_url, path_to_media_archive = self.init(camera, camera_channels,
+                                                   task_id=task.display_id if task else None)
+        auth_handler = self._connect(camera)
+        time_interval = TimeInterval.from_string(start_datetime_str, end_datetime_str, timedelta())
+
+        # Searching here also fills the search cache, so the download that
+        # follows an admitted plan does not repeat it for closed windows.
+        clips = {'all': 0, 'missing': 0}
+        unsized = {'all': 0, 'missing': 0}
+        sizes = {'all': 0, 'missing': 0}
+        for track in self._iter_tracks(auth_handler, cam_url, time_interval):
+            if task and task.is_cancelled():
+                break
+            # Planning leaves the index alone; adopting files is up to the download
+            missing = not self.archive_index.has_clip(cam_url, track.channel(), track,
+                                                      self._file_name_for(track, path_to_media_archive))
+            for key in ('all', 'missing') if missing else ('all',):
+                clips[key] += 1
+                sizes[key] += track.size()
+                unsized[key] += not track.size()
+
+        # Devices that leave out the size are estimated from the clips that
+        # have one, or from what this camera's clips took on disk before.
+        sized = clips['all'] - unsized['all']
+        average_size = sizes['all'] // sized if sized else self.archive_index.average_clip_size(cam_url) or 0
+        return {
+            'clips': clips['all'],
+            'clips_to_download': clips['missing'],
+            'total_bytes': sizes['all'] + unsized['all'] * average_size,
+            'bytes_to_download': sizes['missing'] + unsized['missing'] * average_size,
+            'unsized_clips': unsized['all'],
+            'average_clip_bytes': average_size
+        }
+
+    def _connect(self, camera):
+        probe_started_at = time.monotonic()
+        cached = CapabilityCache.peek(camera.id) is not None
+        self.capabilities = CapabilityCache.get(camera)
+        self._record_stage('auth_probe', probe_started_at, cached=cached)
+        unknown_channels = [c for c in self.camera_channels if c not in self.capabilities.channels]
+        if self.capabilities.channels and unknown_channels:
+            self.logger.warning('Channels {} are not among the channels reported by the device: {}'.format(
+                unknown_channels, self.capabilities.channels))
+        self.batch_search = camera.batch_search and self.capabilities.batch_search
+
+        return CameraSdk.get_auth(self.capabilities.auth_type, camera.username, camera.password)
+
+    def _iter_tracks(self, auth_handler, cam_url, utc_time_interval):
         start_time_text, end_time_text = utc_time_interval.to_local_time().to_text()
         self.logger.info('Start time: {}'.format(start_time_text))
         self.logger.info('End time: {}'.format(end_time_text))
         self.logger.info('Getting track list...')
 
-        tracks = []
-        while True:
-            answer = self._get_tracks_info(auth_handler, cam_url, utc_time_interval)
-            local_time_offset = utc_time_interval.local_time_offset
-            if answer:
-                new_tracks = CameraSdk.create_tracks_from_info(answer, local_time_offset)
-                tracks += new_tracks
-                if len(new_tracks) < 50:
+        closed_before = self._get_closed_buckets_boundary()
+        buckets = SearchCache.split_into_buckets(utc_time_interval, self.config['search_shard_minutes'] * 60)
+
+        seen_uris = set()
+        search_units = self._iter_search_units(buckets)
+        for bucket_tracks in self._search_buckets_in_parallel(auth_handler, cam_url, search_units, closed_before):
+            bucket_tracks.sort(key=lambda t: t.get_time_interval().start_time)
+            for track in bucket_tracks:
+                uri = track.url_to_download()
+                # Incremental runs leave clips that end past the window for the
+                # next run, so a recording the NVR has not closed yet is never fetched.
+                if self.incremental and track.get_time_interval().end_time > utc_time_interval.end_time:
+                    continue
+                if uri not in seen_uris and self._overlaps(track, utc_time_interval):
+                    seen_uris.add(uri)
+                    yield track
+
+    def _init_worker_thread(self):
+        Logger.set_task_id(self.task_id)
+        if self.task and self.task.timeline and self.task.timeline.profiler:
+            self.task.timeline.profiler.add_current_thread()
+
+    def _record_stage(self, stage, started_at, duration=None, event=True, **details):
+        if self.task:
+            self.task.record_stage(stage, started_at, duration, event, **details)
+
+    def _iter_search_units(self, buckets):
+        # Evaluated lazily so that units created after a failed batched search
+        # already fall back to one concurrent search per channel.
+        for bucket in buckets:
+            if self.batch_search and len(self.camera_channels) > 1:
+                yield bucket, self.camera_channels
+            else:
+                for camera_channel in self.camera_channels:
+                    yield bucket, [camera_channel]
+
+    def _search_buckets_in_parallel(self, auth_handler, cam_url, search_units, closed_before):
+        fan_out = self.config['search_fan_out']
+        executor = ThreadPoolExecutor(max_workers=fan_out, thread_name_prefix='search',
+                                      initializer=self._init_worker_thread)
+        pending = deque()
+        remaining = iter(search_units)
+        try:
+            while True:
+                while len(pending) < fan_out:
+                    search_unit = next(remaining, None)
+                    if search_unit is None:
+                        break
+                    bucket, camera_channels = search_unit
+                    pending.append(executor.submit(self._get_bucket_tracks, auth_handler, cam_url,
+                                                   bucket, camera_channels, closed_before))
+                if not pending:
                     break
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _get_closed_buckets_boundary(self):
+        camera_now = self.capabilities.camera_now()
+        return camera_now - timedelta(minutes=self.config['search_cache_recent_minutes'])
 
-                last_track = tracks[-1]
-                utc_time_interval.start_time = last_track.get_time_interval().end_time
+    def _get_bucket_tracks(self, auth_handler, cam_url, bucket, camera_channels, closed_before):
+        is_closed = bucket.end_time <= closed_before
+
+        tracks = []
+        uncached_channels = []
+        for camera_channel in camera_channels:
+            track_id = CameraSdk.video_track_id(camera_channel)
+            playback_uris = self.search_cache.get(cam_url, track_id, bucket) if is_closed else None
+            if is_closed:
+                metrics.SEARCH_CACHE_LOOKUPS.labels(result='miss' if playback_uris is None else 'hit').inc()
+            if playback_uris is None:
+                uncached_channels.append(camera_channel)
             else:
-                tracks = []
+                tracks += [Track(uri, bucket.local_time_offset, track_id) for uri in playback_uris]
+
+        if not uncached_channels:
+            return tracks
+
+        found_tracks = self._search_channels(auth_handler, cam_url, bucket, uncached_channels)
+
+        if is_closed and all(t.get_time_interval().end_time <= closed_before for t in found_tracks):
+            for camera_channel in uncached_channels:
+                track_id = CameraSdk.video_track_id(camera_channel)
+                self.search_cache.put(cam_url, track_id, bucket,
+                                      [t.url_to_download() for t in found_tracks if t.track_id() == track_id])
+
+        return tracks + found_tracks
+
+    def _search_channels(self, auth_handler, cam_url, utc_time_interval, camera_channels):
+        if len(camera_channels) > 1 and self.batch_search:
+            tracks = self._search_tracks_batched(auth_handler, cam_url, utc_time_interval, camera_channels)
+            if tracks is not None:
+                return tracks
+
+        tracks = []
+        for camera_channel in camera_channels:
+            tracks += self._search_tracks(auth_handler, cam_url, utc_time_interval, camera_channel)
+        return tracks
+
+    def _search_tracks_batched(self, auth_handler, cam_url, utc_time_interval, camera_channels):
+        track_ids = {CameraSdk.video_track_id(camera_channel) for camera_channel in camera_channels}
+
+        tracks = []
+        search_position = 0
+        while True:
+            answer = self._get_tracks_info(auth_handler, cam_url, utc_time_interval, camera_channels,
+                                           search_position, log_errors=False)
+            if not answer:
+                self._disable_batch_search('Error {} {}'.format(answer.status_code, answer.reason))
+                return None
+
+            page = {}
+            new_tracks = []
+            for track in CameraSdk.iter_search_result(answer, utc_time_interval.local_time_offset, page=page):
+                if track.track_id() not in track_ids:
+                    self._disable_batch_search('results cannot be attributed to channels')
+                    return None
+                new_tracks.append(track)
+
+            tracks += new_tracks
+            if not new_tracks or not (page['has_more'] or len(new_tracks) >= 50):
+                break
+            search_position += len(new_tracks)
+
+        return tracks
+
+    def _disable_batch_search(self, reason):
+        if self.batch_search:
+            self.logger.warning('Multi-channel search is not supported by the device ({}), '
+                                'searching channels separately'.format(reason))
+        self.batch_search = False
+        self.capabilities.batch_search = False
+
+    def _search_tracks(self, auth_handler, cam_url, utc_time_interval, camera_channel):
+        search_interval = TimeInterval(utc_time_interval.start_time, utc_time_interval.end_time,
+                                       utc_time_interval.local_time_offset)
+        track_id = CameraSdk.video_track_id(camera_channel)
+
+        tracks = []
+        while True:
+            answer = self._get_tracks_info(auth_handler, cam_url, search_interval, [camera_channel])
+            if not answer:
+                raise RuntimeError('Error occurred during getting track list')
+
+            page = {}
+            new_tracks = list(CameraSdk.iter_search_result(answer, search_interval.local_time_offset, track_id,
+                                                           page=page))
+            tracks += new_tracks
+            # Devices may cap a page below the 50 results asked for, so a short
+            # page only ends the search when the device has nothing more.
+            if not new_tracks or not (page['has_more'] or len(new_tracks) >= 50):
                 break
 
+            last_track = tracks[-1]
+            search_interval.start_time = last_track.get_time_interval().end_time
+
         return tracks
 
-    def _get_tracks_info(self, auth_handler, cam_url, utc_time_interval):
-        result = CameraSdk.get_video_tracks_info(auth_handler, cam_url, utc_time_interval, 50)
+    @staticmethod
+    def _overlaps(track, time_interval):
+        track_interval = track.get_time_interval()
+        return track_interval.start_time < time_interval.end_time and \
+            track_interval.end_time > time_interval.start_time
+
+    def _get_tracks_info(self, auth_handler, cam_url, utc_time_interval, camera_channels, search_position=0,
+                         log_errors=True):
+        started_at = time.monotonic()
+        result = CameraSdk.get_multi_channel_video_tracks_info(auth_handler, cam_url, utc_time_interval, 50,
+                                                               camera_channels, search_position)
+        duration = time.monotonic() - started_at
+        metrics.SEARCH_REQUEST_SECONDS.labels(
+            camera=self.camera_id, mode='batched' if len(camera_channels) > 1 else 'single').observe(duration)
+        start_time_text, end_time_text = utc_time_interval.to_text()
+        self._record_stage('search_page', started_at, duration, channels=list(camera_channels),
+                           range_start=start_time_text, range_end=end_time_text, position=search_position,
+                           status=result.status_code)
+
+        if CameraSdk.is_unauthorised(result):
+            result.close()
+            CapabilityCache.invalidate(self.camera_id)
+            raise RuntimeError('Unauthorised! Check login and password')
 
         if not result:
-            error_message = CameraSdk.get_error_message_from(result)
-            self.logger.error('Error occurred during getting track list')
-            self.logger.error(error_message)
+            if log_errors:
+                error_message = CameraSdk.get_error_message_from(result)
+                self.logger.error('Error occurred during getting track list')
+                self.logger.error(error_message)
+            # Search answers are streamed; only successful ones are read to the end
+            result.close()
 
         return result
 
     def _download_tracks(self, tracks, auth_handler, cam_url, path_to_media_archive, task=None):
-        for idx, track in enumerate(tracks):
-            if task and task.is_cancelled():
+        max_workers = self.max_parallel_downloads
+        queued_tracks = threading.BoundedSemaphore(max_workers + self.config['download_queue_size'])
+        cancel_event = task.cancel_flag if task else None
+        stop_event = _StopEvent(cancel_event)
+        failures = []
+        clips_queued = metrics.CLIPS_QUEUED.labels(camera=self.camera_id)
+
+        def on_track_done(future):
+            queued_tracks.release()
+            clips_queued.dec()
+            if not future.cancelled() and future.exception() is not None:
+                failures.append(future.exception())
+                stop_event.set()
+
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='clip',
+                                      initializer=self._init_worker_thread)
+        files_count = 0
+        try:
+            for track in tracks:
+                if task:
+                    task.checkpoint()
+                if not self._wait_for_queue_slot(queued_tracks, cancel_event, failures):
+                    break
+
+                future = executor.submit(self._download_track, track, auth_handler, cam_url,
+                                         path_to_media_archive, task, stop_event)
+                clips_queued.inc()
+                future.add_done_callback(on_track_done)
+                files_count += 1
+                if task:
+                    task.update(total=files_count)
+        except BaseException:
+            # The task fails once this returns, so clips already in flight are
+            # stopped and waited for rather than left holding slots and writing files.
+            stop_event.set()
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+        executor.shutdown(wait=True, cancel_futures=bool(failures))
+        if failures:
+            raise failures[0]
+
+        return files_count
+
+    @staticmethod
+    def _wait_for_queue_slot(queued_tracks, cancel_event, failures):
+        while not queued_tracks.acquire(timeout=0.5):
+            if failures or (cancel_event is not None and cancel_event.is_set()):
+                return False
+        return not failures and not (cancel_event is not None and cancel_event.is_set())
+
+    def _download_track(self, track, auth_handler, cam_url, path_to_media_archive, task=None, stop_event=None):
+        if stop_event is None:
+            stop_event = _StopEvent(task.cancel_flag if task else None)
+
+        index_started_at = time.monotonic()
+        already_downloaded = self._is_already_downloaded(track, cam_url, path_to_media_archive)
+        self._observe_stage('index', index_started_at, event=False)
+        if already_downloaded:
+            self._mark_track_done(task)
+            return
+
+        file_name = self._file_name_for(track, path_to_media_archive)
+        create_directory_for(file_name)
+        attempts = {}
+        while True:
+            # A preempted task parks here without holding the clip lock, so
+            # the task that preempted it can fetch the clips both cover.
+            if task:
+                task.checkpoint(stop_event)
+            if stop_event.is_set():
                 return
 
-            while True:
-                if self._download_file_with_retry(
-                        auth_handler, cam_url, track, path_to_media_archive, task):
+            # Overlapping tasks may reach the same clip; only one writes its
+            # partial file, the others find it in the index once it is done.
+            if not ClipLocks.acquire(file_name, stop_event):
+                return
+            try:
+                if self._is_already_downloaded(track, cam_url, path_to_media_archive):
                     break
-                else:
-                    if task and task.is_cancelled():
-                        return
-                    time.sleep(self.config['retry_delay_seconds'])
+                status = self._fetch_track(track, auth_handler, cam_url, path_to_media_archive, task, stop_event)
+            finally:
+                ClipLocks.release(file_name)
 
-            if task:
-                task.progress = idx + 1
+            if status is None or stop_event.is_set():
+                return
+            if status.result_type == CameraSdk.FileDownloadingResult.OK:
+                break
 
-    def _download_file_with_retry(self, auth_handler, cam_url, track, path_to_media_archive, task=None):
+            result_name = status.name()
+            attempts[result_name] = attempts.get(result_name, 0) + 1
+            if not self.retry_policy.should_retry(result_name, attempts[result_name]):
+                self.logger.error('Giving up on {} after {} attempts ending with {}'.format(
+                    track.name() or track.url_to_download(), sum(attempts.values()), result_name))
+                metrics.CLIPS_FAILED.labels(camera=self.camera_id, result=result_name).inc()
+                start_time_text, end_time_text = track.get_time_interval().to_text()
+                with self._progress_lock:
+                    self.failed += 1
+                    self.failed_clips.append({'channel': track.channel(), 'start': start_time_text,
+                                              'end': end_time_text, 'result': result_name})
+                break
+
+            delay = self.retry_policy.delay(result_name, attempts[result_name])
+            metrics.CLIP_RETRIES.labels(camera=self.camera_id).inc()
+            sleep_started_at = time.monotonic()
+            slept = RetryPolicy.sleep(delay, stop_event)
+            self._record_stage('retry_sleep', sleep_started_at, clip=track.name() or track.url_to_download(),
+                               result=result_name, attempt=attempts[result_name])
+            if not slept:
+                return
+
+        self._mark_track_done(task)
+
+    def _fetch_track(self, track, auth_handler, cam_url, path_to_media_archive, task, stop_event):
+        circuit_wait_started_at = time.monotonic()
+        if not CircuitBreaker.acquire(self.camera_id, stop_event):
+            return None
+        self._observe_stage('circuit_wait', circuit_wait_started_at, event=False)
+
+        status = None
+        try:
+            slot_wait_started_at = time.monotonic()
+            if not DownloadSlots.acquire(self.camera_id, stop_event):
+                return None
+            self._observe_stage('slot_wait', slot_wait_started_at)
+
+            active_downloads = metrics.ACTIVE_CLIP_DOWNLOADS.labels(camera=self.camera_id)
+            active_downloads.inc()
+            try:
+                status = self._download_file_with_retry(auth_handler, cam_url, track, path_to_media_archive, task)
+            finally:
+                active_downloads.dec()
+                DownloadSlots.release(self.camera_id)
+        finally:
+            self._record_circuit_result(status, task)
+        return status
+
+    def _record_circuit_result(self, status, task):
+        # Clip-specific HTTP errors still prove the device is responsive; only
+        # timeouts, dropped connections and device errors count against it.
+        if status is None or (task and task.is_cancelled()):
+            CircuitBreaker.record_neutral(self.camera_id)
+        elif status.result_type in (CameraSdk.FileDownloadingResult.TIMEOUT,
+                                    CameraSdk.FileDownloadingResult.CONNECTION_ERROR,
+                                    CameraSdk.FileDownloadingResult.DEVICE_ERROR):
+            CircuitBreaker.record_failure(self.camera_id)
+        else:
+            CircuitBreaker.record_success(self.camera_id)
+
+    def _observe_stage(self, stage, started_at, event=True):
+        duration = time.monotonic() - started_at
+        metrics.CLIP_STAGE_SECONDS.labels(camera=self.camera_id, stage=stage).observe(duration)
+        self._record_stage(stage, started_at, duration, event)
+
+    def _mark_track_done(self, task):
+        if task:
+            with self._progress_lock:
+                task.update(progress=task.progress + 1)
+
+    def _is_already_downloaded(self, track, cam_url, path_to_media_archive):
+        existing_file = self.archive_index.find_downloaded(cam_url, track.channel(), track)
+        if existing_file is None:
+            file_name = self._file_name_for(track, path_to_media_archive)
+            if self.archive_index.adopt_existing(cam_url, track.channel(), track, file_name):
+                existing_file = file_name
+
+        if existing_file is None:
+            return False
+
+        self.logger.info('Skipping {}: already downloaded'.format(existing_file))
+        metrics.CLIPS_SKIPPED.labels(camera=self.camera_id).inc()
+        with self._progress_lock:
+            self.skipped += 1
+        return True
+
+    def _record_clip_attempt(self, file_name, started_at, duration, status):
+        # Transfer stages only feed the per-stage totals; their durations are
+        # kept on the clip event so each clip costs a single timeline entry.
+        for stage, seconds in status.stages.items():
+            self._record_stage(stage, started_at, seconds, event=False)
+        stages = {stage: round(seconds, 4) for stage, seconds in status.stages.items()}
+        relative_name = os.path.relpath(file_name, self.config['path_to_media_archive'])
+        self._record_stage('clip', started_at, duration, file=relative_name, result=status.name(),
+                           bytes=status.received_bytes, stages=stages)
+
+    def _file_name_for(self, track, path_to_media_archive):
         start_time_text = track.get_time_interval().to_filename_text()
-        file_name = path_to_media_archive + start_time_text + '.mp4'
+        if self.channel_subdirs:
+            path_to_media_archive += 'ch{}/'.format(track.channel())
+        return path_to_media_archive + start_time_text + '.mp4'
+
+    def _download_file_with_retry(self, auth_handler, cam_url, track, path_to_media_archive, task=None):
+        file_name = self._file_name_for(track, path_to_media_archive)
         url_to_download = track.url_to_download()
 
         create_directory_for(file_name)
 
         if task:
-            task.current_file = file_name
+            task.update(current_file=file_name)
 
         self.logger.info('Downloading {}'.format(file_name))
-        status = CameraSdk.download_file(auth_handler, cam_url, url_to_download, file_name, task)
+        started_at = time.monotonic()
+        status = CameraSdk.download_file(auth_handler, cam_url, url_to_download, file_name, task,
+                                         rate_limit_key=self.camera_id)
+        duration = time.monotonic() - started_at
+        metrics.CLIP_DOWNLOAD_SECONDS.labels(camera=self.camera_id, result=status.name()).observe(duration)
+        metrics.CLIP_RESULTS.labels(camera=self.camera_id, result=status.name()).inc()
+        self._record_clip_attempt(file_name, started_at, duration, status)
+
+        if status.result_type == CameraSdk.FileDownloadingResult.UNAUTHORISED:
+            CapabilityCache.invalidate(self.camera_id)
+            raise RuntimeError(status.text)
 
         if status.result_type != CameraSdk.FileDownloadingResult.OK:
             if status.result_type == CameraSdk.FileDownloadingResult.TIMEOUT:
                 self.logger.error("Timeout during file downloading")
             else:
                 self.logger.error(status.text)
-            return False
+            return status
 
-        return True
+        self.archive_index.record(cam_url, track.channel(), track, file_name)
+        if task:
+            DiskBudget.consume(task.task_id, status.received_bytes)
+        return status
@@ -0,0 +1,297 @@
+import fcntl
+import os
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate=0, explicit=False):
+        self.explicit = explicit
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = max(0, int(rate or 0))
+            self.burst = self.rate
+            self.tokens = min(self.tokens, self.burst)
+            self.updated_at = time.monotonic()
+
+    def reserve(self, amount):
+        # Reserving ahead lets the balance go negative, so concurrent streams
+        # queue behind each other in arrival order instead of racing.
+        with self._lock:
+            if not self.rate:
+                return 0
+
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class BandwidthLimiter:
+    MIN_STREAM_RATE = 256 * 1024
+
+    _global_bucket = TokenBucket()
+    _per_camera_default = 0
+    _camera_buckets = {}
+    _site_buckets = {}
+    _camera_sites = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def init(cls, global_rate=0, per_camera_rate=0):
+        cls.set_limits({'global': global_rate, 'per_camera_default': per_camera_rate})
+
+    @classmethod
+    def assign_site(cls, camera, site):
+        with cls._lock:
+            if site:
+                cls._camera_sites[camera] = site
+                cls._site_buckets.setdefault(site, TokenBucket())
+            else:
+                cls._camera_sites.pop(camera, None)
+
+    @classmethod
+    def get_limits(cls):
+        with cls._lock:
+            return {
+                'global': cls._global_bucket.rate,
+                'per_camera_default': cls._per_camera_default,
+                'cameras': {camera: bucket.rate for camera, bucket in cls._camera_buckets.items()},
+                'sites': {site: bucket.rate for site, bucket in cls._site_buckets.items()},
+                'camera_sites': dict(cls._camera_sites)
+            }
+
+    @classmethod
+    def set_limits(cls, limits):
+        global_rate = cls.__parse_rate(limits['global']) if 'global' in limits else None
+        default_rate = cls.__parse_rate(limits['per_camera_default']) if 'per_camera_default' in limits else None
+        camera_rates = {camera: None if rate is None else cls.__parse_rate(rate)
+                        for camera, rate in limits.get('cameras', {}).items()}
+        site_rates = {site: cls.__parse_rate(rate) for site, rate in limits.get('sites', {}).items()}
+
+        with cls._lock:
+            if global_rate is not None:
+                cls._global_bucket.set_rate(global_rate)
+            if default_rate is not None:
+                cls._per_camera_default = default_rate
+                for bucket in cls._camera_buckets.values():
+                    if not bucket.explicit:
+                        bucket.set_rate(default_rate)
+            for camera, rate in camera_rates.items():
+                bucket = cls.__camera_bucket(camera)
+                bucket.explicit = rate is not None
+                bucket.set_rate(cls._per_camera_default if rate is None else rate)
+            for site, rate in site_rates.items():
+                cls._site_buckets.setdefault(site, TokenBucket()).set_rate(rate)
+
+    @classmethod
+    def throttle(cls, camera, amount, cancel_event=None):
+        delay = max(bucket.reserve(amount) for bucket in cls.__buckets_for(camera))
+        if delay <= 0:
+            return True
+        if cancel_event is not None:
+            return not cancel_event.wait(delay)
+        time.sleep(delay)
+        return True
+
+    @classmethod
+    def max_streams(cls, camera=None):
+        buckets = cls.__buckets_for(camera) if camera is not None else [cls._global_bucket]
+        rates = [bucket.rate for bucket in buckets if bucket.rate]
+        if not rates:
+            return None
+        return max(1, min(rates) // cls.MIN_STREAM_RATE)
+
+    @classmethod
+    def __buckets_for(cls, camera):
+        with cls._lock:
+            buckets = [cls._global_bucket, cls.__camera_bucket(camera)]
+            site = cls._camera_sites.get(camera)
+            if site:
+                buckets.append(cls._site_buckets[site])
+            return buckets
+
+    @classmethod
+    def __camera_bucket(cls, camera):
+        bucket = cls._camera_buckets.get(camera)
+        if bucket is None:
+            bucket = TokenBucket(cls._per_camera_default)
+            cls._camera_buckets[camera] = bucket
+        return bucket
+
+    @staticmethod
+    def __parse_rate(rate):
+        try:
+            rate = int(rate or 0)
+        except (TypeError, ValueError):
+            raise ValueError('Rate limit must be an integer number of bytes per second')
+        if rate < 0:
+            raise ValueError('Rate limit must not be negative')
+        return rate
+
+
+class DownloadSlots:
+    per_camera_limit = 2
+    global_limit = 4
+
+    _camera_limits = {}
+    _active = {}
+    _active_total = 0
+    _condition = threading.Condition()
+    _cluster = None
+
+    _WAIT_STEP_SECONDS = 0.5
+
+    @classmethod
+    def init(cls, per_camera_limit, global_limit):
+        with cls._condition:
+            cls.per_camera_limit = max(1, per_camera_limit)
+            cls.global_limit = max(1, global_limit)
+            cls._condition.notify_all()
+
+    @classmethod
+    def set_camera_limit(cls, camera, limit):
+        with cls._condition:
+            if limit:
+                cls._camera_limits[camera] = max(1, limit)
+            else:
+                cls._camera_limits.pop(camera, None)
+            cls._condition.notify_all()
+
+    @classmethod
+    def set_cluster(cls, cluster):
+        cls._cluster = cluster
+
+    @classmethod
+    def acquire(cls, camera, cancel_event=None):
+        with cls._condition:
+            while not cls.__has_free_slot(camera):
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                cls._condition.wait(cls._WAIT_STEP_SECONDS)
+
+            cls._active[camera] = cls._active.get(camera, 0) + 1
+            cls._active_total += 1
+            camera_limit = cls._camera_limits.get(camera, cls.per_camera_limit)
+
+        # The per-camera limit protects the device, so with several nodes it is
+        # enforced across all of them; the global limit stays per node.
+        if cls._cluster is not None:
+            while not cls._cluster.acquire(camera, camera_limit):
+                if cancel_event is not None and cancel_event.wait(cls._WAIT_STEP_SECONDS):
+                    cls.__release_local(camera)
+                    return False
+                if cancel_event is None:
+                    time.sleep(cls._WAIT_STEP_SECONDS)
+        return True
+
+    @classmethod
+    def release(cls, camera):
+        if cls._cluster is not None:
+            cls._cluster.release(camera)
+        cls.__release_local(camera)
+
+    @classmethod
+    def __release_local(cls, camera):
+        with cls._condition:
+            cls._active[camera] -= 1
+            if not cls._active[camera]:
+                del cls._active[camera]
+            cls._active_total -= 1
+            cls._condition.notify_all()
+
+    @classmethod
+    def active_count(cls, camera=None):
+        with cls._condition:
+            return cls._active_total if camera is None else cls._active.get(camera, 0)
+
+    @classmethod
+    def __has_free_slot(cls, camera):
+        # Streams beyond what the rate limit can feed at a useful speed would
+        # only split the same budget further, so cap them as well.
+        global_limit = cls.__capped(cls.global_limit, BandwidthLimiter.max_streams())
+        camera_limit = cls.__capped(cls._camera_limits.get(camera, cls.per_camera_limit),
+                                    BandwidthLimiter.max_streams(camera))
+        return cls._active_total < global_limit and cls._active.get(camera, 0) < camera_limit
+
+    @staticmethod
+    def __capped(limit, cap):
+        return limit if cap is None else min(limit, cap)
+
+
+class ClipLocks:
+    LOCK_SUFFIX = '.lock'
+
+    _held = {}
+    _condition = threading.Condition()
+
+    _WAIT_STEP_SECONDS = 0.5
+
+    @classmethod
+    def acquire(cls, file_name, cancel_event=None):
+        with cls._condition:
+            while file_name in cls._held:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+                cls._condition.wait(cls._WAIT_STEP_SECONDS)
+            cls._held[file_name] = None
+
+        # Tasks of other processes (a separate worker, cluster nodes) may fetch
+        # the same clip, so the lock is also taken on a file next to it.
+        lock_file = None
+        try:
+            lock_file = cls.__lock_file(file_name + cls.LOCK_SUFFIX, cancel_event)
+        finally:
+            with cls._condition:
+                if lock_file is None:
+                    del cls._held[file_name]
+                    cls._condition.notify_all()
+                else:
+                    cls._held[file_name] = lock_file
+        return lock_file is not None
+
+    @classmethod
+    def release(cls, file_name):
+        with cls._condition:
+            lock_file = cls._held.pop(file_name, None)
+            cls._condition.notify_all()
+        if lock_file is not None:
+            # Removed while still locked: a waiter that opened the old file
+            # notices on acquiring it and retries with a fresh one.
+            try:
+                os.remove(lock_file.name)
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    @classmethod
+    def __lock_file(cls, lock_name, cancel_event):
+        while True:
+            lock_file = open(lock_name, 'ab')
+            try:
+                while True:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if cancel_event is not None and cancel_event.wait(cls._WAIT_STEP_SECONDS):
+                            lock_file.close()
+                            return None
+                        if cancel_event is None:
+                            time.sleep(cls._WAIT_STEP_SECONDS)
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_name).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
@@ -1,19 +1,19 @@
 import logging
+import threading
 
 
 class ContextFilter(logging.Filter):
     def __init__(self):
         super().__init__()
-        self.task_id = None
+        self._context = threading.local()
 
     def set_task_id(self, task_id):
-        self.task_id = task_id
+        self._context.task_id = task_id
 
     def filter(self, record):
-        if self.task_id:
-            record.task_id = self.task_id
-        else:
-            record.task_id = ''
+        task_id = getattr(self._context, 'task_id', None)
+        record.task_id = task_id or ''
+        record.task_context = ' - [{}]'.format(task_id) if task_id else ''
         return True
 
 
@@ -39,10 +39,7 @@ class Logger:
         if task_id:
             Logger._context_filter.set_task_id(task_id)
 
-        log_format = '%(asctime)s - %(levelname)s'
-        if task_id:
-            log_format += ' - [%(task_id)s]'
-        log_format += ' - %(message)s'
+        log_format = '%(asctime)s - %(levelname)s%(task_context)s - %(message)s'
 
         console_formatter = logging.Formatter(fmt=log_format, datefmt='%Y-%m-%d %H:%M:%S')
 
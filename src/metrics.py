@@ -0,0 +1,52 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+CLIP_SECONDS_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_SECONDS_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SEARCH_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DOWNLOADED_BYTES = Counter(
+    'hikfetch_downloaded_bytes_total', 'Bytes of clip data received from cameras', ['camera'])
+CLIP_DOWNLOAD_SECONDS = Histogram(
+    'hikfetch_clip_download_seconds', 'Duration of a single clip download attempt',
+    ['camera', 'result'], buckets=CLIP_SECONDS_BUCKETS)
+CLIP_STAGE_SECONDS = Histogram(
+    'hikfetch_clip_stage_seconds', 'Time a clip download spends in each stage '
+    '(circuit_wait, slot_wait, index, response, network, throttle, disk, finalize)',
+    ['camera', 'stage'], buckets=STAGE_SECONDS_BUCKETS)
+CLIP_RESULTS = Counter(
+    'hikfetch_clip_download_results_total', 'Clip download attempts by result', ['camera', 'result'])
+CLIP_RETRIES = Counter(
+    'hikfetch_clip_retries_total', 'Clip downloads retried after a failed attempt', ['camera'])
+CLIPS_FAILED = Counter(
+    'hikfetch_clips_failed_total', 'Clips given up on after exhausting their retries', ['camera', 'result'])
+CIRCUIT_OPEN = Gauge(
+    'hikfetch_circuit_open', 'Whether downloads from a camera are paused by its circuit breaker', ['camera'])
+CLIPS_SKIPPED = Counter(
+    'hikfetch_clips_skipped_total', 'Clips skipped because they were already downloaded', ['camera'])
+CLIPS_QUEUED = Gauge(
+    'hikfetch_clips_queued', 'Clips handed to the download pool and not finished yet', ['camera'])
+ACTIVE_CLIP_DOWNLOADS = Gauge(
+    'hikfetch_active_clip_downloads', 'Clips currently being downloaded', ['camera'])
+
+SEARCH_REQUEST_SECONDS = Histogram(
+    'hikfetch_search_request_seconds', 'Round trip of a single recording search request',
+    ['camera', 'mode'], buckets=SEARCH_SECONDS_BUCKETS)
+SEARCH_CACHE_LOOKUPS = Counter(
+    'hikfetch_search_cache_lookups_total', 'Search cache lookups for closed time buckets', ['result'])
+
+RETENTION_DELETED_FILES = Counter(
+    'hikfetch_retention_deleted_files_total', 'Clips removed by the retention engine', ['camera', 'rule'])
+RETENTION_DELETED_BYTES = Counter(
+    'hikfetch_retention_deleted_bytes_total', 'Bytes freed by the retention engine', ['camera', 'rule'])
+
+TASK_QUEUE_DEPTH = Gauge(
+    'hikfetch_task_queue_depth', 'Tasks waiting for a free task slot')
+ACTIVE_TASKS = Gauge(
+    'hikfetch_active_tasks', 'Tasks currently holding a task slot')
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    'hikfetch_task_queue_wait_seconds', 'Time tasks waited in the scheduler before starting',
+    buckets=(1, 5, 15, 60, 300, 900, 3600, 4 * 3600))
+
+
+def render_latest():
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,251 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from src.camera import CapabilityCache
+from src.cluster import ClusterStore
+from src.storage import SqliteStore
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class MirrorStore(SqliteStore):
+    FILE_NAME = 'mirror.db'
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    camera TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    synced_until TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (camera, channel)
+);
+CREATE TABLE IF NOT EXISTS gaps (
+    camera TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    detected_at TEXT NOT NULL,
+    PRIMARY KEY (camera, channel, start_time, end_time)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    camera TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync_requests (
+    camera TEXT PRIMARY KEY,
+    requested_at TEXT NOT NULL
+);
+"""
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls.open(os.path.join(state_dir, cls.FILE_NAME))
+
+    def get_watermarks(self, camera):
+        rows = self.execute('SELECT channel, synced_until FROM watermarks WHERE camera = ?', (camera,))
+        return {row['channel']: row['synced_until'] for row in rows}
+
+    def set_watermark(self, camera, channel, synced_until):
+        self.execute(
+            'INSERT OR REPLACE INTO watermarks (camera, channel, synced_until, updated_at) VALUES (?, ?, ?, ?)',
+            (camera, channel, synced_until, datetime.now().isoformat()))
+
+    def add_gap(self, camera, channel, start_time, end_time, error=None):
+        self.execute(
+            'INSERT OR IGNORE INTO gaps (camera, channel, start_time, end_time, last_error, detected_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (camera, channel, start_time, end_time, error, datetime.now().isoformat()))
+
+    def list_gaps(self, camera, limit=None):
+        rows = self.execute(
+            'SELECT channel, start_time, end_time, attempts, last_error FROM gaps WHERE camera = ? '
+            'ORDER BY attempts, start_time LIMIT ?', (camera, -1 if limit is None else limit))
+        return [dict(row) for row in rows]
+
+    def remove_gap(self, camera, gap):
+        self.execute('DELETE FROM gaps WHERE camera = ? AND channel = ? AND start_time = ? AND end_time = ?',
+                     (camera, gap['channel'], gap['start_time'], gap['end_time']))
+
+    def fail_gap(self, camera, gap, error):
+        self.execute(
+            'UPDATE gaps SET attempts = attempts + 1, last_error = ? '
+            'WHERE camera = ? AND channel = ? AND start_time = ? AND end_time = ?',
+            (error, camera, gap['channel'], gap['start_time'], gap['end_time']))
+
+    def get_run(self, camera):
+        rows = self.execute('SELECT task_id FROM runs WHERE camera = ?', (camera,))
+        return rows[0]['task_id'] if rows else None
+
+    def set_run(self, camera, task_id):
+        if task_id is None:
+            self.execute('DELETE FROM runs WHERE camera = ?', (camera,))
+        else:
+            self.execute('INSERT OR REPLACE INTO runs (camera, task_id) VALUES (?, ?)', (camera, task_id))
+
+    def request_sync(self, camera):
+        self.execute('INSERT OR REPLACE INTO sync_requests (camera, requested_at) VALUES (?, ?)',
+                     (camera, datetime.now().isoformat()))
+
+    def pop_sync_request(self, camera):
+        return bool(self.execute('DELETE FROM sync_requests WHERE camera = ? RETURNING camera', (camera,)))
+
+
+class MirrorService:
+    POLL_INTERVAL_SECONDS = 5
+    MAX_GAP_ATTEMPTS = 5
+    MIN_WINDOW_SECONDS = 60
+    LEASE_NAME = 'mirror'
+    LEASE_SECONDS = 30
+
+    def __init__(self, task_manager, registry, config):
+        self.task_manager = task_manager
+        self.registry = registry
+        self.config = config
+        self.store = MirrorStore.for_state_dir(config['state_dir'])
+        self.cluster_store = ClusterStore.for_state_dir(config['state_dir'])
+        self.interval_seconds = config['mirror_interval_minutes'] * 60
+        self.backfill = timedelta(hours=config['mirror_backfill_hours'])
+        self.settle = timedelta(seconds=config['mirror_settle_seconds'])
+        self.next_run_at = {}
+        self.running = False
+        self.thread = None
+        self._wake_event = threading.Event()
+
+    def cameras(self):
+        return [camera for camera in self.registry.all() if camera.mirror]
+
+    def start(self):
+        if self.running or not self.cameras():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='mirror', daemon=True)
+        self.thread.start()
+        logger.info(f"Mirroring cameras {', '.join(camera.id for camera in self.cameras())} "
+                    f"every {self.interval_seconds // 60} minutes")
+
+    def stop(self):
+        self.running = False
+        self._wake_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.cluster_store.release_lease(self.LEASE_NAME, self.task_manager.worker_id)
+
+    def sync_now(self, camera_id):
+        camera = self.registry.get(camera_id)
+        if camera is None or not camera.mirror:
+            return False
+        # Stored rather than applied directly, as the mirror may run in the worker process
+        self.store.request_sync(camera.id)
+        self._wake_event.set()
+        return True
+
+    def status(self):
+        cameras = []
+        for camera in self.cameras():
+            watermarks = self.store.get_watermarks(camera.id)
+            cameras.append({
+                'camera_id': camera.id,
+                'channels': [{'channel': channel, 'synced_until': watermarks.get(channel)}
+                             for channel in camera.channels],
+                'gaps': self.store.list_gaps(camera.id),
+                'task_id': self.store.get_run(camera.id)
+            })
+        return {'interval_minutes': self.interval_seconds // 60, 'cameras': cameras}
+
+    def _run(self):
+        while self.running:
+            # Only one node of a cluster mirrors at a time; another takes over
+            # once its lease runs out.
+            if not self.cluster_store.acquire_lease(self.LEASE_NAME, self.task_manager.worker_id,
+                                                    self.LEASE_SECONDS):
+                self._wake_event.wait(self.POLL_INTERVAL_SECONDS)
+                self._wake_event.clear()
+                continue
+
+            for camera in self.cameras():
+                try:
+                    self._tick(camera)
+                except Exception as e:
+                    logger.error(f"Mirror of camera {camera.id} failed: {e}")
+            self._wake_event.wait(self.POLL_INTERVAL_SECONDS)
+            self._wake_event.clear()
+
+    def _tick(self, camera):
+        task_id = self.store.get_run(camera.id)
+        if task_id is not None:
+            task = self.task_manager.get_task(task_id)
+            if task is not None and not task.is_finished():
+                return
+            if task is not None:
+                self._finish(camera, task)
+            self.store.set_run(camera.id, None)
+
+        if self.store.pop_sync_request(camera.id) or time.monotonic() >= self.next_run_at.get(camera.id, 0):
+            self.next_run_at[camera.id] = time.monotonic() + self.interval_seconds
+            window = self._sync_window(camera)
+            if window is not None:
+                self._submit(camera, 'sync', camera.channels, *window)
+                return
+
+        # Gaps are refilled one at a time between regular syncs, so a bad
+        # stretch of archive never delays new clips.
+        gaps = self.store.list_gaps(camera.id, limit=1)
+        if gaps and gaps[0]['attempts'] < self.MAX_GAP_ATTEMPTS:
+            gap = gaps[0]
+            self._submit(camera, 'gap', [gap['channel']], gap['start_time'], gap['end_time'])
+
+    def _sync_window(self, camera):
+        end = CapabilityCache.get(camera).camera_now().replace(microsecond=0) - self.settle
+        watermarks = self.store.get_watermarks(camera.id)
+        start = min(datetime.strptime(watermarks[channel], TIME_FORMAT) if channel in watermarks
+                    else end - self.backfill for channel in camera.channels)
+        if (end - start).total_seconds() < self.MIN_WINDOW_SECONDS:
+            return None
+        return start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+
+    def _submit(self, camera, kind, channels, start, end):
+        task_id = self.task_manager.create_task({
+            'camera_id': camera.id,
+            'start_datetime_str': start,
+            'end_datetime_str': end,
+            'camera_channel': channels[0],
+            'camera_channels': list(channels),
+            'priority': 'low',
+            'mirror': kind
+        })
+        self.store.set_run(camera.id, task_id)
+        logger.info(f"Mirror {kind} of camera {camera.id} channels {channels}: {start} - {end}")
+
+    def _finish(self, camera, task):
+        kind = task.params.get('mirror')
+        result = task.result or {}
+        downloaded = 'files' in result
+
+        if kind == 'gap':
+            gap = {'channel': task.channels()[0], 'start_time': task.params['start_datetime_str'],
+                   'end_time': task.params['end_datetime_str']}
+            if downloaded and not result.get('failed'):
+                self.store.remove_gap(camera.id, gap)
+            else:
+                self.store.fail_gap(camera.id, gap, task.error)
+                logger.warning(f"Mirror gap of camera {camera.id} channel {gap['channel']} "
+                               f"{gap['start_time']} - {gap['end_time']} still missing: {task.error}")
+            return
+
+        # A run that never got to search leaves the watermark alone, so the
+        # next cycle covers the same stretch again.
+        if not downloaded:
+            logger.warning(f"Mirror sync of camera {camera.id} did not complete: {task.error or task.status.value}")
+            return
+
+        for clip in result.get('failed_clips', []):
+            self.store.add_gap(camera.id, clip['channel'], clip['start'], clip['end'], clip.get('result'))
+        for channel in task.channels():
+            self.store.set_watermark(camera.id, channel, task.params['end_datetime_str'])
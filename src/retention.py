@@ -0,0 +1,239 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from src import metrics
+from src.archive_index import ArchiveIndex
+from src.camera import CapabilityCache
+from src.cluster import ClusterStore
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+MB = 1024 * 1024
+
+
+class RetentionEngine:
+    POLL_INTERVAL_SECONDS = 5
+    BATCH_SIZE = 500
+    BATCH_PAUSE_SECONDS = 0.2
+    SAMPLE_SIZE = 20
+    LEASE_NAME = 'retention'
+    LEASE_SECONDS = 30
+
+    def __init__(self, config, registry, worker_id=None):
+        self.archive_index = ArchiveIndex.for_state_dir(config['state_dir'])
+        self.cluster_store = ClusterStore.for_state_dir(config['state_dir'])
+        self.archive_root = os.path.abspath(config['path_to_media_archive'])
+        self.max_age_days = config['archive_retention_days']
+        self.max_bytes = config['archive_max_mb'] * MB
+        self.interval_seconds = config['archive_retention_interval_minutes'] * 60
+        self.worker_id = worker_id
+        # The archive index identifies cameras by URL, as clips outlive renamed ids
+        self.cameras = {camera.url: camera for camera in registry.all()}
+        self.next_run_at = 0
+        self.running = False
+        self.thread = None
+        self._wake_event = threading.Event()
+
+    def enabled(self):
+        return bool(self.max_age_days or self.max_bytes or
+                    any(camera.retention_days or camera.max_archive_mb for camera in self.cameras.values()))
+
+    def start(self):
+        if self.running or not self.enabled():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self.thread.start()
+        logger.info(f"Archive retention checked every {self.interval_seconds // 60} minutes")
+
+    def stop(self):
+        self.running = False
+        self._wake_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+            self.cluster_store.release_lease(self.LEASE_NAME, self.worker_id)
+
+    def request_run(self):
+        if not self.enabled():
+            return False
+        # Stored rather than applied directly, as retention may run in the worker process
+        self.archive_index.request_retention_run()
+        self._wake_event.set()
+        return True
+
+    def report(self):
+        usage = self.archive_index.camera_usage()
+        return {
+            'policy': self.policy(),
+            'usage': [{'camera_id': self.__camera_id(camera), 'clips': row['clips'], 'bytes': row['bytes'],
+                       'oldest': row['oldest']} for camera, row in usage.items()],
+            'pending': self.evaluate(dry_run=True),
+            'runs': self.archive_index.list_retention_runs()
+        }
+
+    def policy(self):
+        return {
+            'max_age_days': self.max_age_days or None,
+            'max_bytes': self.max_bytes or None,
+            'interval_minutes': self.interval_seconds // 60,
+            'cameras': {camera.id: {'max_age_days': camera.retention_days,
+                                    'max_bytes': camera.max_archive_mb * MB if camera.max_archive_mb else None}
+                        for camera in self.cameras.values() if camera.retention_days or camera.max_archive_mb}
+        }
+
+    def run(self):
+        run_id = self.archive_index.start_retention_run()
+        started_at = time.monotonic()
+        report = self.evaluate(dry_run=False)
+        report['seconds'] = round(time.monotonic() - started_at, 3)
+        self.archive_index.finish_retention_run(run_id, report)
+        if report['files']:
+            logger.info(f"Retention removed {report['files']} clips ({report['bytes']} bytes)")
+        return report
+
+    def evaluate(self, dry_run=True):
+        usage = {camera: row['bytes'] for camera, row in self.archive_index.camera_usage().items()}
+        total = sum(usage.values())
+        cutoffs = {camera: self.__age_cutoff(camera) for camera in usage}
+        latest_cutoff = max((cutoff for cutoff in cutoffs.values() if cutoff), default=None)
+        over_cameras = {camera for camera in usage if self.__size_limit(camera) and
+                        usage[camera] > self.__size_limit(camera)}
+
+        report = {'dry_run': dry_run, 'files': 0, 'bytes': 0, 'failed': 0, 'rules': {}, 'cameras': {}, 'sample': []}
+        position = ('', 0)
+        # Clips are visited oldest first straight from the index, and only up
+        # to the point where no rule can apply any more.
+        while True:
+            rows = self.archive_index.list_oldest(*position, self.BATCH_SIZE)
+            if not rows:
+                break
+
+            batch = []
+            finished = False
+            for row in rows:
+                position = (row['start_time'], row['rowid'])
+                camera = row['camera']
+                over_total = self.max_bytes and total > self.max_bytes
+                if cutoffs.get(camera) and row['start_time'] < cutoffs[camera]:
+                    rule = 'age'
+                elif camera in over_cameras:
+                    rule = 'camera_size'
+                elif over_total:
+                    rule = 'total_size'
+                else:
+                    if not over_cameras and not over_total and \
+                            (latest_cutoff is None or row['start_time'] >= latest_cutoff):
+                        finished = True
+                        break
+                    continue
+
+                row['rule'] = rule
+                batch.append(row)
+                usage[camera] -= row['file_size']
+                total -= row['file_size']
+                if camera in over_cameras and usage[camera] <= self.__size_limit(camera):
+                    over_cameras.discard(camera)
+
+            if not dry_run:
+                batch = self._delete(batch, report)
+            self.__add_to_report(report, batch)
+            if finished:
+                break
+            if not dry_run and batch:
+                time.sleep(self.BATCH_PAUSE_SECONDS)
+
+        return report
+
+    def _delete(self, rows, report):
+        deleted = []
+        directories = set()
+        for row in rows:
+            path = os.path.abspath(row['file_path'])
+            if not path.startswith(self.archive_root + os.sep):
+                logger.warning(f"Not removing {path}: outside of the download directory")
+                report['failed'] += 1
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove {path}: {e}")
+                report['failed'] += 1
+                continue
+            deleted.append(row)
+            directories.add(os.path.dirname(path))
+
+        self.archive_index.delete_clips(deleted)
+        for row in deleted:
+            camera_id = self.__camera_id(row['camera'])
+            metrics.RETENTION_DELETED_FILES.labels(camera=camera_id, rule=row['rule']).inc()
+            metrics.RETENTION_DELETED_BYTES.labels(camera=camera_id, rule=row['rule']).inc(row['file_size'])
+        self._remove_empty_directories(directories)
+        return deleted
+
+    def _remove_empty_directories(self, directories):
+        # Only the day and channel directories that just lost clips are
+        # checked, never the whole tree.
+        for directory in sorted(directories, key=len, reverse=True):
+            while directory.startswith(self.archive_root + os.sep):
+                try:
+                    os.rmdir(directory)
+                except OSError:
+                    break
+                directory = os.path.dirname(directory)
+
+    def _run(self):
+        while self.running:
+            # Only one node of a cluster applies retention at a time
+            if self.cluster_store.acquire_lease(self.LEASE_NAME, self.worker_id, self.LEASE_SECONDS):
+                requested = self.archive_index.pop_retention_requests()
+                if requested or time.monotonic() >= self.next_run_at:
+                    self.next_run_at = time.monotonic() + self.interval_seconds
+                    try:
+                        self.run()
+                    except Exception as e:
+                        logger.error(f"Retention run failed: {e}")
+            self._wake_event.wait(self.POLL_INTERVAL_SECONDS)
+            self._wake_event.clear()
+
+    def __add_to_report(self, report, rows):
+        for row in rows:
+            camera_id = self.__camera_id(row['camera'])
+            report['files'] += 1
+            report['bytes'] += row['file_size']
+            for key, name in (('rules', row['rule']), ('cameras', camera_id)):
+                totals = report[key].setdefault(name, {'files': 0, 'bytes': 0})
+                totals['files'] += 1
+                totals['bytes'] += row['file_size']
+            if len(report['sample']) < self.SAMPLE_SIZE:
+                report['sample'].append({'camera_id': camera_id, 'channel': row['channel'],
+                                         'start_time': row['start_time'], 'file': row['file_path'],
+                                         'bytes': row['file_size'], 'rule': row['rule']})
+
+    def __camera_id(self, camera_url):
+        camera = self.cameras.get(camera_url)
+        return camera.id if camera else camera_url
+
+    def __age_cutoff(self, camera_url):
+        camera = self.cameras.get(camera_url)
+        days = camera.retention_days if camera and camera.retention_days else self.max_age_days
+        if not days:
+            return None
+        # Start times in the index are camera-local, so the cutoff follows the camera clock
+        return (self.__camera_now(camera) - timedelta(days=days)).strftime(TIME_FORMAT)
+
+    @staticmethod
+    def __camera_now(camera):
+        # Only the cached clock is used: reports are served synchronously and
+        # an unreachable camera must not hold up every retention pass.
+        capabilities = CapabilityCache.peek(camera.id) if camera is not None else None
+        return capabilities.camera_now() if capabilities is not None else datetime.now()
+
+    def __size_limit(self, camera_url):
+        camera = self.cameras.get(camera_url)
+        return camera.max_archive_mb * MB if camera and camera.max_archive_mb else 0
@@ -0,0 +1,154 @@
+import logging
+import random
+import threading
+import time
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    # Attempts allowed and delay multiplier per FileDownloadingResult name. An
+    # overloaded NVR (device_error) gets more patience but backs off harder.
+    DEFAULT_RULES = {
+        'timeout': (5, 1),
+        'connection_error': (5, 1),
+        'device_error': (8, 2),
+        'error': (3, 1)
+    }
+
+    def __init__(self, base_delay_seconds, max_delay_seconds, max_attempts=None):
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.rules = dict(self.DEFAULT_RULES)
+        if max_attempts is not None:
+            self.rules = {name: (max_attempts * (2 if name == 'device_error' else 1), factor)
+                          for name, (_, factor) in self.rules.items()}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['retry_base_delay_seconds'], config['retry_max_delay_seconds'],
+                   config.get('retry_max_attempts'))
+
+    def should_retry(self, result_name, attempts):
+        max_attempts, _ = self.rules.get(result_name, self.rules['error'])
+        return attempts < max_attempts
+
+    def delay(self, result_name, attempts):
+        _, factor = self.rules.get(result_name, self.rules['error'])
+        ceiling = min(self.max_delay_seconds, self.base_delay_seconds * factor * 2 ** (attempts - 1))
+        # Equal jitter: keeps a minimum back-off while spreading out workers
+        # that failed at the same moment.
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    @staticmethod
+    def sleep(seconds, cancel_event=None):
+        if cancel_event is None:
+            time.sleep(seconds)
+            return True
+        return not cancel_event.wait(seconds)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    failure_threshold = 5
+    cooldown_seconds = 30
+    max_cooldown_seconds = 300
+
+    _breakers = {}
+    _condition = threading.Condition()
+
+    _WAIT_STEP_SECONDS = 0.5
+
+    @classmethod
+    def init(cls, failure_threshold, cooldown_seconds, max_cooldown_seconds):
+        with cls._condition:
+            cls.failure_threshold = max(1, failure_threshold)
+            cls.cooldown_seconds = cooldown_seconds
+            cls.max_cooldown_seconds = max(cooldown_seconds, max_cooldown_seconds)
+
+    @classmethod
+    def acquire(cls, camera, cancel_event=None):
+        with cls._condition:
+            breaker = cls.__breaker(camera)
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    return False
+
+                if breaker['state'] == cls.OPEN and time.monotonic() >= breaker['opened_until']:
+                    breaker.update(state=cls.HALF_OPEN, trial_in_flight=False, trial_holder=None)
+                    logger.info(f"Circuit for camera {camera} half-open, sending a trial request")
+
+                if breaker['state'] == cls.CLOSED:
+                    return True
+                if breaker['state'] == cls.HALF_OPEN and not breaker['trial_in_flight']:
+                    breaker.update(trial_in_flight=True, trial_holder=threading.get_ident())
+                    return True
+
+                cls._condition.wait(cls._WAIT_STEP_SECONDS)
+
+    @classmethod
+    def record_success(cls, camera):
+        with cls._condition:
+            breaker = cls.__breaker(camera)
+            # While half-open only the trial decides; other requests were
+            # sent before the circuit opened.
+            if breaker['state'] == cls.HALF_OPEN and not cls.__holds_trial(breaker):
+                return
+            if breaker['state'] != cls.CLOSED:
+                logger.info(f"Circuit for camera {camera} closed")
+            breaker.update(state=cls.CLOSED, failures=0, trips=0, trial_in_flight=False, trial_holder=None)
+            metrics.CIRCUIT_OPEN.labels(camera=camera).set(0)
+            cls._condition.notify_all()
+
+    @classmethod
+    def record_failure(cls, camera):
+        with cls._condition:
+            breaker = cls.__breaker(camera)
+            if breaker['state'] == cls.HALF_OPEN and not cls.__holds_trial(breaker):
+                return
+            breaker['failures'] += 1
+            if breaker['state'] == cls.HALF_OPEN or \
+                    (breaker['state'] == cls.CLOSED and breaker['failures'] >= cls.failure_threshold):
+                cls.__trip(camera, breaker)
+            cls._condition.notify_all()
+
+    @classmethod
+    def record_neutral(cls, camera):
+        with cls._condition:
+            breaker = cls.__breaker(camera)
+            if cls.__holds_trial(breaker):
+                breaker.update(trial_in_flight=False, trial_holder=None)
+                cls._condition.notify_all()
+
+    @classmethod
+    def get_state(cls, camera):
+        with cls._condition:
+            breaker = cls._breakers.get(camera)
+            return breaker['state'] if breaker else cls.CLOSED
+
+    @classmethod
+    def __trip(cls, camera, breaker):
+        cooldown = min(cls.max_cooldown_seconds, cls.cooldown_seconds * 2 ** breaker['trips'])
+        breaker.update(state=cls.OPEN, opened_until=time.monotonic() + cooldown,
+                       trips=breaker['trips'] + 1, trial_in_flight=False, trial_holder=None)
+        metrics.CIRCUIT_OPEN.labels(camera=camera).set(1)
+        logger.warning(f"Circuit for camera {camera} opened for {cooldown:.0f}s "
+                       f"after {breaker['failures']} consecutive failures")
+
+    @staticmethod
+    def __holds_trial(breaker):
+        return breaker['trial_in_flight'] and breaker['trial_holder'] == threading.get_ident()
+
+    @classmethod
+    def __breaker(cls, camera):
+        breaker = cls._breakers.get(camera)
+        if breaker is None:
+            breaker = {'state': cls.CLOSED, 'failures': 0, 'trips': 0, 'opened_until': 0,
+                       'trial_in_flight': False, 'trial_holder': None}
+            cls._breakers[camera] = breaker
+        return breaker
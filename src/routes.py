@@ -1,9 +1,41 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
 from flask import render_template, request, jsonify, redirect, url_for, Response, session
 
+from src import metrics
+from src.archive_export import ArchiveStream
 from src.auth.oidc import check_oidc_claims
+from src.camera import CapabilityCache
+from src.scheduler import TaskPriority
+
+
+TASKS_PAGE_SIZE = 100
+TASKS_MAX_PAGE_SIZE = 500
+EVENT_STREAM_MAX_SECONDS = 300
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_SHARDS_PER_CAMERA = 500
+
+
+def format_event(event_type, data):
+    return 'event: {}\ndata: {}\n\n'.format(event_type, json.dumps(data))
 
 
-def register_routes(app, oauth, oidc_config, credentials, task_manager, config, requires_auth, auth_method='none'):
+def get_request_user(auth_method):
+    if auth_method == 'oidc':
+        return session.get('user')
+    if auth_method == 'basic' and request.authorization:
+        return request.authorization.username
+    return None
+
+
+def register_routes(app, oauth, oidc_config, credentials, registry, task_manager, config, requires_auth,
+                    auth_method='none', mirror_service=None, retention_engine=None):
     @app.route('/')
     @requires_auth
     def index():
@@ -35,6 +67,7 @@ def register_routes(app, oauth, oidc_config, credentials, task_manager, config,
 
             session.permanent = True
             session['authenticated'] = True
+            session['user'] = userinfo.get('preferred_username') or userinfo.get('email') or userinfo.get('sub')
 
             return redirect(url_for('index'))
 
@@ -63,34 +96,183 @@ def register_routes(app, oauth, oidc_config, credentials, task_manager, config,
     def download():
         data = request.json
 
-        start_date = data.get('start_date')
-        start_time = data.get('start_time')
-        end_date = data.get('end_date')
-        end_time = data.get('end_time')
-        camera_channel = int(data.get('camera_channel', 1))
+        camera_id = data.get('camera_id') or registry.default_camera_id()
+        if registry.get(camera_id) is None:
+            return jsonify({'error': f"Unknown camera '{camera_id}'"}), 400
 
-        start_datetime_str = f"{start_date} {start_time}"
-        end_datetime_str = f"{end_date} {end_time}"
+        try:
+            camera_channels = parse_channels(data.get('camera_channels') or data.get('camera_channel', 1))
+            task_params = build_task_params(data, camera_id, camera_channels)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
-        task_params = {
-            'config': config,
-            'camera_url': credentials['camera_url'],
-            'user_name': credentials['username'],
-            'user_password': credentials['password'],
-            'start_datetime_str': start_datetime_str,
-            'end_datetime_str': end_datetime_str,
-            'camera_channel': camera_channel
-        }
+        if request.args.get('plan', '').lower() in ('1', 'true'):
+            try:
+                return jsonify(task_manager.plan_task(task_params))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            except Exception as e:
+                app.logger.error(f"Planning download failed: {e}")
+                return jsonify({'error': f'Could not search the camera: {e}'}), 502
 
         task_id = task_manager.create_task(task_params)
 
         return jsonify({'task_id': task_id})
 
+    @app.route('/fleet-download', methods=['POST'])
+    @requires_auth
+    def fleet_download():
+        data = request.json
+        targets = data.get('cameras') or [{'camera_id': camera.id} for camera in registry.all()]
+
+        task_params_list = []
+        batch_id = str(uuid.uuid4())
+        try:
+            for target in targets:
+                if isinstance(target, str):
+                    target = {'camera_id': target}
+                camera = registry.get(target.get('camera_id'))
+                if camera is None:
+                    raise ValueError(f"Unknown camera '{target.get('camera_id')}'")
+
+                camera_channels = parse_channels(target.get('channels') or camera.channels)
+                task_params = build_task_params(data, camera.id, camera_channels)
+                task_params['batch_id'] = batch_id
+                task_params_list.extend(split_time_shards(task_params, data.get('shard_hours')))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        task_ids = [task_manager.create_task(task_params) for task_params in task_params_list]
+
+        return jsonify({'batch_id': batch_id, 'task_ids': task_ids})
+
+    @app.route('/batches/<batch_id>', methods=['GET'])
+    @requires_auth
+    def get_batch(batch_id):
+        batch = task_manager.get_batch(batch_id)
+        if batch:
+            return jsonify(batch)
+        return jsonify({'error': 'Batch not found'}), 404
+
+    @app.route('/cameras', methods=['GET'])
+    @requires_auth
+    def get_cameras():
+        cameras = []
+        for camera in registry.all():
+            capabilities = CapabilityCache.peek(camera.id)
+            cameras.append(dict(camera.to_dict(), capabilities=capabilities.to_dict() if capabilities else None))
+        return jsonify(cameras)
+
+    def parse_channels(value):
+        if isinstance(value, str):
+            value = [part for part in value.replace(' ', '').split(',') if part]
+        elif not isinstance(value, list):
+            value = [value]
+
+        try:
+            camera_channels = sorted({int(camera_channel) for camera_channel in value})
+        except (TypeError, ValueError):
+            raise ValueError('Camera channels must be integers')
+        if not camera_channels or camera_channels[0] < 1:
+            raise ValueError('Camera channels must be positive integers')
+        return camera_channels
+
+    def split_time_shards(task_params, shard_hours):
+        if not shard_hours:
+            return [task_params]
+        try:
+            shard = timedelta(hours=float(shard_hours))
+            start = datetime.strptime(task_params['start_datetime_str'], TIME_FORMAT)
+            end = datetime.strptime(task_params['end_datetime_str'], TIME_FORMAT)
+        except (TypeError, ValueError):
+            raise ValueError('shard_hours must be a number and the time range must be valid')
+        if shard < timedelta(minutes=1):
+            raise ValueError('shard_hours must be at least one minute')
+        if (end - start) / shard >= MAX_SHARDS_PER_CAMERA:
+            raise ValueError(f'shard_hours would split the time range into more than {MAX_SHARDS_PER_CAMERA} tasks')
+
+        # Shards are separate tasks, so that nodes of a cluster can work on
+        # different stretches of the same camera.
+        shards = []
+        while start <= end:
+            shard_end = min(start + shard - timedelta(seconds=1), end)
+            shards.append(dict(task_params, start_datetime_str=start.strftime(TIME_FORMAT),
+                               end_datetime_str=shard_end.strftime(TIME_FORMAT)))
+            start = shard_end + timedelta(seconds=1)
+        return shards
+
+    def build_task_params(data, camera_id, camera_channels):
+        priority = data.get('priority') or 'normal'
+        TaskPriority.from_name(priority)
+
+        start_datetime_str = f"{data.get('start_date')} {data.get('start_time')}"
+        end_datetime_str = f"{data.get('end_date')} {data.get('end_time')}"
+
+        task_params = {
+            'camera_id': camera_id,
+            'start_datetime_str': start_datetime_str,
+            'end_datetime_str': end_datetime_str,
+            'camera_channel': camera_channels[0],
+            'camera_channels': camera_channels,
+            'priority': priority,
+            'owner': get_request_user(auth_method)
+        }
+        if data.get('profile'):
+            task_params['profile'] = True
+        return task_params
+
     @app.route('/tasks', methods=['GET'])
     @requires_auth
     def get_tasks():
-        tasks = task_manager.get_all_tasks()
-        return jsonify([task.to_dict() for task in tasks])
+        status = request.args.get('status')
+        limit = min(max(request.args.get('limit', TASKS_PAGE_SIZE, type=int), 1), TASKS_MAX_PAGE_SIZE)
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        mirror = request.args.get('mirror', 'false').lower() in ('1', 'true')
+
+        tasks = task_manager.list_tasks(status=status, limit=limit, offset=offset, mirror=mirror)
+        response = jsonify([task.to_dict() for task in tasks])
+        response.headers['X-Total-Count'] = str(task_manager.count_tasks(status=status, mirror=mirror))
+        return response
+
+    # Each open stream holds a gunicorn thread for up to EVENT_STREAM_MAX_SECONDS,
+    # so they are capped below the thread count to keep the API answering.
+    event_streams = threading.BoundedSemaphore(config['max_event_streams'])
+
+    @app.route('/tasks/events', methods=['GET'])
+    @requires_auth
+    def task_events():
+        if not event_streams.acquire(blocking=False):
+            # EventSource gives up on an error status; the UI then falls back to polling
+            return jsonify({'error': 'Too many open event streams'}), 503
+
+        def snapshot():
+            return format_event('snapshot', [task.to_dict() for task in task_manager.get_all_tasks()])
+
+        def stream():
+            subscription = task_manager.events.subscribe()
+            try:
+                yield 'retry: 2000\n\n'
+                yield snapshot()
+
+                deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+                while time.monotonic() < deadline:
+                    try:
+                        event = subscription.get(timeout=EVENT_STREAM_KEEPALIVE_SECONDS)
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+
+                    if event['type'] == 'resync':
+                        yield snapshot()
+                    else:
+                        yield format_event(event['type'], event)
+            finally:
+                task_manager.events.unsubscribe(subscription)
+
+        response = Response(stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(event_streams.release)
+        return response
 
     @app.route('/tasks/<task_id>', methods=['GET'])
     @requires_auth
@@ -100,9 +282,110 @@ def register_routes(app, oauth, oidc_config, credentials, task_manager, config,
             return jsonify(task.to_dict())
         return jsonify({'error': 'Task not found'}), 404
 
+    @app.route('/tasks/<task_id>/timeline', methods=['GET'])
+    @requires_auth
+    def get_task_timeline(task_id):
+        timeline = task_manager.get_timeline(task_id)
+        if timeline is None:
+            return jsonify({'error': 'Timeline not found'}), 404
+
+        if request.args.get('format') == 'folded':
+            stacks = timeline.get('profile', {}).get('stacks', [])
+            folded = ''.join('{} {}\n'.format(entry['stack'], entry['count']) for entry in stacks)
+            return Response(folded, content_type='text/plain')
+
+        return jsonify(dict(timeline, task_id=task_id))
+
+    @app.route('/tasks/<task_id>/archive', methods=['GET'])
+    @requires_auth
+    def get_task_archive(task_id):
+        task = task_manager.get_task(task_id)
+        if task is None:
+            return jsonify({'error': 'Task not found'}), 404
+        if not task.is_finished():
+            return jsonify({'error': 'Task is still running'}), 409
+
+        archive_format = request.args.get('format', 'zip')
+        if archive_format not in ArchiveStream.CONTENT_TYPES:
+            return jsonify({'error': 'Unsupported format, expected zip or tar'}), 400
+
+        archive = task_manager.build_archive(task, archive_format)
+        if archive is None:
+            return jsonify({'error': 'No downloaded clips found for this task'}), 404
+
+        etag = archive.etag()
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': '"{}"'.format(etag),
+            'Content-Disposition': 'attachment; filename="hikfetch-{}.{}"'.format(task.display_id, archive_format)
+        }
+        start, stop, status = 0, archive.size, 200
+
+        # Multiple ranges are answered with the whole archive, which RFC 9110 allows
+        byte_range = request.range
+        if byte_range and len(byte_range.ranges) == 1 and \
+                (not request.headers.get('If-Range') or request.if_range.etag == etag):
+            requested = byte_range.range_for_length(archive.size)
+            if requested is None:
+                return Response(status=416, headers={'Content-Range': 'bytes */{}'.format(archive.size)})
+            start, stop = requested
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, archive.size)
+
+        headers['Content-Length'] = str(stop - start)
+        return Response(archive.iter_bytes(start, stop), status=status, headers=headers,
+                        content_type=archive.content_type, direct_passthrough=True)
+
     @app.route('/tasks/<task_id>/cancel', methods=['POST'])
     @requires_auth
     def cancel_task(task_id):
         if task_manager.cancel_task(task_id):
             return jsonify({'status': 'cancelled'})
         return jsonify({'error': 'Task not found'}), 404
+
+    @app.route('/mirror', methods=['GET'])
+    @requires_auth
+    def get_mirror():
+        return jsonify(mirror_service.status())
+
+    @app.route('/mirror/<camera_id>/sync', methods=['POST'])
+    @requires_auth
+    def sync_mirror(camera_id):
+        if mirror_service.sync_now(camera_id):
+            return jsonify({'status': 'scheduled'})
+        return jsonify({'error': 'Camera not found or not mirrored'}), 404
+
+    @app.route('/retention', methods=['GET'])
+    @requires_auth
+    def get_retention():
+        return jsonify(retention_engine.report())
+
+    @app.route('/retention/run', methods=['POST'])
+    @requires_auth
+    def run_retention():
+        if retention_engine.request_run():
+            return jsonify({'status': 'scheduled'})
+        return jsonify({'error': 'No retention policy configured'}), 409
+
+    @app.route('/cluster', methods=['GET'])
+    @requires_auth
+    def get_cluster():
+        return jsonify(task_manager.cluster_status())
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        body, content_type = metrics.render_latest()
+        return Response(body, content_type=content_type)
+
+    @app.route('/limits', methods=['GET'])
+    @requires_auth
+    def get_limits():
+        return jsonify(task_manager.get_limits())
+
+    @app.route('/limits', methods=['PUT'])
+    @requires_auth
+    def set_limits():
+        try:
+            return jsonify(task_manager.set_limits(request.json or {}))
+        except (ValueError, AttributeError) as e:
+            return jsonify({'error': str(e)}), 400
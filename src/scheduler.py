@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TaskPriority:
+    URGENT = 0
+    HIGH = 1
+    NORMAL = 2
+    LOW = 3
+
+    NAMES = {'urgent': URGENT, 'high': HIGH, 'normal': NORMAL, 'low': LOW}
+
+    @classmethod
+    def from_name(cls, name):
+        if name is None:
+            return cls.NORMAL
+        if name not in cls.NAMES:
+            raise ValueError('Unknown priority "{}". Must be one of: {}'.format(name, ', '.join(cls.NAMES)))
+        return cls.NAMES[name]
+
+
+class ScheduledTask:
+    def __init__(self, task):
+        self.task = task
+        self.priority = TaskPriority.from_name(task.params.get('priority'))
+        self.owner = task.params.get('owner')
+        self.camera = task.params.get('camera_id')
+        self.enqueued_at = time.monotonic()
+        self.estimated_cost = self.__estimate_cost(task)
+        self.resume_event = None
+
+    @staticmethod
+    def __estimate_cost(task):
+        try:
+            start = datetime.strptime(task.params['start_datetime_str'], '%Y-%m-%d %H:%M:%S')
+            end = datetime.strptime(task.params['end_datetime_str'], '%Y-%m-%d %H:%M:%S')
+            return max((end - start).total_seconds(), 0) * len(task.channels())
+        except (KeyError, ValueError):
+            return 0
+
+
+class TaskScheduler:
+    def __init__(self, slots, aging_seconds=900):
+        self.slots = slots
+        self.aging_seconds = aging_seconds
+        self._waiting = []
+        self._running = {}
+        self._paused = {}
+        self._condition = threading.Condition()
+
+    def submit(self, task):
+        with self._condition:
+            self._waiting.append(ScheduledTask(task))
+            self._condition.notify_all()
+
+    def next_task(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._waiting and len(self._running) < self.slots:
+                    entry = self.__pick_next()
+                    self._waiting.remove(entry)
+                    self._running[entry.task.task_id] = entry
+
+                    if entry.resume_event is None:
+                        metrics.TASK_QUEUE_WAIT_SECONDS.observe(time.monotonic() - entry.enqueued_at)
+                        return entry.task
+
+                    self._paused.pop(entry.task.task_id, None)
+                    entry.resume_event.set()
+                    logger.info(f"Resuming preempted task {entry.task.display_id}")
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def checkpoint(self, task, stop_event=None):
+        with self._condition:
+            entry = self._paused.get(task.task_id)
+            if entry is None:
+                entry = self._running.get(task.task_id)
+                if entry is None or not self.__should_preempt(entry):
+                    return False
+                self.__preempt(entry)
+            resume_event = entry.resume_event
+
+        stop_event = stop_event or task.cancel_flag
+        while not resume_event.wait(timeout=0.5):
+            if stop_event.is_set():
+                break
+        return True
+
+    def release(self, task):
+        with self._condition:
+            self._running.pop(task.task_id, None)
+            self._paused.pop(task.task_id, None)
+            self._waiting = [entry for entry in self._waiting if entry.task.task_id != task.task_id]
+            self._condition.notify_all()
+
+    def discard_waiting(self, task):
+        with self._condition:
+            if task.task_id not in self._running:
+                self._paused.pop(task.task_id, None)
+                self._waiting = [entry for entry in self._waiting if entry.task.task_id != task.task_id]
+                self._condition.notify_all()
+
+    def queue_depth(self):
+        with self._condition:
+            return len(self._waiting)
+
+    def running_count(self):
+        with self._condition:
+            return len(self._running)
+
+    def __should_preempt(self, entry):
+        if len(self._running) < self.slots or not self._waiting:
+            return False
+        # Aging only orders the queue; otherwise tasks of the same priority
+        # would keep pausing each other once one of them waited long enough.
+        candidate = self.__pick_next()
+        return candidate.priority < entry.priority
+
+    def __preempt(self, entry):
+        del self._running[entry.task.task_id]
+        entry.enqueued_at = time.monotonic()
+        entry.resume_event = threading.Event()
+        self._paused[entry.task.task_id] = entry
+        self._waiting.append(entry)
+        self._condition.notify_all()
+        logger.info(f"Preempting task {entry.task.display_id} at clip boundary")
+
+    def __pick_next(self):
+        return min(self._waiting, key=self.__rank)
+
+    def __rank(self, entry):
+        running = self._running.values()
+        owner_share = sum(1 for other in running if entry.owner and other.owner == entry.owner)
+        camera_share = sum(1 for other in running if other.camera == entry.camera)
+        # Between equally aged entries a task submitted at that priority goes first
+        return (self.__effective_priority(entry), entry.priority, owner_share, camera_share,
+                entry.estimated_cost, entry.enqueued_at)
+
+    def __effective_priority(self, entry):
+        if entry.task.task_id in self._running:
+            return entry.priority
+        waited = time.monotonic() - entry.enqueued_at
+        return max(entry.priority - int(waited // self.aging_seconds), TaskPriority.URGENT)
@@ -0,0 +1,61 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+from src.camera import TimeInterval
+from src.storage import SqliteStore
+
+
+class SearchCache(SqliteStore):
+    FILE_NAME = 'search_cache.db'
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_buckets (
+    camera TEXT NOT NULL,
+    track_id INTEGER NOT NULL,
+    bucket_start TEXT NOT NULL,
+    bucket_seconds INTEGER NOT NULL,
+    playback_uris TEXT NOT NULL,
+    cached_at TEXT NOT NULL,
+    PRIMARY KEY (camera, track_id, bucket_start, bucket_seconds)
+);
+"""
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls.open(os.path.join(state_dir, cls.FILE_NAME))
+
+    def get(self, camera, track_id, bucket):
+        rows = self.execute(
+            'SELECT playback_uris FROM search_buckets '
+            'WHERE camera = ? AND track_id = ? AND bucket_start = ? AND bucket_seconds = ?',
+            self.__key(camera, track_id, bucket))
+        if not rows:
+            return None
+        return json.loads(rows[0]['playback_uris'])
+
+    def put(self, camera, track_id, bucket, playback_uris):
+        self.execute(
+            'INSERT OR REPLACE INTO search_buckets '
+            '(camera, track_id, bucket_start, bucket_seconds, playback_uris, cached_at) VALUES (?, ?, ?, ?, ?, ?)',
+            self.__key(camera, track_id, bucket) + (json.dumps(playback_uris), datetime.now().isoformat()))
+
+    @staticmethod
+    def split_into_buckets(time_interval, bucket_seconds):
+        bucket_length = timedelta(seconds=bucket_seconds)
+        epoch = datetime(1970, 1, 1)
+        offset_seconds = int((time_interval.start_time - epoch).total_seconds())
+        bucket_start = epoch + timedelta(seconds=offset_seconds - offset_seconds % bucket_seconds)
+
+        buckets = []
+        while bucket_start < time_interval.end_time:
+            bucket_end = bucket_start + bucket_length
+            buckets.append(TimeInterval(bucket_start, bucket_end, time_interval.local_time_offset))
+            bucket_start = bucket_end
+        return buckets
+
+    @staticmethod
+    def __key(camera, track_id, bucket):
+        start_time_text, _ = bucket.to_text()
+        bucket_seconds = int((bucket.end_time - bucket.start_time).total_seconds())
+        return camera, track_id, start_time_text, bucket_seconds
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    SCHEMA = ''
+    # WAL needs shared memory between all connections, which a state
+    # directory shared between hosts cannot provide.
+    journal_mode = 'WAL'
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute(f'PRAGMA journal_mode={SqliteStore.journal_mode}')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._lock, self._connection:
+            self._connection.executescript(self.SCHEMA)
+
+    @classmethod
+    def open(cls, path):
+        key = (cls, os.path.abspath(path))
+        with cls._instances_lock:
+            store = cls._instances.get(key)
+            if store is None:
+                store = cls(path)
+                cls._instances[key] = store
+            return store
+
+    @classmethod
+    def close_all(cls):
+        with cls._instances_lock:
+            stores = list(cls._instances.values())
+            cls._instances.clear()
+
+        for store in stores:
+            store.close()
+
+    def execute(self, sql, params=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, params).fetchall()
+
+    def execute_many(self, sql, params_list):
+        with self._lock, self._connection:
+            self._connection.executemany(sql, params_list)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
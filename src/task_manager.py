@@ -1,12 +1,25 @@
 import logging
+import os
 import queue
 import random
+import socket
 import string
 import threading
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
 
+from src import metrics
+from src.admission import DiskBudget
+from src.archive_export import ArchiveEntry, ArchiveStream, ClipChecksums
+from src.archive_index import ArchiveIndex
+from src.cluster import ClusterSlots, ClusterStore
+from src.limits import BandwidthLimiter, DownloadSlots
+from src.scheduler import TaskScheduler
+from src.task_store import TaskStore
+from src.timeline import TaskTimeline
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +31,46 @@ class TaskStatus(Enum):
     CANCELLED = 'cancelled'
 
 
+class TaskEvents:
+    QUEUE_SIZE = 1000
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = queue.Queue(maxsize=self.QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                self.__request_resync(subscription)
+
+    @staticmethod
+    def __request_resync(subscription):
+        while True:
+            try:
+                subscription.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            subscription.put_nowait({'type': 'resync'})
+        except queue.Full:
+            pass
+
+
 class Task:
     def __init__(self, task_id, params):
         self.task_id = task_id
@@ -34,6 +87,31 @@ class Task:
         self.result = None
         self.cancel_flag = threading.Event()
         self.execution_thread = None
+        self.listener = None
+        self.scheduler = None
+        self.persisted_at = 0
+        self.timeline = None
+
+    @classmethod
+    def from_dict(cls, record):
+        task = cls(record['task_id'], record['params'])
+        task.display_id = record['display_id']
+        task.status = TaskStatus(record['status'])
+        task.progress = record['progress']
+        task.total = record['total']
+        task.current_file = record['current_file']
+        task.error = record['error']
+        task.created_at = datetime.fromisoformat(record['created_at'])
+        task.started_at = datetime.fromisoformat(record['started_at']) if record['started_at'] else None
+        task.completed_at = datetime.fromisoformat(record['completed_at']) if record['completed_at'] else None
+        task.result = record['result']
+        return task
+
+    def update(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+        if self.listener:
+            self.listener(self, changes)
 
     def to_dict(self):
         return {
@@ -51,21 +129,47 @@ class Task:
             'params': self.params
         }
 
+    def channels(self):
+        return self.params.get('camera_channels') or [self.params.get('camera_channel', 1)]
+
+    def record_stage(self, stage, started_at, duration=None, event=True, **details):
+        if self.timeline:
+            self.timeline.record(stage, started_at, duration, event, **details)
+
+    def is_finished(self):
+        return self.status not in [TaskStatus.PENDING, TaskStatus.RUNNING]
+
+    def checkpoint(self, stop_event=None):
+        if self.scheduler:
+            started_at = time.monotonic()
+            if self.scheduler.checkpoint(self, stop_event):
+                self.record_stage('preempted', started_at)
+
     def is_cancelled(self):
         return self.cancel_flag.is_set()
 
     def cancel(self):
         self.cancel_flag.set()
         if self.status in [TaskStatus.PENDING, TaskStatus.RUNNING]:
-            self.status = TaskStatus.CANCELLED
-            self.completed_at = datetime.now()
+            self.update(status=TaskStatus.CANCELLED, completed_at=datetime.now())
 
 
 class TaskManager:
     _instance = None
     _lock = threading.Lock()
 
-    def __new__(cls):
+    PROGRESS_PERSIST_INTERVAL_SECONDS = 2
+    RETENTION_CHECK_INTERVAL_SECONDS = 600
+    STORE_POLL_INTERVAL_SECONDS = 0.5
+    TIMELINE_PERSIST_INTERVAL_SECONDS = 10
+    CLAIM_BATCH_SIZE = 50
+    __PROGRESS_FIELDS = {'progress', 'total', 'current_file'}
+    __STATUS_FIELDS = ('status', 'progress', 'total', 'current_file', 'error', 'result', 'started_at',
+                       'completed_at')
+
+    ROLES = ('all', 'web', 'worker')
+
+    def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             with cls._lock:
                 if cls._instance is None:
@@ -73,120 +177,494 @@ class TaskManager:
                     cls._instance._initialized = False
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, config=None, registry=None, role='all'):
         if self._initialized:
             return
 
+        self.config = config
+        self.registry = registry
+        self.role = role
+        self.runs_tasks = role != 'web'
+        self.worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.cluster = config.get('cluster', False)
+        self.lease_seconds = config.get('lease_seconds', 60)
+        self.store = TaskStore.for_state_dir(config['state_dir'])
+        self.cluster_store = ClusterStore.for_state_dir(config['state_dir'])
         self.tasks = {}
-        self.task_queue = queue.Queue()
+        self.tasks_lock = threading.Lock()
+        self.scheduler = TaskScheduler(config['max_concurrent_tasks'])
+        metrics.TASK_QUEUE_DEPTH.set_function(self.scheduler.queue_depth)
+        metrics.ACTIVE_TASKS.set_function(self.scheduler.running_count)
         self.worker_thread = None
+        self.store_thread = None
         self.running = False
-        self.execution_semaphore = threading.Semaphore(1)
+        self.events = TaskEvents()
+        self.last_retention_check = 0
+        self.last_change_seq = 0
+        self.last_timeline_persist = 0
+        self.last_lease_renewal = 0
+        self.applied_limits = None
         self._initialized = True
 
     def start(self):
         if not self.running:
             self.running = True
-            self.worker_thread = threading.Thread(target=self._worker, daemon=True)
-            self.worker_thread.start()
+            self.last_change_seq = self.store.last_change()
+            if self.runs_tasks:
+                # Runtime limit changes last until the downloading process restarts
+                self.store.save_setting('limits', None)
+                if self.cluster:
+                    DownloadSlots.set_cluster(ClusterSlots(self.cluster_store, self.worker_id, self.lease_seconds))
+                self._recover_unfinished_tasks()
+                self.worker_thread = threading.Thread(target=self._worker, daemon=True)
+                self.worker_thread.start()
+            self.store_thread = threading.Thread(target=self._sync_with_store, name='task-store-sync', daemon=True)
+            self.store_thread.start()
 
     def stop(self):
         self.running = False
-        if self.worker_thread:
-            self.worker_thread.join(timeout=5)
+        for thread in (self.worker_thread, self.store_thread):
+            if thread:
+                thread.join(timeout=5)
+
+    def _recover_unfinished_tasks(self):
+        self._release_stale_claims()
+        self._claim_submitted_tasks()
+
+    def _release_stale_claims(self):
+        # Claims of dead processes on this host are released right away rather
+        # than when their lease runs out; a container restarted with the same
+        # hostname and PID reuses the old worker id.
+        host = socket.gethostname()
+        for record in self.store.list_unfinished():
+            worker_id = self.store.get_claim(record['task_id'])
+            if worker_id is None:
+                continue
+            claim_host, _, pid = worker_id.rpartition(':')
+            if worker_id == self.worker_id or (claim_host == host and not self.__is_process_alive(pid)):
+                self.store.release_claim(record['task_id'])
 
-    def _worker(self):
+    @staticmethod
+    def __is_process_alive(pid):
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, ProcessLookupError):
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _sync_with_store(self):
         while self.running:
             try:
-                task_id = self.task_queue.get(timeout=1)
-                task = self.tasks.get(task_id)
-
-                if task:
-                    if task.is_cancelled():
-                        if task.status == TaskStatus.PENDING:
-                            task.completed_at = datetime.now()
-                    else:
-                        task.execution_thread = threading.Thread(
-                            target=self._execute_task_wrapper,
-                            args=(task,),
-                            daemon=True
-                        )
-                        task.execution_thread.start()
-
-                self.task_queue.task_done()
-            except queue.Empty:
+                if self.runs_tasks:
+                    self._renew_leases()
+                    self._claim_submitted_tasks()
+                    self._apply_cancellations()
+                    self._apply_shared_limits()
+                if self.role == 'worker':
+                    self._persist_running_timelines()
+                if self.role == 'web':
+                    self._publish_store_changes()
+            except Exception as e:
+                logger.error(f"Task store sync error: {e}")
+            time.sleep(self.STORE_POLL_INTERVAL_SECONDS)
+
+    def _claim_submitted_tasks(self):
+        capacity = self._claim_capacity()
+        if not capacity:
+            return
+
+        for record in self.store.claim_pending(self.worker_id, capacity, self.lease_seconds):
+            if record['task_id'] in self.tasks:
                 continue
+            task = Task.from_dict(record)
+            if task.status == TaskStatus.RUNNING:
+                # Left running by a process that stopped; clips already on disk are skipped
+                task.status = TaskStatus.PENDING
+                task.started_at = None
+                task.progress = 0
+                task.total = 0
+                self.store.save(task.to_dict())
+                logger.info(f"Recovered task {task.display_id}")
+            else:
+                logger.info(f"Picked up task {task.display_id}")
+            self._track(task)
+            self.scheduler.submit(task)
+
+    def _claim_capacity(self):
+        if not self.cluster:
+            return self.CLAIM_BATCH_SIZE
+        # A node only takes what it can start soon, leaving the rest of the
+        # queue to nodes with free capacity.
+        with self.tasks_lock:
+            unfinished = sum(1 for task in self.tasks.values() if not task.is_finished())
+        return max(0, self.config['max_concurrent_tasks'] * 2 - unfinished)
+
+    def _renew_leases(self):
+        now = time.monotonic()
+        if now - self.last_lease_renewal < self.lease_seconds / 3:
+            return
+        self.last_lease_renewal = now
+
+        held = self.store.renew_claims(self.worker_id, self.lease_seconds)
+        if self.cluster:
+            self.cluster_store.renew(self.worker_id, self.lease_seconds)
+
+        with self.tasks_lock:
+            lost = [task for task in self.tasks.values() if not task.is_finished() and task.task_id not in held]
+            for task in lost:
+                del self.tasks[task.task_id]
+        for task in lost:
+            # Another node took the task over after this one missed its
+            # heartbeats; stop without writing over the new owner's state.
+            logger.warning(f"Lease on task {task.display_id} was lost, stopping it on this node")
+            task.listener = None
+            task.cancel_flag.set()
+            self.scheduler.discard_waiting(task)
+
+    def _apply_cancellations(self):
+        for task_id in self.store.pop_cancellations(self.worker_id):
+            task = self.tasks.get(task_id)
+            if task:
+                self._cancel(task)
+
+    def _cancel(self, task):
+        task.cancel()
+        self.scheduler.discard_waiting(task)
+        # A task dropped from the queue never reaches _execute_task_wrapper
+        if task.is_finished():
+            self.store.release_claim(task.task_id, self.worker_id)
+
+    def _apply_shared_limits(self):
+        limits = self.store.get_setting('limits')
+        if limits is not None and limits != self.applied_limits:
+            BandwidthLimiter.set_limits(limits)
+            self.applied_limits = limits
+
+    def _persist_running_timelines(self):
+        now = time.monotonic()
+        if now - self.last_timeline_persist < self.TIMELINE_PERSIST_INTERVAL_SECONDS:
+            return
+        self.last_timeline_persist = now
+
+        with self.tasks_lock:
+            running = [task for task in self.tasks.values() if task.status == TaskStatus.RUNNING and task.timeline]
+        for task in running:
+            self.store.save_timeline(task.task_id, task.timeline.to_dict())
+
+    def _publish_store_changes(self):
+        changes, self.last_change_seq = self.store.list_changes(self.last_change_seq)
+        published = set()
+        for change in changes:
+            if change['kind'] != 'created' and change['task_id'] in published:
+                continue
+            record = self.store.get(change['task_id'])
+            if record is None:
+                continue
+            published.add(change['task_id'])
+
+            task = Task.from_dict(record).to_dict()
+            if change['kind'] == 'created':
+                self.events.publish({'type': 'created', 'task': task})
+            else:
+                self.events.publish({'type': 'updated', 'task_id': task['task_id'],
+                                     'changes': {name: task[name] for name in self.__STATUS_FIELDS}})
+
+    def _worker(self):
+        while self.running:
+            try:
+                self._apply_retention()
+                task = self.scheduler.next_task(timeout=1)
+                if task is None:
+                    continue
+
+                if task.is_cancelled():
+                    self.scheduler.release(task)
+                    if task.status == TaskStatus.PENDING:
+                        task.update(completed_at=datetime.now())
+                    self.store.release_claim(task.task_id, self.worker_id)
+                else:
+                    task.execution_thread = threading.Thread(
+                        target=self._execute_task_wrapper,
+                        args=(task,),
+                        daemon=True
+                    )
+                    task.execution_thread.start()
             except Exception as e:
                 logger.error(f"Worker error: {e}")
 
     def _execute_task_wrapper(self, task):
-        with self.execution_semaphore:
-            try:
-                self._execute_task(task)
-            except Exception as e:
-                task.status = TaskStatus.FAILED
-                task.error = f"Task execution error: {str(e)}"
-                task.completed_at = datetime.now()
+        try:
+            self._execute_task(task)
+        except Exception as e:
+            task.update(status=TaskStatus.FAILED, error=f"Task execution error: {str(e)}",
+                        completed_at=datetime.now())
+        finally:
+            self.scheduler.release(task)
+            # Only this node's claim: a lost task already belongs to another one
+            self.store.release_claim(task.task_id, self.worker_id)
+            self._evict_finished_tasks()
 
     def _execute_task(self, task):
         if task.is_cancelled():
-            task.status = TaskStatus.CANCELLED
-            task.completed_at = datetime.now()
+            task.update(status=TaskStatus.CANCELLED, completed_at=datetime.now())
             return
 
-        task.status = TaskStatus.RUNNING
-        task.started_at = datetime.now()
+        task.update(status=TaskStatus.RUNNING, started_at=datetime.now())
+        task.timeline = TaskTimeline()
+        if task.params.get('profile'):
+            task.timeline.start_profiler().add_current_thread()
 
         try:
             from src.downloader import MediaDownloader
 
-            downloader = MediaDownloader(task.params['config'])
+            camera = self.registry.get(task.params.get('camera_id'))
+            if camera is None:
+                raise RuntimeError(f"Unknown camera '{task.params.get('camera_id')}'")
 
-            task.progress = 0
-            task.total = 0
+            task.update(progress=0, total=0)
 
+            # Mirror runs cover a few minutes each; a full pre-flight search
+            # would only delay them.
+            if DiskBudget.enabled() and not task.params.get('mirror') and not self._admit(task, camera):
+                return
+
+            downloader = MediaDownloader(self.config)
             result = downloader.download(
-                camera_url=task.params['camera_url'],
-                user_name=task.params['user_name'],
-                user_password=task.params['user_password'],
+                camera=camera,
                 start_datetime_str=task.params['start_datetime_str'],
                 end_datetime_str=task.params['end_datetime_str'],
-                camera_channel=task.params['camera_channel'],
-                task=task
+                camera_channels=task.channels(),
+                task=task,
+                incremental=bool(task.params.get('mirror'))
             )
 
             if task.is_cancelled():
-                task.status = TaskStatus.CANCELLED
+                task.update(status=TaskStatus.CANCELLED)
             elif result['status'] == 'success':
-                task.status = TaskStatus.COMPLETED
-                task.result = result
+                task.update(status=TaskStatus.COMPLETED, result=result)
             else:
-                task.status = TaskStatus.FAILED
-                task.error = result.get('message', 'Unknown error')
+                task.update(status=TaskStatus.FAILED, error=result.get('message', 'Unknown error'),
+                            result=result if 'files' in result else None)
 
         except Exception as e:
-            task.status = TaskStatus.FAILED
-            task.error = str(e)
+            task.update(status=TaskStatus.FAILED, error=str(e))
 
         finally:
-            task.completed_at = datetime.now()
+            DiskBudget.release(task.task_id)
+            task.timeline.stop_profiler()
+            task.update(completed_at=datetime.now())
+            if self.tasks.get(task.task_id) is task:
+                self.store.save_timeline(task.task_id, task.timeline.to_dict())
+
+    def _admit(self, task, camera):
+        from src.downloader import MediaDownloader
+
+        started_at = time.monotonic()
+        plan = MediaDownloader(self.config).plan(
+            camera, task.params['start_datetime_str'], task.params['end_datetime_str'], task.channels(),
+            task=task)
+        task.record_stage('plan', started_at, clips=plan['clips_to_download'], bytes=plan['bytes_to_download'])
+        if task.is_cancelled():
+            task.update(status=TaskStatus.CANCELLED)
+            return False
+
+        wait_started_at = time.monotonic()
+        decision = DiskBudget.admit(task.task_id, plan['bytes_to_download'], task.cancel_flag)
+        task.record_stage('admission_wait', wait_started_at, verdict=decision['verdict'])
+        if task.is_cancelled():
+            task.update(status=TaskStatus.CANCELLED)
+            return False
+        if decision['verdict'] == 'reject':
+            logger.warning(f"Task {task.display_id} rejected: {decision['message']}")
+            task.update(status=TaskStatus.FAILED, error=f"Not enough disk space: {decision['message']}")
+            return False
+        return True
+
+    def plan_task(self, params):
+        from src.downloader import MediaDownloader
+
+        camera = self.registry.get(params.get('camera_id'))
+        if camera is None:
+            raise ValueError(f"Unknown camera '{params.get('camera_id')}'")
+
+        plan = MediaDownloader(self.config).plan(camera, params['start_datetime_str'], params['end_datetime_str'],
+                                                 params['camera_channels'])
+        if DiskBudget.enabled():
+            plan['admission'] = DiskBudget.check(plan['bytes_to_download'])
+        return plan
+
+    def _track(self, task):
+        task.listener = self._on_task_changed
+        task.scheduler = self.scheduler
+        with self.tasks_lock:
+            self.tasks[task.task_id] = task
+
+    def _on_task_changed(self, task, changes):
+        self.events.publish({'type': 'updated', 'task_id': task.task_id, 'changes': serialize_changes(changes)})
+
+        now = time.monotonic()
+        if not self.__PROGRESS_FIELDS.issuperset(changes) or \
+                now - task.persisted_at >= self.PROGRESS_PERSIST_INTERVAL_SECONDS:
+            task.persisted_at = now
+            self.store.save(task.to_dict())
+
+    def _evict_finished_tasks(self):
+        keep_count = self.config['max_cached_finished_tasks']
+        with self.tasks_lock:
+            finished = sorted((task for task in self.tasks.values() if task.is_finished()),
+                              key=lambda task: task.created_at, reverse=True)
+            for task in finished[keep_count:]:
+                del self.tasks[task.task_id]
+
+    def _apply_retention(self):
+        now = time.monotonic()
+        if now - self.last_retention_check < self.RETENTION_CHECK_INTERVAL_SECONDS:
+            return
+        self.last_retention_check = now
+
+        created_before = datetime.now() - timedelta(days=self.config['task_retention_days'])
+        self.store.delete_finished(created_before.isoformat(), self.config['task_retention_count'])
 
     def create_task(self, params):
         task_id = str(uuid.uuid4())
         task = Task(task_id, params)
-        self.tasks[task_id] = task
-        self.task_queue.put(task_id)
+        # Claimed before it is saved, so no other node can pick it up first
+        claimed = self.runs_tasks and self._claim_capacity() > 0 and \
+            self.store.claim(task_id, self.worker_id, self.lease_seconds)
+        if claimed:
+            self._track(task)
+        self.store.save(task.to_dict(), kind='created')
+        self.events.publish({'type': 'created', 'task': task.to_dict()})
+        if claimed:
+            self.scheduler.submit(task)
         return task_id
 
     def get_task(self, task_id):
-        return self.tasks.get(task_id)
+        task = self.tasks.get(task_id)
+        if task:
+            return task
+
+        record = self.store.get(task_id)
+        return Task.from_dict(record) if record else None
 
     def get_all_tasks(self):
-        return list(self.tasks.values())
+        return self.list_tasks()
+
+    def list_tasks(self, status=None, limit=100, offset=0, mirror=False):
+        tasks = []
+        for record in self.store.list(status=status, limit=limit, offset=offset, mirror=mirror):
+            task = self.tasks.get(record['task_id'])
+            tasks.append(task if task else Task.from_dict(record))
+        return tasks
+
+    def count_tasks(self, status=None, mirror=False):
+        return self.store.count(status=status, mirror=mirror)
+
+    def get_batch(self, batch_id):
+        tasks = []
+        for record in self.store.list_batch(batch_id):
+            task = self.tasks.get(record['task_id'])
+            tasks.append(task if task else Task.from_dict(record))
+        if not tasks:
+            return None
+
+        statuses = {task.status for task in tasks}
+        if statuses & {TaskStatus.PENDING, TaskStatus.RUNNING}:
+            status = 'running' if TaskStatus.RUNNING in statuses else 'pending'
+        elif TaskStatus.FAILED in statuses:
+            status = 'failed'
+        elif statuses == {TaskStatus.CANCELLED}:
+            status = 'cancelled'
+        else:
+            status = 'completed'
+
+        return {
+            'batch_id': batch_id,
+            'status': status,
+            'progress': sum(task.progress for task in tasks),
+            'total': sum(task.total for task in tasks),
+            'tasks': [task.to_dict() for task in tasks]
+        }
+
+    def get_timeline(self, task_id):
+        task = self.tasks.get(task_id)
+        if task and task.timeline:
+            return task.timeline.to_dict()
+        return self.store.get_timeline(task_id)
+
+    def build_archive(self, task, archive_format):
+        camera = self.registry.get(task.params.get('camera_id'))
+        if camera is None:
+            return None
+
+        archive_index = ArchiveIndex.for_state_dir(self.config['state_dir'])
+        root = self.config['path_to_media_archive']
+        clips = archive_index.find_clips(camera.url, task.channels(), task.params['start_datetime_str'],
+                                         task.params['end_datetime_str'])
+
+        entries = []
+        for clip in clips:
+            try:
+                entries.append(ArchiveEntry.from_file(clip['file_path'], os.path.relpath(clip['file_path'], root)))
+            except OSError:
+                logger.warning(f"Clip {clip['file_path']} disappeared before it could be archived")
+        if not entries:
+            return None
+        return ArchiveStream(entries, archive_format, ClipChecksums(archive_index))
 
     def cancel_task(self, task_id):
         task = self.tasks.get(task_id)
         if task:
-            task.cancel()
+            self._cancel(task)
             return True
-        return False
+
+        # The task belongs to another process; it picks the request up from the store
+        if self.store.get(task_id) is None:
+            return False
+        if self.store.request_cancel(task_id):
+            task = Task.from_dict(self.store.get(task_id)).to_dict()
+            self.events.publish({'type': 'updated', 'task_id': task_id,
+                                 'changes': {name: task[name] for name in self.__STATUS_FIELDS}})
+        return True
+
+    def cluster_status(self):
+        return {
+            'worker_id': self.worker_id if self.runs_tasks else None,
+            'cluster': self.cluster,
+            'lease_seconds': self.lease_seconds,
+            'nodes': self.store.list_claims(),
+            'camera_slots': self.cluster_store.count_slots()
+        }
+
+    def get_limits(self):
+        self._apply_shared_limits()
+        return BandwidthLimiter.get_limits()
+
+    def set_limits(self, limits):
+        BandwidthLimiter.set_limits(limits)
+
+        # Overrides are merged rather than snapshotted so cameras still
+        # following the per-camera default keep doing so in other processes.
+        shared = self.store.get_setting('limits') or {}
+        for name in ('global', 'per_camera_default'):
+            if name in limits:
+                shared[name] = limits[name]
+        for name in ('cameras', 'sites'):
+            if name in limits:
+                shared[name] = dict(shared.get(name, {}), **limits[name])
+        self.store.save_setting('limits', shared)
+        self.applied_limits = shared
+        return BandwidthLimiter.get_limits()
+
+
+def serialize_changes(changes):
+    serialized = {}
+    for name, value in changes.items():
+        if isinstance(value, Enum):
+            value = value.value
+        elif isinstance(value, datetime):
+            value = value.isoformat()
+        serialized[name] = value
+    return serialized
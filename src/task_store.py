@@ -0,0 +1,241 @@
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from src.storage import SqliteStore
+
+
+class TaskStore(SqliteStore):
+    FILE_NAME = 'tasks.db'
+
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    display_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    progress INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    current_file TEXT,
+    error TEXT,
+    result TEXT,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status_created_at ON tasks (status, created_at);
+CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at);
+CREATE TABLE IF NOT EXISTS task_timelines (
+    task_id TEXT PRIMARY KEY,
+    timeline TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_claims (
+    task_id TEXT PRIMARY KEY,
+    worker_id TEXT NOT NULL,
+    claimed_at TEXT NOT NULL,
+    lease_expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_cancellations (
+    task_id TEXT PRIMARY KEY,
+    requested_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS task_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    origin TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+    UNFINISHED_STATUSES = ('pending', 'running')
+    __TAKE_OVER_EXPIRED = ('ON CONFLICT (task_id) DO UPDATE SET worker_id = excluded.worker_id, '
+                           'claimed_at = excluded.claimed_at, lease_expires_at = excluded.lease_expires_at '
+                           'WHERE task_claims.worker_id = excluded.worker_id OR task_claims.lease_expires_at < ?')
+    __PRIORITY_ORDER = ("CASE json_extract(params, '$.priority') WHEN 'urgent' THEN 0 WHEN 'high' THEN 1 "
+                        "WHEN 'low' THEN 3 ELSE 2 END")
+    MIRROR_KEEP_COUNT = 200
+    CHANGES_KEEP_COUNT = 10000
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Change rows written by this process are skipped when it replays the
+        # change log, since its own subscribers were already notified.
+        self.origin = uuid.uuid4().hex
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls.open(os.path.join(state_dir, cls.FILE_NAME))
+
+    def save(self, record, kind='updated'):
+        self.execute(
+            'INSERT OR REPLACE INTO tasks (task_id, display_id, status, params, progress, total, current_file, '
+            'error, result, created_at, started_at, completed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (record['task_id'], record['display_id'], record['status'], json.dumps(record['params']),
+             record['progress'], record['total'], record['current_file'], record['error'],
+             json.dumps(record['result']) if record['result'] is not None else None,
+             record['created_at'], record['started_at'], record['completed_at']))
+        self.__record_change(record['task_id'], kind)
+
+    def get(self, task_id):
+        rows = self.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,))
+        return self.__to_record(rows[0]) if rows else None
+
+    def list(self, status=None, limit=100, offset=0, mirror=False):
+        where, params = self.__filter(status, mirror)
+        rows = self.execute(
+            'SELECT * FROM tasks {} ORDER BY created_at DESC LIMIT ? OFFSET ?'.format(where),
+            params + (limit, offset))
+        return [self.__to_record(row) for row in rows]
+
+    def count(self, status=None, mirror=False):
+        where, params = self.__filter(status, mirror)
+        rows = self.execute('SELECT COUNT(*) AS count FROM tasks {}'.format(where), params)
+        return rows[0]['count']
+
+    def list_batch(self, batch_id):
+        rows = self.execute(
+            "SELECT * FROM tasks WHERE json_extract(params, '$.batch_id') = ? ORDER BY created_at", (batch_id,))
+        return [self.__to_record(row) for row in rows]
+
+    def save_timeline(self, task_id, timeline):
+        self.execute('INSERT OR REPLACE INTO task_timelines (task_id, timeline) VALUES (?, ?)',
+                     (task_id, json.dumps(timeline)))
+
+    def get_timeline(self, task_id):
+        rows = self.execute('SELECT timeline FROM task_timelines WHERE task_id = ?', (task_id,))
+        return json.loads(rows[0]['timeline']) if rows else None
+
+    def list_unfinished(self):
+        rows = self.execute(
+            'SELECT * FROM tasks WHERE status IN (?, ?) ORDER BY created_at', self.UNFINISHED_STATUSES)
+        return [self.__to_record(row) for row in rows]
+
+    def claim(self, task_id, worker_id, lease_seconds):
+        now = time.time()
+        rows = self.execute(
+            'INSERT INTO task_claims (task_id, worker_id, claimed_at, lease_expires_at) VALUES (?, ?, ?, ?) '
+            f'{self.__TAKE_OVER_EXPIRED} RETURNING task_id',
+            (task_id, worker_id, datetime.now().isoformat(), now + lease_seconds, now))
+        return bool(rows)
+
+    def get_claim(self, task_id):
+        rows = self.execute('SELECT worker_id FROM task_claims WHERE task_id = ?', (task_id,))
+        return rows[0]['worker_id'] if rows else None
+
+    def release_claim(self, task_id, worker_id=None):
+        if worker_id is None:
+            self.execute('DELETE FROM task_claims WHERE task_id = ?', (task_id,))
+        else:
+            self.execute('DELETE FROM task_claims WHERE task_id = ? AND worker_id = ?', (task_id, worker_id))
+
+    def claim_pending(self, worker_id, limit, lease_seconds):
+        # Unfinished tasks whose lease ran out belonged to a node that died;
+        # they are taken over like new ones, most urgent first.
+        now = time.time()
+        claimed = self.execute(
+            'INSERT INTO task_claims (task_id, worker_id, claimed_at, lease_expires_at) '
+            'SELECT task_id, ?, ?, ? FROM tasks WHERE status IN (?, ?) '
+            'AND task_id NOT IN (SELECT task_id FROM task_claims WHERE lease_expires_at >= ?) '
+            f'ORDER BY {self.__PRIORITY_ORDER}, created_at LIMIT ? {self.__TAKE_OVER_EXPIRED} RETURNING task_id',
+            (worker_id, datetime.now().isoformat(), now + lease_seconds, *self.UNFINISHED_STATUSES, now, limit, now))
+        return [record for record in (self.get(row['task_id']) for row in claimed) if record]
+
+    def renew_claims(self, worker_id, lease_seconds):
+        rows = self.execute(
+            'UPDATE task_claims SET lease_expires_at = ? WHERE worker_id = ? '
+            'AND task_id IN (SELECT task_id FROM tasks WHERE status IN (?, ?)) RETURNING task_id',
+            (time.time() + lease_seconds, worker_id, *self.UNFINISHED_STATUSES))
+        return {row['task_id'] for row in rows}
+
+    def list_claims(self):
+        rows = self.execute(
+            'SELECT c.worker_id, COUNT(*) AS tasks, MIN(c.lease_expires_at) AS lease_expires_at FROM task_claims c '
+            'JOIN tasks t ON t.task_id = c.task_id WHERE t.status IN (?, ?) AND c.lease_expires_at >= ? '
+            'GROUP BY c.worker_id ORDER BY c.worker_id', (*self.UNFINISHED_STATUSES, time.time()))
+        return [dict(row) for row in rows]
+
+    def request_cancel(self, task_id):
+        self.execute('INSERT OR REPLACE INTO task_cancellations (task_id, requested_at) VALUES (?, ?)',
+                     (task_id, datetime.now().isoformat()))
+        # Nobody is working on an unclaimed task yet, so it can be cancelled
+        # here instead of waiting for a worker to pick it up.
+        cancelled = self.execute(
+            'UPDATE tasks SET status = ?, completed_at = ? WHERE task_id = ? AND status = ? '
+            'AND task_id NOT IN (SELECT task_id FROM task_claims WHERE lease_expires_at >= ?) RETURNING task_id',
+            ('cancelled', datetime.now().isoformat(), task_id, 'pending', time.time()))
+        if cancelled:
+            self.execute('DELETE FROM task_cancellations WHERE task_id = ?', (task_id,))
+            self.__record_change(task_id, 'updated')
+        return bool(cancelled)
+
+    def pop_cancellations(self, worker_id):
+        rows = self.execute(
+            'DELETE FROM task_cancellations WHERE task_id IN '
+            '(SELECT task_id FROM task_claims WHERE worker_id = ?) RETURNING task_id', (worker_id,))
+        return [row['task_id'] for row in rows]
+
+    def last_change(self):
+        rows = self.execute('SELECT MAX(seq) AS seq FROM task_changes')
+        return rows[0]['seq'] or 0
+
+    def list_changes(self, after_seq, limit=1000):
+        rows = self.execute('SELECT seq, task_id, kind, origin FROM task_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+                            (after_seq, limit))
+        last_seq = rows[-1]['seq'] if rows else after_seq
+        return [dict(row) for row in rows if row['origin'] != self.origin], last_seq
+
+    def get_setting(self, name):
+        rows = self.execute('SELECT value FROM settings WHERE name = ?', (name,))
+        return json.loads(rows[0]['value']) if rows else None
+
+    def save_setting(self, name, value):
+        if value is None:
+            self.execute('DELETE FROM settings WHERE name = ?', (name,))
+        else:
+            self.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+
+    def delete_finished(self, created_before, keep_count):
+        self.execute(
+            'DELETE FROM tasks WHERE status NOT IN (?, ?) AND created_at < ?',
+            self.UNFINISHED_STATUSES + (created_before,))
+        # Mirror runs are kept to their own budget so that they never push
+        # manually requested tasks out of the history.
+        for mirror_filter, count in (('IS NULL', keep_count), ('IS NOT NULL', self.MIRROR_KEEP_COUNT)):
+            self.execute(
+                'DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks WHERE status NOT IN (?, ?) '
+                "AND json_extract(params, '$.mirror') {} ORDER BY created_at DESC LIMIT -1 OFFSET ?)".format(
+                    mirror_filter),
+                self.UNFINISHED_STATUSES + (count,))
+        self.execute('DELETE FROM task_timelines WHERE task_id NOT IN (SELECT task_id FROM tasks)')
+        # A new task is claimed just before it is saved, so only expired claims are pruned
+        self.execute('DELETE FROM task_claims WHERE lease_expires_at < ? AND task_id NOT IN '
+                     '(SELECT task_id FROM tasks WHERE status IN (?, ?))', (time.time(), *self.UNFINISHED_STATUSES))
+        self.execute('DELETE FROM task_cancellations WHERE task_id NOT IN (SELECT task_id FROM tasks)')
+        self.execute('DELETE FROM task_changes WHERE seq <= (SELECT MAX(seq) FROM task_changes) - ?',
+                     (self.CHANGES_KEEP_COUNT,))
+
+    def __record_change(self, task_id, kind):
+        self.execute('INSERT INTO task_changes (task_id, kind, origin) VALUES (?, ?, ?)',
+                     (task_id, kind, self.origin))
+
+    @staticmethod
+    def __filter(status, mirror):
+        conditions = ["json_extract(params, '$.mirror') IS {}".format('NOT NULL' if mirror else 'NULL')]
+        params = ()
+        if status:
+            conditions.append('status = ?')
+            params = (status,)
+        return 'WHERE ' + ' AND '.join(conditions), params
+
+    @staticmethod
+    def __to_record(row):
+        record = dict(row)
+        record['params'] = json.loads(record['params'])
+        record['result'] = json.loads(record['result']) if record['result'] is not None else None
+        return record
@@ -0,0 +1,121 @@
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+class TaskTimeline:
+    MAX_EVENTS = 10000
+
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.started_monotonic = time.monotonic()
+        self.events = []
+        self.dropped_events = 0
+        self.stages = {}
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def record(self, stage, started_at, duration=None, event=True, **details):
+        if duration is None:
+            duration = time.monotonic() - started_at
+
+        with self._lock:
+            totals = self.stages.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            totals['count'] += 1
+            totals['total_seconds'] += duration
+            totals['max_seconds'] = max(totals['max_seconds'], duration)
+
+            if not event:
+                return
+            if len(self.events) >= self.MAX_EVENTS:
+                self.dropped_events += 1
+                return
+            entry = {'stage': stage, 'start': round(started_at - self.started_monotonic, 4),
+                     'duration': round(duration, 4)}
+            entry.update(details)
+            self.events.append(entry)
+
+    def start_profiler(self):
+        self.profiler = TaskProfiler()
+        self.profiler.start()
+        return self.profiler
+
+    def stop_profiler(self):
+        if self.profiler:
+            self.profiler.stop()
+
+    def to_dict(self, include_events=True):
+        with self._lock:
+            stages = {stage: {'count': totals['count'],
+                              'total_seconds': round(totals['total_seconds'], 3),
+                              'max_seconds': round(totals['max_seconds'], 3)}
+                      for stage, totals in self.stages.items()}
+            timeline = {
+                'started_at': self.started_at.isoformat(),
+                'elapsed_seconds': round(time.monotonic() - self.started_monotonic, 3),
+                'stages': stages,
+                'dropped_events': self.dropped_events
+            }
+            if include_events:
+                timeline['events'] = list(self.events)
+
+        if self.profiler:
+            timeline['profile'] = self.profiler.to_dict()
+        return timeline
+
+
+class TaskProfiler:
+    SAMPLE_INTERVAL_SECONDS = 0.01
+    MAX_STACK_DEPTH = 40
+    MAX_REPORTED_STACKS = 50
+
+    def __init__(self):
+        self.samples = 0
+        self.stacks = Counter()
+        self._threads = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def add_current_thread(self):
+        with self._lock:
+            self._threads.add(threading.get_ident())
+
+    def start(self):
+        self._thread = threading.Thread(target=self.__sample_loop, name='task-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'interval_seconds': self.SAMPLE_INTERVAL_SECONDS,
+                'samples': self.samples,
+                'stacks': [{'stack': stack, 'count': count}
+                           for stack, count in self.stacks.most_common(self.MAX_REPORTED_STACKS)]
+            }
+
+    def __sample_loop(self):
+        while not self._stop_event.wait(self.SAMPLE_INTERVAL_SECONDS):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id in self._threads:
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.stacks[self.__fold(frame)] += 1
+                        self.samples += 1
+
+    @classmethod
+    def __fold(cls, frame):
+        names = []
+        while frame is not None and len(names) < cls.MAX_STACK_DEPTH:
+            code = frame.f_code
+            names.append('{}:{}'.format(code.co_filename.rsplit('/', 1)[-1], code.co_name))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
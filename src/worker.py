@@ -0,0 +1,85 @@
+import os
+import signal
+import threading
+
+from prometheus_client import start_http_server
+
+from src.admission import DiskBudget
+from src.archive_index import ArchiveIndex
+from src.camera import CameraSdk, CapabilityCache, SessionPool
+from src.camera_registry import CameraRegistry
+from src.config import get_config_from_env, validate_config, build_download_config
+from src.limits import BandwidthLimiter, DownloadSlots
+from src.logger import Logger
+from src.mirror import MirrorService
+from src.retention import RetentionEngine
+from src.retry import CircuitBreaker
+from src.storage import SqliteStore
+from src.task_manager import TaskManager
+
+
+def init_runtime(config, registry):
+    if config['cluster']:
+        SqliteStore.journal_mode = 'DELETE'
+    DownloadSlots.init(config['max_parallel_downloads'], config['max_global_downloads'])
+    BandwidthLimiter.init(config['rate_limit_global'], config['rate_limit_per_camera'])
+    CircuitBreaker.init(config['circuit_failure_threshold'], config['circuit_cooldown_seconds'],
+                        config['circuit_max_cooldown_seconds'])
+    for camera in registry.all():
+        DownloadSlots.set_camera_limit(camera.id, camera.max_parallel_downloads)
+        BandwidthLimiter.assign_site(camera.id, camera.site)
+        if camera.rate_limit is not None:
+            BandwidthLimiter.set_limits({'cameras': {camera.id: camera.rate_limit}})
+
+    os.makedirs(config['path_to_media_archive'], exist_ok=True)
+    DiskBudget.init(config['path_to_media_archive'], config['min_free_space_bytes'], config['download_quota_bytes'],
+                    ArchiveIndex.for_state_dir(config['state_dir']))
+
+    CameraSdk.init(config['default_timeout_seconds'], connection_pool_size=config['connection_pool_size'])
+    CapabilityCache.init(config['device_cache_ttl_minutes'] * 60)
+    CapabilityCache.warm(registry.all())
+
+
+def main():
+    args = get_config_from_env()
+    validate_config(args, lambda msg: (_ for _ in ()).throw(ValueError(msg)))
+
+    Logger.init_logger(log_level=args.get('log_level', 'INFO'))
+    logger = Logger.get_logger()
+
+    config = build_download_config(args)
+    registry = CameraRegistry.from_config(args)
+    init_runtime(config, registry)
+
+    task_manager = TaskManager(config=config, registry=registry, role='worker')
+    mirror_service = MirrorService(task_manager, registry, config)
+    retention_engine = RetentionEngine(config, registry, task_manager.worker_id)
+    task_manager.start()
+    mirror_service.start()
+    retention_engine.start()
+
+    if args['worker_metrics_port']:
+        start_http_server(args['worker_metrics_port'])
+        logger.info(f"Worker metrics served on port {args['worker_metrics_port']}")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    logger.info(f"HikFetch worker {task_manager.worker_id} started")
+    for camera in registry.all():
+        logger.info(f"Camera {camera.id}: {camera.url} (channels {camera.channels})")
+    logger.info(f"Media will be saved to: {args['download_dir']}")
+
+    stop_event.wait()
+
+    logger.info("Stopping HikFetch worker")
+    retention_engine.stop()
+    mirror_service.stop()
+    task_manager.stop()
+    SessionPool.close_all()
+    SqliteStore.close_all()
+
+
+if __name__ == '__main__':
+    main()
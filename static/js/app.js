@@ -1,5 +1,6 @@
 const form = document.getElementById('downloadForm');
 const taskList = document.getElementById('taskList');
+const cameraNames = {};
 
 const today = new Date().toISOString().split('T')[0];
 document.getElementById('start_date').value = today;
@@ -12,11 +13,13 @@ async function createTask(formData) {
     return await response.json();
 }
 
+const tasks = new Map();
+const taskElements = new Map();
+
 async function loadTasks() {
     try {
         const response = await fetch('/tasks');
-        const tasks = await response.json();
-        renderTasks(tasks);
+        renderTasks(await response.json());
     } catch (error) {
         console.error('Error loading tasks:', error);
     }
@@ -25,27 +28,76 @@ async function loadTasks() {
 async function cancelTask(taskId) {
     try {
         await fetch(`/tasks/${taskId}/cancel`, {method: 'POST'});
-        loadTasks();
     } catch (error) {
         console.error('Error canceling task:', error);
     }
 }
 
-function renderTasks(tasks) {
-    if (tasks.length === 0) {
+function renderTasks(taskData) {
+    tasks.clear();
+    taskElements.clear();
+    taskList.innerHTML = '';
+
+    taskData.forEach(task => tasks.set(task.task_id, task));
+    [...tasks.values()]
+        .sort((a, b) => new Date(b.created_at) - new Date(a.created_at))
+        .forEach(renderTask);
+
+    renderEmptyState();
+}
+
+function renderEmptyState() {
+    const emptyState = taskList.querySelector('.empty-state');
+    if (tasks.size === 0 && !emptyState) {
         taskList.innerHTML = '<div class="empty-state">No download tasks yet</div>';
+    } else if (tasks.size > 0 && emptyState) {
+        emptyState.remove();
+    }
+}
+
+function renderTask(task) {
+    let element = taskElements.get(task.task_id);
+    if (!element) {
+        element = document.createElement('div');
+        element.className = 'task-item';
+        element.dataset.createdAt = task.created_at;
+        taskElements.set(task.task_id, element);
+        insertTaskElement(task, element);
+    }
+    element.innerHTML = taskHtml(task);
+}
+
+function insertTaskElement(task, element) {
+    const createdAt = new Date(task.created_at);
+    const next = [...taskList.children].find(other =>
+        other.dataset.createdAt && new Date(other.dataset.createdAt) < createdAt);
+    taskList.insertBefore(element, next || null);
+}
+
+function addTask(task) {
+    if (task.params.mirror) {
         return;
     }
+    tasks.set(task.task_id, task);
+    renderEmptyState();
+    renderTask(task);
+}
 
-    tasks.sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+function updateTask(taskId, changes) {
+    const task = tasks.get(taskId);
+    if (!task) {
+        return;
+    }
+    Object.assign(task, changes);
+    renderTask(task);
+}
 
-    taskList.innerHTML = tasks.map(task => {
-        const progress = task.total > 0 ? Math.round((task.progress / task.total) * 100) : 0;
-        const isActive = task.status === 'running' || task.status === 'pending';
-        const showProgress = task.total > 0;
+function taskHtml(task) {
+    const progress = task.total > 0 ? Math.round((task.progress / task.total) * 100) : 0;
+    const isActive = task.status === 'running' || task.status === 'pending';
+    const showProgress = task.total > 0;
 
-        return `
-                <div class="task-item">
+    return `
                     <div class="task-header">
                         <div style="display: flex; align-items: center; gap: 10px;">
                             <span class="task-status ${task.status}">${task.status}</span>
@@ -53,11 +105,14 @@ function renderTasks(tasks) {
                         </div>
                         <div class="task-actions">
                             ${isActive ? `<button class="btn btn-danger btn-small" onclick="cancelTask('${task.task_id}')">Cancel</button>` : ''}
+                            ${task.status === 'completed' ? `<a class="btn btn-primary btn-small" href="/tasks/${task.task_id}/archive" download>Download ZIP</a>` : ''}
                         </div>
                     </div>
 
                     <div class="task-info">
-                        <div><strong>Channel:</strong> ${task.params.camera_channel}</div>
+                        ${cameraNames[task.params.camera_id] && Object.keys(cameraNames).length > 1 ? `<div><strong>Camera:</strong> ${cameraNames[task.params.camera_id]}</div>` : ''}
+                        <div><strong>Channel:</strong> ${(task.params.camera_channels || [task.params.camera_channel]).join(', ')}</div>
+                        ${task.params.priority && task.params.priority !== 'normal' ? `<div><strong>Priority:</strong> ${task.params.priority}</div>` : ''}
                         <div><strong>Time Range:</strong> ${task.params.start_datetime_str} - ${task.params.end_datetime_str}</div>
                         ${task.current_file ? `<div><strong>Current:</strong> ${task.current_file.split('/').pop()}</div>` : ''}
                         ${task.error ? `<div style="color: #d63031;"><strong>Error:</strong> ${task.error}</div>` : ''}
@@ -71,16 +126,42 @@ function renderTasks(tasks) {
                     ` : task.status === 'running' ? `<div style="color: #666; font-size: 13px;">Finding files...</div>` : ''}
 
                     ${task.status === 'running' ? '<div><span class="spinner"></span> Downloading...</div>' : ''}
-                </div>
             `;
-    }).join('');
+}
+
+function pollTasks() {
+    loadTasks();
+    setInterval(loadTasks, 2000);
+}
+
+function subscribeToTaskEvents() {
+    if (!window.EventSource) {
+        pollTasks();
+        return;
+    }
+
+    const source = new EventSource('/tasks/events');
+    source.onerror = () => {
+        // Closed rather than reconnecting: the server refused the stream
+        if (source.readyState === EventSource.CLOSED) {
+            pollTasks();
+        }
+    };
+    source.addEventListener('snapshot', event => renderTasks(JSON.parse(event.data)));
+    source.addEventListener('created', event => addTask(JSON.parse(event.data).task));
+    source.addEventListener('updated', event => {
+        const data = JSON.parse(event.data);
+        updateTask(data.task_id, data.changes);
+    });
 }
 
 form.addEventListener('submit', async (e) => {
     e.preventDefault();
 
     const formData = {
-        camera_channel: document.getElementById('camera_channel').value,
+        camera_id: document.getElementById('camera_id').value || undefined,
+        camera_channels: document.getElementById('camera_channel').value,
+        priority: document.getElementById('priority').value,
         start_date: document.getElementById('start_date').value,
         start_time: document.getElementById('start_time').value + ':00',
         end_date: document.getElementById('end_date').value,
@@ -89,7 +170,6 @@ form.addEventListener('submit', async (e) => {
 
     try {
         await createTask(formData);
-        loadTasks();
     } catch (error) {
         alert('Error creating task: ' + error.message);
     }
@@ -108,6 +188,20 @@ async function loadUserInfo() {
     }
 }
 
-loadTasks();
+async function loadCameras() {
+    try {
+        const response = await fetch('/cameras');
+        if (!response.ok) {
+            return;
+        }
+        const cameras = await response.json();
+        const select = document.getElementById('camera_id');
+        select.innerHTML = cameras.map(camera => `<option value="${camera.id}">${camera.name}</option>`).join('');
+        cameras.forEach(camera => { cameraNames[camera.id] = camera.name; });
+        document.getElementById('cameraGroup').style.display = cameras.length > 1 ? '' : 'none';
+    } catch (error) {
+    }
+}
+
+loadCameras().then(subscribeToTaskEvents);
 loadUserInfo();
-setInterval(loadTasks, 2000);
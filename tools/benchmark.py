@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from src.camera import CameraSdk, CapabilityCache, SessionPool
+from src.camera_registry import CameraConfig, CameraRegistry
+from src.config import get_config_from_env, validate_config, build_download_config
+from src.downloader import MediaDownloader
+from src.limits import BandwidthLimiter, DownloadSlots
+from src.logger import Logger
+from src.retry import CircuitBreaker
+from src.storage import SqliteStore
+from src.task_manager import Task, TaskManager, TaskStatus
+from src.timeline import TaskTimeline
+from tools.isapi_simulator import IsapiSimulator, add_simulator_arguments, config_from_arguments
+
+CAMERA_ID = 'simulator'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def build_config(args, simulator, download_dir):
+    overrides = {
+        'HIKFETCH_CAMERA_URL': simulator.url,
+        'HIKFETCH_CAMERA_USERNAME': simulator.config.username,
+        'HIKFETCH_CAMERA_PASSWORD': simulator.config.password,
+        'HIKFETCH_DOWNLOAD_DIR': download_dir,
+        'HIKFETCH_STATE_DIR': '',
+        'HIKFETCH_CAMERAS_FILE': '',
+        'HIKFETCH_AUTH_METHOD': 'none',
+        'HIKFETCH_WEB_USERNAME': '',
+        'HIKFETCH_WEB_PASSWORD': ''
+    }
+    for name, value in [('HIKFETCH_MAX_PARALLEL_DOWNLOADS', args.parallel),
+                        ('HIKFETCH_MAX_GLOBAL_DOWNLOADS', args.global_downloads),
+                        ('HIKFETCH_MAX_CONCURRENT_TASKS', args.concurrent_tasks)]:
+        if value:
+            overrides[name] = str(value)
+    os.environ.update(overrides)
+
+    env_args = get_config_from_env()
+    validate_config(env_args, lambda msg: (_ for _ in ()).throw(ValueError(msg)))
+    config = build_download_config(env_args)
+    config.update(default_timeout_seconds=args.timeout, retry_base_delay_seconds=args.retry_delay,
+                  retry_max_delay_seconds=args.retry_delay * 8)
+    return config
+
+
+def init_runtime(config, camera):
+    DownloadSlots.init(config['max_parallel_downloads'], config['max_global_downloads'])
+    BandwidthLimiter.init(config['rate_limit_global'], config['rate_limit_per_camera'])
+    CircuitBreaker.init(config['circuit_failure_threshold'], config['circuit_cooldown_seconds'],
+                        config['circuit_max_cooldown_seconds'])
+    CameraSdk.init(config['default_timeout_seconds'], connection_pool_size=config['connection_pool_size'])
+    CapabilityCache.init(config['device_cache_ttl_minutes'] * 60)
+    CapabilityCache.clear()
+    CapabilityCache.get(camera)
+
+
+def local_window(simulator, start_offset_hours, hours):
+    start = simulator.config.start + timedelta(hours=start_offset_hours)
+    end = start + timedelta(hours=hours) - timedelta(seconds=1)
+    return start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+
+
+def summarize(name, timelines, elapsed, simulator_stats, extra=None):
+    clips = [event for timeline in timelines for event in timeline.events if event['stage'] == 'clip']
+    ok_clips = [event for event in clips if event['result'] == 'ok']
+    received_bytes = sum(event['bytes'] for event in clips)
+    first_bytes = sorted(event['stages']['response'] for event in clips if 'response' in event['stages'])
+
+    summary = {
+        'scenario': name,
+        'elapsed_seconds': round(elapsed, 3),
+        'clips': len(ok_clips),
+        'clip_attempts': len(clips),
+        'clips_per_second': round(len(ok_clips) / elapsed, 2) if elapsed else 0,
+        'megabytes': round(received_bytes / 1024 / 1024, 2),
+        'megabytes_per_second': round(received_bytes / 1024 / 1024 / elapsed, 2) if elapsed else 0,
+        'ttfb_p50_ms': percentile_ms(first_bytes, 0.5),
+        'ttfb_p95_ms': percentile_ms(first_bytes, 0.95),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'simulator': simulator_stats
+    }
+    summary.update(extra or {})
+    return summary
+
+
+def percentile_ms(values, share):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * share))] * 1000, 1)
+
+
+def run_downloader(args, simulator, config, camera):
+    stats_before = simulator.stats.to_dict()
+    task = Task('benchmark', {})
+    task.timeline = TaskTimeline()
+    start, end = local_window(simulator, 0, args.hours)
+
+    started_at = time.monotonic()
+    result = MediaDownloader(config).download(camera, start, end, camera_channels=camera.channels, task=task)
+    elapsed = time.monotonic() - started_at
+
+    return summarize('downloader', [task.timeline], elapsed, stats_delta(stats_before, simulator.stats.to_dict()),
+                     {'status': result['status'], 'stages': task.timeline.to_dict(include_events=False)['stages']})
+
+
+def run_tasks(args, simulator, config, camera):
+    stats_before = simulator.stats.to_dict()
+    task_manager = new_task_manager(config, camera)
+
+    hours_per_task = args.hours / args.tasks
+    task_ids = []
+    started_at = time.monotonic()
+    for index in range(args.tasks):
+        task_ids.append(create_task(task_manager, simulator, camera, index * hours_per_task, hours_per_task))
+
+    tasks = [task_manager.get_task(task_id) for task_id in task_ids]
+    while not all(task.is_finished() for task in tasks):
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started_at
+    task_manager.stop()
+
+    return summarize('tasks', [task.timeline for task in tasks if task.timeline], elapsed,
+                     stats_delta(stats_before, simulator.stats.to_dict()),
+                     {'tasks': len(tasks),
+                      'failed_tasks': sum(1 for task in tasks if task.status != TaskStatus.COMPLETED)})
+
+
+def run_preemption(args, simulator, config, camera):
+    # A single task slot, so the urgent task has to preempt the running one
+    # at a clip boundary while both cover the same clips.
+    stats_before = simulator.stats.to_dict()
+    task_manager = new_task_manager(dict(config, max_concurrent_tasks=1), camera)
+
+    started_at = time.monotonic()
+    background = task_manager.get_task(create_task(task_manager, simulator, camera, 0, args.hours, 'low'))
+    while background.progress < 2 and not background.is_finished():
+        time.sleep(0.05)
+    urgent = task_manager.get_task(create_task(task_manager, simulator, camera, 0, args.hours / 4, 'urgent'))
+
+    tasks = [background, urgent]
+    deadline = started_at + args.preemption_timeout
+    while not all(task.is_finished() for task in tasks) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started_at
+    stuck = [task for task in tasks if not task.is_finished()]
+    for task in stuck:
+        task_manager.cancel_task(task.task_id)
+    task_manager.stop()
+
+    return summarize('preemption', [task.timeline for task in tasks if task.timeline], elapsed,
+                     stats_delta(stats_before, simulator.stats.to_dict()),
+                     {'tasks': len(tasks),
+                      'failed_tasks': sum(1 for task in tasks if task.status != TaskStatus.COMPLETED),
+                      'stuck_tasks': len(stuck),
+                      'preempted': 'preempted' in background.timeline.stages if background.timeline else False})
+
+
+def new_task_manager(config, camera):
+    # TaskManager is a per-process singleton; each scenario needs its own on its own state directory
+    TaskManager._instance = None
+    task_manager = TaskManager(config=config, registry=CameraRegistry([camera]))
+    task_manager.start()
+    return task_manager
+
+
+def create_task(task_manager, simulator, camera, start_offset_hours, hours, priority='normal'):
+    start, end = local_window(simulator, start_offset_hours, hours)
+    return task_manager.create_task({
+        'camera_id': camera.id,
+        'start_datetime_str': start,
+        'end_datetime_str': end,
+        'camera_channel': camera.channels[0],
+        'camera_channels': camera.channels,
+        'priority': priority
+    })
+
+
+def stats_delta(before, after):
+    return {name: value - before.get(name, 0) for name, value in after.items()}
+
+
+def print_summary(summary):
+    print('{scenario}: {clips} clips in {elapsed_seconds}s, {clips_per_second} clips/s, '
+          '{megabytes_per_second} MB/s, TTFB p50 {ttfb_p50_ms} ms p95 {ttfb_p95_ms} ms, '
+          'peak RSS {peak_rss_mb} MB'.format(**summary))
+    print('  simulator: {}'.format(summary['simulator']))
+    if summary.get('failed_tasks'):
+        print('  failed tasks: {} of {}'.format(summary['failed_tasks'], summary['tasks']))
+    if summary.get('stuck_tasks'):
+        print('  tasks still running at the timeout: {} of {}'.format(summary['stuck_tasks'], summary['tasks']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark against the ISAPI simulator')
+    add_simulator_arguments(parser)
+    parser.add_argument('--scenario', choices=['downloader', 'tasks', 'preemption', 'all'], default='all')
+    parser.add_argument('--tasks', type=int, default=4, help='Concurrent tasks in the task scenario')
+    parser.add_argument('--preemption-timeout', type=float, default=120,
+                        help='Seconds the preemption scenario waits for both tasks')
+    parser.add_argument('--parallel', type=int, default=None, help='Parallel downloads per camera')
+    parser.add_argument('--global-downloads', type=int, default=None, help='Parallel downloads overall')
+    parser.add_argument('--concurrent-tasks', type=int, default=None, help='Tasks allowed to run at once')
+    parser.add_argument('--timeout', type=float, default=5, help='Camera request timeout in seconds')
+    parser.add_argument('--retry-delay', type=float, default=0.1, help='Base retry delay in seconds')
+    parser.add_argument('--keep', action='store_true', help='Keep the downloaded files')
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the results to this file')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    Logger.init_logger(log_level=args.log_level)
+    simulator = IsapiSimulator(config_from_arguments(args)).start()
+    download_dir = tempfile.mkdtemp(prefix='hikfetch-benchmark-')
+    camera = CameraConfig(CAMERA_ID, simulator.url, simulator.config.username, simulator.config.password,
+                          channels=list(range(1, simulator.config.channels + 1)), archive_subdir='')
+
+    results = []
+    try:
+        for name, run in [('downloader', run_downloader), ('tasks', run_tasks), ('preemption', run_preemption)]:
+            if args.scenario not in (name, 'all'):
+                continue
+            # Each scenario gets its own archive and state, so nothing is skipped as already downloaded
+            config = build_config(args, simulator, os.path.join(download_dir, name))
+            if not results:
+                init_runtime(config, camera)
+            results.append(run(args, simulator, config, camera))
+            print_summary(results[-1])
+    finally:
+        SessionPool.close_all()
+        SqliteStore.close_all()
+        simulator.stop()
+        if args.keep:
+            print('Downloaded files kept in {}'.format(download_dir))
+        else:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    if any(summary.get('stuck_tasks') for summary in results):
+        raise SystemExit(1)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+import argparse
+import hashlib
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from base64 import b64decode
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+
+
+class SimulatorConfig:
+    def __init__(self, channels=1, start='2024-01-01 00:00:00', hours=24, clip_seconds=600, clip_size=1024 * 1024,
+                 latency_ms=0, bandwidth=0, error_rate=0.0, timeout_rate=0.0, auth='digest', username='admin',
+                 password='admin', timezone='CST-3:00:00', max_results=50, batch_search=True, range_support=True,
+                 seed=None):
+        self.channels = channels
+        self.start = datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+        self.hours = hours
+        self.clip_seconds = clip_seconds
+        self.clip_size = clip_size
+        self.latency_ms = latency_ms
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.auth = auth
+        self.username = username
+        self.password = password
+        self.timezone = timezone
+        self.max_results = max_results
+        self.batch_search = batch_search
+        self.range_support = range_support
+        self.seed = seed
+
+
+class SimulatorStats:
+    def __init__(self):
+        self.counters = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_bytes(self, amount):
+        with self._lock:
+            self.bytes_sent += amount
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self.counters, bytes_sent=self.bytes_sent)
+
+
+class IsapiSimulator:
+    XML_NAMESPACE = 'http://www.hikvision.com/ver20/XMLSchema'
+    CHUNK_SIZE = 64 * 1024
+    TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+    HANG_SECONDS = 3600
+
+    def __init__(self, config, host='127.0.0.1', port=0):
+        self.config = config
+        self.stats = SimulatorStats()
+        self.random = random.Random(config.seed)
+        self.realm = 'HikFetchSimulator'
+        self.nonces = set()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self.__handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='isapi-simulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def clips(self, channel):
+        clip_length = timedelta(seconds=self.config.clip_seconds)
+        end = self.config.start + timedelta(hours=self.config.hours)
+        clip_start = self.config.start
+        while clip_start < end:
+            yield channel, clip_start, min(clip_start + clip_length, end)
+            clip_start += clip_length
+
+    def playback_uri(self, channel, start, end):
+        return 'rtsp://{}/Streaming/tracks/{}01/?starttime={}&endtime={}&name=ch{:02d}_{}&size={}'.format(
+            self._server.server_address[0], channel, start.strftime(self.TIME_FORMAT),
+            end.strftime(self.TIME_FORMAT), channel, start.strftime(self.TIME_FORMAT), self.config.clip_size)
+
+    def search(self, track_ids, start, end, max_results, position):
+        matches = []
+        for track_id in track_ids:
+            channel = track_id // 100
+            if track_id % 100 != 1 or not 1 <= channel <= self.config.channels:
+                continue
+            matches += [(clip_start, track_id, clip_end) for _, clip_start, clip_end in self.clips(channel)
+                        if clip_start < end and clip_end > start]
+        matches.sort()
+        page = matches[position:position + min(max_results, self.config.max_results)]
+        return page, position + len(page) < len(matches)
+
+    def check_auth(self, header):
+        if self.config.auth == 'none':
+            return True
+        if not header:
+            return False
+
+        scheme, _, credentials = header.partition(' ')
+        if scheme.lower() == 'basic' and self.config.auth == 'basic':
+            try:
+                user_name, _, password = b64decode(credentials).decode().partition(':')
+            except ValueError:
+                return False
+            return user_name == self.config.username and password == self.config.password
+        if scheme.lower() == 'digest' and self.config.auth == 'digest':
+            return self.__check_digest(dict(re.findall(r'(\w+)="?([^",]+)"?', credentials)))
+        return False
+
+    def challenge(self):
+        if self.config.auth == 'basic':
+            return 'Basic realm="{}"'.format(self.realm)
+
+        nonce = secrets.token_hex(16)
+        with self._lock:
+            self.nonces.add(nonce)
+        return 'Digest realm="{}", qop="auth", nonce="{}", algorithm=MD5'.format(self.realm, nonce)
+
+    def __check_digest(self, fields):
+        with self._lock:
+            if fields.get('nonce') not in self.nonces:
+                return False
+        if fields.get('username') != self.config.username:
+            return False
+
+        ha1 = self.__md5('{}:{}:{}'.format(self.config.username, self.realm, self.config.password))
+        ha2 = self.__md5('{}:{}'.format(fields.get('method', ''), fields.get('uri', '')))
+        expected = self.__md5('{}:{}:{}:{}:{}:{}'.format(
+            ha1, fields.get('nonce'), fields.get('nc'), fields.get('cnonce'), fields.get('qop'), ha2))
+        return fields.get('response') == expected
+
+    @staticmethod
+    def __md5(text):
+        return hashlib.md5(text.encode()).hexdigest()
+
+    def __handler_class(self):
+        simulator = self
+
+        class Handler(_IsapiRequestHandler):
+            pass
+
+        Handler.simulator = simulator
+        return Handler
+
+
+class _IsapiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    simulator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.__handle('GET')
+
+    def do_POST(self):
+        self.__handle('POST')
+
+    def __handle(self, method):
+        simulator = self.simulator
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.split('?', 1)[0]
+        simulator.stats.count('requests')
+
+        if simulator.config.latency_ms:
+            time.sleep(simulator.config.latency_ms / 1000)
+
+        authorization = self.headers.get('Authorization')
+        if authorization and authorization.lower().startswith('digest'):
+            authorization += ', method="{}"'.format(method)
+        if not simulator.check_auth(authorization):
+            simulator.stats.count('unauthorised')
+            return self.__send_status(401, 'Unauthorized', 'notAuthorized',
+                                      {'WWW-Authenticate': simulator.challenge()})
+
+        if path == '/ISAPI/System/time':
+            return self.__send_time()
+        if path == '/ISAPI/ContentMgmt/capabilities':
+            return self.__send_capabilities()
+        if path == '/ISAPI/ContentMgmt/InputProxy/channels' and simulator.config.channels > 1:
+            return self.__send_channels('InputProxyChannelList', 'InputProxyChannel')
+        if path == '/ISAPI/System/Video/inputs/channels':
+            return self.__send_channels('VideoInputChannelList', 'VideoInputChannel')
+        if path == '/ISAPI/ContentMgmt/search' and method == 'POST':
+            return self.__send_search(body)
+        if path == '/ISAPI/ContentMgmt/download':
+            return self.__send_download(body)
+        return self.__send_status(404, 'Invalid Operation', 'notSupport')
+
+    def __send_time(self):
+        self.simulator.stats.count('time')
+        device_timezone = self.simulator.config.timezone
+        # POSIX zones count west of UTC, so CST-3:00:00 is three hours ahead
+        match = re.match(r'[A-Za-z]*([+-]?)(\d+):(\d+):(\d+)', device_timezone)
+        sign = 1 if match and match.group(1) == '-' else -1
+        offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3))) * sign if match else timedelta()
+        local_time = datetime.now(timezone.utc).replace(tzinfo=None) + offset
+        self.__send_xml(200, '<Time version="2.0" xmlns="{}"><timeMode>NTP</timeMode>'
+                             '<localTime>{}</localTime><timeZone>{}</timeZone></Time>'.format(
+                                 IsapiSimulator.XML_NAMESPACE, local_time.strftime('%Y-%m-%dT%H:%M:%S'), device_timezone))
+
+    def __send_capabilities(self):
+        self.__send_xml(200, '<RacmCap version="2.0" xmlns="{}"><isSupportDownloadByTime>true'
+                             '</isSupportDownloadByTime><isSupportRangeDownload>{}</isSupportRangeDownload>'
+                             '</RacmCap>'.format(IsapiSimulator.XML_NAMESPACE,
+                                                 str(self.simulator.config.range_support).lower()))
+
+    def __send_channels(self, list_tag, channel_tag):
+        channels = ''.join('<{0}><id>{1}</id><name>Camera {1:02d}</name></{0}>'.format(channel_tag, channel)
+                           for channel in range(1, self.simulator.config.channels + 1))
+        self.__send_xml(200, '<{0} version="2.0" xmlns="{1}">{2}</{0}>'.format(
+            list_tag, IsapiSimulator.XML_NAMESPACE, channels))
+
+    def __send_search(self, body):
+        simulator = self.simulator
+        simulator.stats.count('search')
+        try:
+            request = ElementTree.fromstring(body)
+            for element in request.iter():
+                element.tag = element.tag.rsplit('}', 1)[-1]
+            track_ids = [int(element.text) for element in request.iter('trackID')]
+            time_span = request.find('timeSpanList/timeSpan')
+            start = datetime.strptime(time_span.find('startTime').text[:19], '%Y-%m-%dT%H:%M:%S')
+            end = datetime.strptime(time_span.find('endTime').text[:19], '%Y-%m-%dT%H:%M:%S')
+            max_results = int(request.findtext('maxResults', '40'))
+            position = int(request.findtext('searchResultPostion', '0'))
+        except (ElementTree.ParseError, AttributeError, ValueError):
+            return self.__send_status(400, 'Invalid XML Content', 'badXmlContent')
+
+        if len(track_ids) > 1 and not simulator.config.batch_search:
+            return self.__send_status(400, 'Invalid XML Content', 'badXmlContent')
+
+        page, has_more = simulator.search(track_ids, start, end, max_results, position)
+        items = ''.join(
+            '<searchMatchItem><sourceID>{{0000}}</sourceID><trackID>{}</trackID><timeSpan>'
+            '<startTime>{}</startTime><endTime>{}</endTime></timeSpan><mediaSegmentDescriptor>'
+            '<contentType>video</contentType><codecType>H.264-BP</codecType><playbackURI>{}</playbackURI>'
+            '</mediaSegmentDescriptor></searchMatchItem>'.format(
+                track_id, clip_start.strftime('%Y-%m-%dT%H:%M:%SZ'), clip_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                simulator.playback_uri(track_id // 100, clip_start, clip_end).replace('&', '&amp;'))
+            for clip_start, track_id, clip_end in page)
+        self.__send_xml(200, '<CMSearchResult version="2.0" xmlns="{}"><searchID>{}</searchID>'
+                             '<responseStatus>true</responseStatus><responseStatusStrg>{}</responseStatusStrg>'
+                             '<numOfMatches>{}</numOfMatches><matchList>{}</matchList></CMSearchResult>'.format(
+                                 IsapiSimulator.XML_NAMESPACE, request.findtext('searchID', ''),
+                                 'MORE' if has_more else 'OK', len(page), items))
+
+    def __send_download(self, body):
+        simulator = self.simulator
+        config = simulator.config
+        simulator.stats.count('download')
+
+        roll = simulator.random.random()
+        if roll < config.timeout_rate:
+            simulator.stats.count('download_hang')
+            time.sleep(IsapiSimulator.HANG_SECONDS)
+            return
+        if roll < config.timeout_rate + config.error_rate:
+            simulator.stats.count('download_error')
+            return self.__send_status(500, 'Device Busy', 'deviceBusy')
+
+        size = config.clip_size
+        match = re.search(r'size=(\d+)', body.decode(errors='ignore'))
+        if match:
+            size = int(match.group(1))
+
+        offset = 0
+        range_match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if range_match and config.range_support:
+            offset = int(range_match.group(1))
+            if offset >= size:
+                return self.__send_status(416, 'Range Not Satisfiable', 'badRange')
+
+        self.send_response(206 if offset else 200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(size - offset))
+        if offset:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(offset, size - 1, size))
+        self.end_headers()
+
+        chunk = bytes(IsapiSimulator.CHUNK_SIZE)
+        remaining = size - offset
+        started_at = time.monotonic()
+        sent = 0
+        try:
+            while remaining > 0:
+                part = chunk[:min(remaining, len(chunk))]
+                self.wfile.write(part)
+                remaining -= len(part)
+                sent += len(part)
+                simulator.stats.add_bytes(len(part))
+                if config.bandwidth:
+                    ahead = sent / config.bandwidth - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def __send_status(self, code, status, substatus, headers=None):
+        self.__send_xml(code, '<ResponseStatus version="2.0" xmlns="{}"><requestURL>{}</requestURL>'
+                              '<statusCode>{}</statusCode><statusString>{}</statusString>'
+                              '<subStatusCode>{}</subStatusCode></ResponseStatus>'.format(
+                                  IsapiSimulator.XML_NAMESPACE, self.path, code // 100, status, substatus), headers)
+
+    def __send_xml(self, code, text, headers=None):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>' + text).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/xml; charset="UTF-8"')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def add_simulator_arguments(parser):
+    parser.add_argument('--channels', type=int, default=1, help='Number of video channels')
+    parser.add_argument('--start', default='2024-01-01 00:00:00', help='Start of the recorded archive, device local time')
+    parser.add_argument('--hours', type=float, default=24, help='Length of the recorded archive in hours')
+    parser.add_argument('--clip-seconds', type=int, default=600, help='Length of a single clip')
+    parser.add_argument('--clip-size', type=int, default=1024 * 1024, help='Size of a single clip in bytes')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request')
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes per second per download, 0 for unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of downloads answered with 500')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='Share of downloads that never answer')
+    parser.add_argument('--auth', choices=['none', 'basic', 'digest'], default='digest')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--timezone', default='CST-3:00:00', help='POSIX timezone reported by the device')
+    parser.add_argument('--max-results', type=int, default=50, help='Maximum matches returned per search page')
+    parser.add_argument('--no-batch-search', action='store_true', help='Reject searches with several track IDs')
+    parser.add_argument('--no-range', action='store_true', help='Ignore Range headers on downloads')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the error and timeout rolls')
+
+
+def config_from_arguments(args):
+    return SimulatorConfig(
+        channels=args.channels, start=args.start, hours=args.hours, clip_seconds=args.clip_seconds,
+        clip_size=args.clip_size, latency_ms=args.latency_ms, bandwidth=args.bandwidth, error_rate=args.error_rate,
+        timeout_rate=args.timeout_rate, auth=args.auth, username=args.username, password=args.password,
+        timezone=args.timezone, max_results=args.max_results, batch_search=not args.no_batch_search,
+        range_support=not args.no_range, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Hikvision ISAPI device for local testing')
+    parser.add_argument('--host', default=os.environ.get('SIMULATOR_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=8080)
+    add_simulator_arguments(parser)
+    args = parser.parse_args()
+
+    simulator = IsapiSimulator(config_from_arguments(args), args.host, args.port).start()
+    print('ISAPI simulator listening on {} ({} auth, user {!r})'.format(simulator.url, args.auth, args.username))
+    try:
+        while True:
+            time.sleep(60)
+            print(simulator.stats.to_dict())
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()